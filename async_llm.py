@@ -0,0 +1,271 @@
+"""
+asyncio counterpart of foo.LLM, so one process can keep many
+conversations in flight against an Ollama host at the same time.
+
+    async with AsyncLLM("llama3") as llm:
+        answers = await llm.chat_many(conversations, concurrency=8)
+"""
+
+import asyncio
+import os
+
+import aiohttp
+
+from foo import (
+    CONNECT_TIMEOUT,
+    POOL_MAXSIZE,
+    READ_TIMEOUT,
+    json_loads,
+    logger,
+    placeholder_turns,
+)
+from metrics import CallTimer
+
+_DONE = object()
+
+
+async def fan_out(jobs, concurrency=4):
+    """Run jobs with at most `concurrency` of them in flight
+
+    Jobs are pulled from the iterable only as workers free up, so a long
+    (or endless) iterable never piles up pending coroutines in memory,
+    and results wait for the consumer instead of accumulating.
+
+    Args:
+        jobs (iterable): zero-argument callables returning awaitables
+        concurrency (int): number of jobs allowed to run at once
+    Yields:
+        tuple: (index, result) in completion order, where result is the
+            exception if the job raised
+    """
+    assert concurrency > 0, concurrency
+    pending = asyncio.Queue(maxsize=concurrency)
+    finished = asyncio.Queue(maxsize=concurrency)
+    failure = []
+
+    async def producer():
+        try:
+            for i, job in enumerate(jobs):
+                await pending.put((i, job))
+        except Exception as e:      # pylint: disable=broad-except
+            failure.append(e)
+        for _ in range(concurrency):
+            await pending.put(None)
+
+    async def worker():
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            i, job = item
+            try:
+                result = await job()
+            except Exception as e:      # pylint: disable=broad-except
+                result = e
+            await finished.put((i, result))
+        await finished.put(_DONE)
+
+    tasks = [asyncio.ensure_future(producer())]
+    tasks += [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        remaining = concurrency
+        while remaining:
+            item = await finished.get()
+            if item is _DONE:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+    if failure:
+        raise failure[0]
+
+
+async def gather(jobs, concurrency=4, return_exceptions=False):
+    """Like asyncio.gather, but bounded by `concurrency`
+
+    Args:
+        jobs (iterable): zero-argument callables returning awaitables
+        concurrency (int): number of jobs allowed to run at once
+        return_exceptions (bool): put exceptions in the result list
+            instead of raising the first one
+    Returns:
+        list: results in the same order as the jobs
+    """
+    results = {}
+    async for i, result in fan_out(jobs, concurrency):
+        if isinstance(result, Exception) and not return_exceptions:
+            raise result
+        results[i] = result
+    return [results[i] for i in range(len(results))]
+
+
+async def _lines(content):
+    """Lines of an aiohttp body, without their newlines, the last one
+    even if the body doesn't end with a newline
+
+    Lines are split here rather than with readline(), as the final
+    message of /api/generate can be longer than its limit. A long line
+    comes in many chunks, so each chunk is searched only once.
+    """
+    buf = bytearray()
+    scanned = 0     # buf[:scanned] has no newline in it
+    async for chunk in content.iter_any():
+        buf += chunk
+        while True:
+            end = buf.find(b"\n", scanned)
+            if end < 0:
+                scanned = len(buf)
+                break
+            line = bytes(buf[:end])
+            # cheap in CPython, which moves the start of the buffer
+            del buf[:end + 1]
+            scanned = 0
+            yield line
+    if buf:
+        yield bytes(buf)
+
+
+class AsyncLLM:
+    def __init__(self, model, session=None,
+                 connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT,
+                 pool_maxsize=POOL_MAXSIZE,
+                 metrics=None):
+        """
+        Args:
+            model (str): name of the Ollama model
+            session (ClientSession): aiohttp session to share; by default
+                one is created on first use and closed by close()
+            connect_timeout (float): seconds allowed to open a connection
+            read_timeout (float): seconds allowed between bytes of a response
+            pool_maxsize (int): connections kept open to the Ollama host
+            metrics (list): sinks that get the timings of every request
+        """
+        self.ollama_host = os.environ.get(
+            "OLLAMA_HOST",
+            "http://localhost:11434"
+        )
+        self.model = model
+        self.session = session
+        self._owns_session = session is None
+        self.pool_maxsize = pool_maxsize
+        self.metrics = list(metrics or [])
+        self.timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=connect_timeout,
+            sock_read=read_timeout
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=self.timeout
+            )
+        return self.session
+
+    async def stream(self, url, selector, **data):
+        """POST to the Ollama server and yield pieces of the answer
+
+        Args:
+            url (str): API path, e.g. "/api/chat"
+            selector (callable): picks the text out of one NDJSON message
+        Yields:
+            str: each piece of the answer as it arrives
+        """
+        assert callable(selector), selector
+        logger.info(self.ollama_host + url)
+        session = self._get_session()
+        timer = CallTimer(self.metrics, self.model, url) if self.metrics else None
+        async with session.post(self.ollama_host + url, json=data) as response:
+            async for line in _lines(response.content):
+                if not line.strip():
+                    continue
+                json_response = json_loads(line)
+                if "error" in json_response:
+                    logger.warning(line)
+                    logger.warning(json_response)
+                    return
+                if json_response.get('done', False):
+                    if timer is not None:
+                        timer.done(json_response)
+                    return
+                if timer is not None:
+                    timer.first()
+                yield selector(json_response)
+
+    async def _collect(self, url, selector, **data):
+        parts = []
+        async for piece in self.stream(url, selector, **data):
+            parts.append(piece)
+        full_response = "".join(parts)
+        logger.info(full_response)
+        return full_response
+
+    async def achat(self, _prompt=None, messages=None):
+        """Same as LLM.chat: each PLACEHOLDER is replaced by the model's
+        answer to the messages before it, then the whole conversation is run
+
+        Returns:
+            str: the answer to the last turn
+        """
+        assert _prompt is None, "handle this case later"
+        assert isinstance(messages, list), messages
+
+        async def run_thru(msgs):
+            return await self._collect(
+                "/api/chat",
+                lambda response: response["message"]["content"],
+                model=self.model,
+                messages=msgs
+            )
+
+        turns = placeholder_turns(messages)
+        answer = None
+        try:
+            while True:
+                answer = await run_thru(turns.send(answer))
+        except StopIteration as done:
+            return await run_thru(done.value)
+
+    async def agenerate(self, _prompt):
+        return await self._collect(
+            "/api/generate",
+            lambda response: response["response"],
+            model=self.model,
+            prompt=_prompt
+        )
+
+    async def chat_many(self, conversations, concurrency=4,
+                        return_exceptions=False):
+        """Run many conversations with at most `concurrency` in flight
+
+        Returns:
+            list: the final answer of each conversation, in order
+        """
+        jobs = ((lambda msgs=msgs: self.achat(messages=msgs))
+                for msgs in conversations)
+        return await gather(jobs, concurrency, return_exceptions)
+
+    async def generate_many(self, prompts, concurrency=4,
+                            return_exceptions=False):
+        """Run many prompts with at most `concurrency` in flight
+
+        Returns:
+            list: the answer to each prompt, in order
+        """
+        jobs = ((lambda p=p: self.agenerate(p)) for p in prompts)
+        return await gather(jobs, concurrency, return_exceptions)
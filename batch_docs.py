@@ -0,0 +1,255 @@
+"""
+Run the docstring conversation of foo.py over a whole code base.
+
+    python batch_docs.py src/ other.py --results docs.jsonl \\
+        [--per function] [--concurrency 4] [--priority size]
+
+Each module, or each top-level function and class with --per function,
+is one item. Items go to a pool of worker threads in priority order, and
+every answer is appended to the results file as soon as it's done. The
+results file is also the checkpoint: run the same command again after a
+crash and the items already in it are skipped, unless their code has
+changed since.
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from foo import LLM, POOL_MAXSIZE, TEST_PROMPT, conversation, make_session
+from snippets import default_index
+
+# foo logs every answer at INFO on the root logger; this one is left at
+# INFO for progress while the root is turned down to WARNING
+log = logging.getLogger("batch_docs")
+log.setLevel(logging.INFO)
+
+CONCURRENCY = 4
+# seconds between progress reports
+REPORT_EVERY = 10.0
+
+# priority: lower runs first. The code itself isn't kept, but read again
+# from the file when its turn comes, so a big tree doesn't sit in memory;
+# the answer is then recorded under the key of the code actually sent
+Item = namedtuple("Item", "priority key path qualname start_line end_line per")
+
+_DEFS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def iter_python_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(".py"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def item_key(per, path, qualname, code):
+    """Changes when the code does, so edited items are done again"""
+    text = "\0".join((per, os.path.abspath(path), qualname, code))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_file(path, per="module"):
+    """
+    Args:
+        per (str): "module" for one item per file, "function" for one
+            per top-level function or class
+    Returns:
+        list: (qualname, start_line, end_line, code) for each piece
+    """
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    lines = source.splitlines(keepends=True)
+    whole = [("<module>", 1, len(lines), source)] if source.strip() else []
+    if per == "module":
+        return whole
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return whole
+    pieces = []
+    for node in tree.body:
+        if isinstance(node, _DEFS):
+            # decorators belong with what they decorate
+            start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            pieces.append((node.name, start, node.end_lineno,
+                           "".join(lines[start - 1:node.end_lineno])))
+    return pieces or whole
+
+
+def make_items(paths, per="module", priority="order"):
+    """
+    Args:
+        priority (str): "order" runs items in the order given, "size"
+            runs the smallest first so results start coming in sooner
+    Returns:
+        list: Items
+    """
+    items = []
+    for path in iter_python_files(paths):
+        for qualname, start, end, code in split_file(path, per):
+            rank = len(code) if priority == "size" else len(items)
+            items.append(Item(rank, item_key(per, path, qualname, code),
+                              path, qualname, start, end, per))
+    return items
+
+
+def load_checkpoint(results_path):
+    """Read the results file, cutting off the partly written last line
+    a killed run may have left
+
+    Returns:
+        set: keys of the items the results file has answers for
+    """
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, "rb+") as f:
+        complete = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            complete += len(line)
+            result = json.loads(line)
+            if "error" not in result:
+                done.add(result["key"])
+        f.truncate(complete)
+    return done
+
+
+class Progress:
+    def __init__(self, total, report_every=REPORT_EVERY):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.time()
+        self.report_every = report_every
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    def finished(self, failed=False):
+        with self._lock:
+            self.done += 1
+            self.failed += failed
+            now = time.time()
+            if now - self._last_report >= self.report_every or self.done == self.total:
+                self._last_report = now
+                self.log()
+
+    def log(self):
+        elapsed = time.time() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else float("inf")
+        log.info("%d/%d items (%d failed), %.2f items/min, ETA %.0fs",
+                 self.done, self.total, self.failed, 60 * rate, eta)
+
+
+def read_code(item, snippets=None):
+    """
+    Args:
+        snippets (SnippetIndex): where to read the item's code, the shared
+            one by default
+    Returns:
+        tuple: (the item's code as it is now, the key to record its
+            answers under)
+    """
+    snippets = snippets or default_index()
+    code = snippets.snippet(item.path, item.start_line, item.end_line)
+    key = item_key(item.per, item.path, item.qualname, code)
+    if key != item.key:
+        log.warning("%s %s changed since it was listed", item.path, item.qualname)
+    return code, key
+
+
+def ask(llm, code, follow_ups=(TEST_PROMPT,)):
+    """
+    Returns:
+        list: the model's answer to each turn of the conversation
+    """
+    messages = conversation(code, follow_ups)
+    resolved = llm.resolve_placeholders(messages)
+    answers = [m["content"] for m, original in zip(resolved, messages)
+               if original is not m and m["role"] == "assistant"]
+    return answers + [llm.run_thru(resolved)]
+
+
+def run(llm, items, results_path, concurrency=CONCURRENCY, follow_ups=(TEST_PROMPT,)):
+    """Answer every item not already in the results file
+
+    Returns:
+        Progress: counts for this run
+    """
+    done = load_checkpoint(results_path)
+    todo = [item for item in items if item.key not in done]
+    log.info("%d items, %d done by an earlier run, %d to go",
+             len(items), len(items) - len(todo), len(todo))
+    pending = queue.PriorityQueue()
+    for item in todo:
+        pending.put(item)
+    progress = Progress(len(todo))
+    write_lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            t0 = time.time()
+            result = {"key": item.key, "path": item.path, "qualname": item.qualname,
+                      "lines": [item.start_line, item.end_line]}
+            try:
+                code, result["key"] = read_code(item)
+                result["answers"] = ask(llm, code, follow_ups)
+            except Exception as e:
+                log.warning("%s %s failed: %s", item.path, item.qualname, e)
+                result["error"] = repr(e)
+            result["seconds"] = time.time() - t0
+            line = json.dumps(result) + "\n"
+            with write_lock:
+                with open(results_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            progress.finished(failed="error" in result)
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="Python files or directories")
+    parser.add_argument("--results", required=True,
+                        help="JSON lines file for answers, also the checkpoint")
+    parser.add_argument("--per", choices=["module", "function"], default="module")
+    parser.add_argument("--priority", choices=["order", "size"], default="order")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--model", default="llama3")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    items = make_items(args.paths, args.per, args.priority)
+    session = make_session(pool_maxsize=max(args.concurrency, POOL_MAXSIZE))
+    llm = LLM(args.model, session=session)
+    run(llm, items, args.results, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Throughput against 1, 2, 4... local stub servers behind an EndpointPool.
+Each stub evaluates one request at a time, like an Ollama server with
+OLLAMA_NUM_PARALLEL=1, so requests/sec should grow with the number of
+servers. The last run stops one server halfway through to show requests
+failing over to the others.
+
+    python bench_endpoints.py [max_endpoints] [requests] [delay]
+"""
+
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stub_ollama
+from endpoints import EndpointPool
+from foo import LLM, logger
+
+logger.setLevel(logging.WARNING)
+CONCURRENCY = 16
+
+
+def run(llm, n):
+    t0 = time.time()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        answers = list(pool.map(lambda _: llm.generate("hi"), range(n)))
+    assert all(answers), answers
+    return n / (time.time() - t0)
+
+
+def main(max_endpoints, n, delay):
+    servers = []
+    count = 1
+    while count <= max_endpoints:
+        while len(servers) < count:
+            servers.append(stub_ollama.serve(delay=delay, parallel=1))
+        urls = ["http://127.0.0.1:%d" % s.server_address[1] for s in servers]
+        llm = LLM("stub", endpoints=EndpointPool(urls), pool_maxsize=CONCURRENCY)
+        print("%2d endpoints  %8.1f req/s" % (count, run(llm, n)))
+        count *= 2
+
+    # failover: take one server away while requests are going
+    urls = ["http://127.0.0.1:%d" % s.server_address[1] for s in servers]
+    pool = EndpointPool(urls, cooldown=60)
+    llm = LLM("stub", endpoints=pool, pool_maxsize=CONCURRENCY)
+    with ThreadPoolExecutor(1) as killer:
+        killer.submit(lambda: (time.sleep(n * delay / len(servers) / 2),
+                               setattr(servers[0], "down", True)))
+        rate = run(llm, n)
+    print("%2d endpoints, one stopped halfway  %8.1f req/s" % (len(servers), rate))
+    for endpoint in pool.report():
+        print("   %(url)s  %(requests)d requests, %(failures)d failures" % endpoint)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 4,
+         int(args[1]) if len(args) > 1 else 200,
+         float(args[2]) if len(args) > 2 else 0.02)
@@ -0,0 +1,49 @@
+"""
+Compare requests/sec against a local stub server with and without a
+pooled keep-alive session:
+
+    python bench_pool.py [number_of_requests]
+"""
+
+import logging
+import os
+import sys
+import time
+
+import requests
+
+import stub_ollama
+
+server = stub_ollama.serve()
+os.environ["OLLAMA_HOST"] = "http://127.0.0.1:%d" % server.server_address[1]
+
+from foo import LLM, logger    # noqa: E402
+
+logger.setLevel(logging.WARNING)
+
+
+def unpooled(llm, n):
+    # what LLM.post used to do: a fresh connection for every request
+    for _ in range(n):
+        r = requests.post(llm.ollama_host + "/api/generate",
+                          stream=True, timeout=20*60,
+                          json={"model": llm.model, "prompt": "hi"})
+        llm.print_streamed_response(r, lambda r: r["response"])
+
+
+def pooled(llm, n):
+    for _ in range(n):
+        llm.generate("hi")
+
+
+def main(n):
+    llm = LLM("stub")
+    for name, f in (("without pooling", unpooled), ("with pooling", pooled)):
+        t0 = time.time()
+        f(llm, n)
+        dt = time.time() - t0
+        print("%-16s %6d requests  %8.1f req/s" % (name, n, n / dt))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,195 @@
+"""
+Keep a chat's messages inside the model's context window.
+
+Ollama's /api/chat gets the whole conversation on every turn, and when it
+doesn't fit the model silently loses the start of it. A ContextWindow
+counts the tokens of each message and, before every turn, cuts the
+conversation down to its budget:
+
+1. code that was already sent earlier is replaced by a short note
+2. if that's not enough, the oldest turns in the middle go, or are
+   replaced by a summary; system messages, pinned messages and the
+   latest turns always stay
+
+Pin a message by giving it "pinned": True; the key is removed before the
+messages are sent.
+"""
+
+import hashlib
+import logging
+import os
+import re
+
+logger = logging.getLogger()
+
+# llama3 has an 8k context; leave room for the answer
+CONTEXT_BUDGET = int(os.environ.get("CONTEXT_BUDGET", 6000))
+# role markers and separators the chat template adds to each message
+MESSAGE_OVERHEAD = 4
+# messages at the end of the conversation that are never dropped
+KEEP_RECENT = 2
+# repeated text shorter than this isn't worth collapsing
+MIN_COLLAPSE_CHARS = 200
+
+_FENCED = re.compile(r"```[^\n]*\n.*?```", re.S)
+
+SUMMARY_PROMPT = """Summarize this conversation in a few sentences. Keep
+names of functions, classes and files, and any decisions made.
+
+"""
+
+
+def estimate_tokens(text):
+    """About four characters per token, which is close for English and
+    code with the Llama tokenizers"""
+    return (len(text) + 3) // 4
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def llm_summarizer(llm):
+    """A summarize function for ContextWindow that asks the model itself
+
+    Args:
+        llm (LLM): used for the summaries
+    """
+    def summarize(messages):
+        transcript = "\n\n".join("{0}: {1}".format(m["role"], m["content"])
+                                 for m in messages)
+        return llm.generate(SUMMARY_PROMPT + transcript)
+    return summarize
+
+
+class ContextWindow:
+    def __init__(self, budget=CONTEXT_BUDGET, count_tokens=estimate_tokens,
+                 summarize=None, keep_recent=KEEP_RECENT):
+        """
+        Args:
+            budget (int): tokens the messages sent may add up to
+            count_tokens (callable): str -> int, e.g. a real tokenizer
+            summarize (callable): list of messages -> str; without it,
+                middle turns are dropped instead of summarized
+            keep_recent (int): latest messages that are always kept
+        """
+        self.budget = budget
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.keep_recent = keep_recent
+        self.turns = []
+        # digests of the messages last summarized, and the summary
+        self._summarized = ()
+        self._summary = None
+
+    def tokens(self, message):
+        return self.count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+    def collapse(self, messages):
+        """Replace code blocks, and whole messages, that were already
+        sent earlier in the conversation with a note saying so"""
+        seen = set()
+        result = []
+        for m in messages:
+            content = m["content"]
+            if len(content) >= MIN_COLLAPSE_CHARS:
+                key = _digest(content)
+                if key in seen:
+                    result.append(dict(m, content="(same as an earlier message)"))
+                    continue
+                seen.add(key)
+            blocks = set()
+
+            def replace(match):
+                block = match.group(0)
+                if len(block) < MIN_COLLAPSE_CHARS:
+                    return block
+                key = _digest(block)
+                if key in seen:
+                    return "(code block sent earlier)"
+                blocks.add(key)
+                return block
+
+            content = _FENCED.sub(replace, content)
+            seen.update(blocks)
+            result.append(dict(m, content=content))
+        return result
+
+    def _assemble(self, messages, dropped, summary):
+        kept = []
+        for i, m in enumerate(messages):
+            if summary is not None and i == dropped[0]:
+                kept.append(summary)
+            if i not in dropped:
+                kept.append({k: v for k, v in m.items() if k != "pinned"})
+        return self.collapse(kept)
+
+    def fit(self, messages):
+        """
+        Args:
+            messages (list): the whole conversation, oldest first
+        Returns:
+            list: messages to send, within budget if at all possible
+        """
+        before = sum(self.tokens(m) for m in messages)
+        keep = set(range(max(len(messages) - self.keep_recent, 0), len(messages)))
+        keep.update(i for i, m in enumerate(messages)
+                    if m["role"] == "system" or m.get("pinned"))
+        middle = [i for i in range(len(messages)) if i not in keep]
+        dropped = []
+        summary = None
+        summarized = 0
+        # collapsed repeats refer back to earlier messages, so assemble
+        # again after each drop in case the original was the one dropped.
+        # The summary is made once enough has been dropped, and again
+        # only if it didn't leave enough room.
+        while True:
+            result = self._assemble(messages, dropped, summary)
+            total = sum(self.tokens(m) for m in result)
+            if total > self.budget and middle:
+                dropped.append(middle.pop(0))
+            elif self.summarize is not None and len(dropped) > summarized:
+                summary = self._summarize([messages[i] for i in dropped])
+                summarized = len(dropped)
+            else:
+                break
+        if total > self.budget:
+            logger.warning("%d tokens of messages that can't be dropped, "
+                           "over the budget of %d", total, self.budget)
+        turn = {
+            "messages": len(result),
+            "tokens": total,
+            "tokens_before": before,
+            "dropped": len(dropped),
+            "summarized": summary is not None,
+        }
+        self.turns.append(turn)
+        logger.info("turn %d: sending %d messages, about %d tokens (%d before "
+                    "fitting, %d messages dropped%s)", len(self.turns),
+                    turn["messages"], total, before, len(dropped),
+                    ", summarized" if summary is not None else "")
+        return result
+
+    def _summarize(self, messages):
+        """A summary message for the dropped turns. Turns dropped since
+        the last summary are folded into it, rather than summarizing the
+        whole span again every turn."""
+        digests = tuple(_digest(m["content"]) for m in messages)
+        n = len(self._summarized)
+        if digests == self._summarized:
+            return self._summary
+        if self._summary is not None and digests[:n] == self._summarized:
+            text = self.summarize([self._summary] + messages[n:])
+        else:
+            text = self.summarize(messages)
+        self._summarized = digests
+        self._summary = {"role": "system",
+                         "content": "Earlier in this conversation: " + text}
+        return self._summary
+
+    def report(self):
+        """
+        Returns:
+            list: for each turn, the messages and tokens sent
+        """
+        return [dict(t) for t in self.turns]
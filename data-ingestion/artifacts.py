@@ -0,0 +1,260 @@
+"""
+Download and unpack build artifacts in one pass.
+
+A .tar.gz is decompressed and unpacked while it downloads, so nothing
+but the extracted files ever touches the disk. A zip can't be read
+until its central directory, at the very end, has arrived, so it is
+spooled to a temporary file as it downloads and its members are then
+extracted by several threads at once. Either way the SHA-256 and the
+size of the archive come back with the download rate, and anything
+wrong (a truncated or corrupt archive, a member that would land outside
+the output directory, a checksum that doesn't match) raises
+ExtractionError.
+
+Artifacts come from an artifact store, which has two methods:
+
+    locate(prefix, branch, revision)    key of the newest matching archive
+    open(key)                           readable binary stream of it
+
+S3ArtifactStore is the real one; fake_s3.FakeS3 serves a local
+directory the same way.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1 << 20
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", 4))
+ARCHIVE_SUFFIXES = (".tar.gz", ".tgz", ".zip")
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class HashingReader(object):
+    """Wraps a binary stream, hashing and counting what is read through it
+    and optionally copying it to another file"""
+
+    def __init__(self, stream, tee=None):
+        self.stream = stream
+        self.tee = tee
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        self.bytes += len(data)
+        if self.tee is not None:
+            self.tee.write(data)
+        return data
+
+    def drain(self):
+        """Read what's left, e.g. the padding after the end of a tar"""
+        while self.read(READ_SIZE):
+            pass
+
+
+def _target(outdir, name):
+    """Where a member goes, refusing names that point outside outdir"""
+    path = os.path.realpath(os.path.join(outdir, name))
+    if path != outdir and not path.startswith(outdir + os.sep):
+        raise ExtractionError("archive member {0!r} is outside {1}".format(name, outdir))
+    return path
+
+
+def extract_tar_stream(reader, outdir):
+    """Unpack a gzipped tar while reading it
+
+    :returns: number of members extracted
+    """
+    count = 0
+    try:
+        with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+            for member in tar:
+                _target(outdir, member.name)
+                if member.issym():
+                    _target(outdir, os.path.join(os.path.dirname(member.name), member.linkname))
+                elif member.islnk():
+                    _target(outdir, member.linkname)
+                if hasattr(tarfile, "data_filter"):
+                    tar.extract(member, outdir, filter="fully_trusted")
+                else:
+                    tar.extract(member, outdir)
+                count += 1
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise ExtractionError("can't extract tar.gz: {0}".format(e))
+    reader.drain()
+    return count
+
+
+def extract_zip_file(path, outdir, workers=EXTRACT_WORKERS):
+    """Extract a zip with several threads, each with its own ZipFile
+
+    :returns: number of members extracted
+    """
+    try:
+        with zipfile.ZipFile(path) as z:
+            members = z.infolist()
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ExtractionError("can't read zip: {0}".format(e))
+    for info in members:
+        _target(outdir, info.filename)
+    # directories first, so the threads don't race to create them; many
+    # zips have no entries for directories, only for the files in them
+    for info in members:
+        if info.is_dir():
+            os.makedirs(_target(outdir, info.filename), exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(_target(outdir, info.filename)), exist_ok=True)
+    files = [info for info in members if not info.is_dir()]
+    # biggest first, dealt round-robin, so the threads finish together
+    files.sort(key=lambda info: -info.file_size)
+    shares = [files[i::workers] for i in range(workers)]
+
+    def extract(share):
+        with zipfile.ZipFile(path) as z:
+            for info in share:
+                z.extract(info, outdir)
+                mode = info.external_attr >> 16
+                if mode & 0o777:
+                    os.chmod(_target(outdir, info.filename), mode & 0o777)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(extract, [s for s in shares if s]):
+                pass
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, OSError) as e:
+        raise ExtractionError("can't extract zip: {0}".format(e))
+    return len(members)
+
+
+def archive_kind(name):
+    if name.endswith((".tar.gz", ".tgz")):
+        return "tar.gz"
+    if name.endswith(".zip"):
+        return "zip"
+    raise ExtractionError("don't know how to extract {0}".format(name))
+
+
+def stream_and_extract(stream, name, outdir, expected_sha256=None,
+                       keep_archive=None, workers=EXTRACT_WORKERS):
+    """Extract an archive as it is read from stream
+
+    :param stream: binary stream of the archive, e.g. an S3 object's Body
+    :param name: the archive's name, which says whether it's a zip or tar.gz
+    :param outdir: existing directory to extract into
+    :param expected_sha256: hex digest the archive must have
+    :param keep_archive: also save the archive at this path
+    :returns: dict with sha256, bytes, seconds, bytes_per_second and members
+    :raises ExtractionError: if the archive is bad or its checksum doesn't match
+    """
+    kind = archive_kind(name)
+    outdir = os.path.realpath(outdir)
+    t0 = time.time()
+    tee = open(keep_archive, "wb") if keep_archive else None
+    try:
+        if kind == "tar.gz":
+            reader = HashingReader(stream, tee)
+            members = extract_tar_stream(reader, outdir)
+        else:
+            with tempfile.NamedTemporaryFile(suffix=".zip", dir=outdir) as spool:
+                reader = HashingReader(stream, tee)
+                shutil.copyfileobj(reader, spool, READ_SIZE)
+                spool.flush()
+                members = extract_zip_file(spool.name, outdir, workers)
+    finally:
+        if tee is not None:
+            tee.close()
+    return _finish(name, outdir, reader, members, t0, expected_sha256)
+
+
+def extract_file(path, outdir, expected_sha256=None, workers=EXTRACT_WORKERS):
+    """Extract an archive that is already on disk
+
+    A zip is extracted where it is, rather than spooled to a copy first.
+    Arguments and result as for stream_and_extract().
+    """
+    if archive_kind(path) == "tar.gz":
+        with open(path, "rb") as f:
+            return stream_and_extract(f, path, outdir, expected_sha256, workers=workers)
+    outdir = os.path.realpath(outdir)
+    t0 = time.time()
+    with open(path, "rb") as f:
+        reader = HashingReader(f)
+        reader.drain()
+    members = extract_zip_file(path, outdir, workers)
+    return _finish(path, outdir, reader, members, t0, expected_sha256)
+
+
+def _finish(name, outdir, reader, members, t0, expected_sha256):
+    seconds = time.time() - t0
+    result = {
+        "sha256": reader.sha256.hexdigest(),
+        "bytes": reader.bytes,
+        "seconds": seconds,
+        "bytes_per_second": reader.bytes / seconds if seconds else 0.0,
+        "members": members,
+    }
+    if expected_sha256 and result["sha256"] != expected_sha256.lower():
+        raise ExtractionError("{0} has sha256 {1}, expected {2}".format(
+            name, result["sha256"], expected_sha256))
+    logger.info("extracted {0} members of {1} to {2}: {3} bytes at {4:.1f} MB/s, "
+                "sha256 {5}".format(members, name, outdir, reader.bytes,
+                                    result["bytes_per_second"] / 1e6, result["sha256"]))
+    return result
+
+
+def fetch_and_extract(store, prefix, branch, revision, outdir, **kwargs):
+    """Find the newest archive of a build, then stream and extract it
+
+    :returns: the archive's key, and the dict from stream_and_extract()
+    """
+    key = store.locate(prefix, branch, revision)
+    stream = store.open(key)
+    try:
+        return key, stream_and_extract(stream, key, outdir, **kwargs)
+    finally:
+        stream.close()
+
+
+class S3ArtifactStore(object):
+    """Build archives in an S3 bucket, found by branch and revision
+
+    Keys under the prefix that contain both the branch's basename and the
+    revision and end in .zip or .tar.gz match; the newest one wins.
+    """
+
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+
+    def locate(self, prefix, branch, revision):
+        paginator = self.client.get_paginator("list_objects_v2")
+        found = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if (os.path.basename(branch) in key and revision in key and
+                        key.endswith(ARCHIVE_SUFFIXES)):
+                    found.append((obj["LastModified"], key))
+        if not found:
+            raise ExtractionError("no archive of {0} {1} under s3://{2}/{3}".format(
+                branch, revision, self.bucket, prefix))
+        return max(found)[1]
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
@@ -0,0 +1,88 @@
+"""
+Download-then-extract against streaming extraction, on a synthetic
+preprocessor build served by FakeS3 at a simulated network rate:
+
+    python bench_artifacts.py [--mb 200] [--rate-mb 100] [--files 2000]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from artifacts import fetch_and_extract
+from fake_s3 import FakeS3
+
+PREFIX = "preprocessor/preprocessor"
+
+
+def make_build(directory, mb, files):
+    """A tree of files of mixed compressibility, like jars and scripts"""
+    tree = os.path.join(directory, "preprocessor")
+    size = mb * (1 << 20) // files
+    for i in range(files):
+        path = os.path.join(tree, "lib" if i % 2 else "php", "{0:02d}".format(i % 50),
+                            "file{0}".format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size // 2) + b"x" * (size - size // 2))
+    return tree
+
+
+def legacy(store, key, outdir):
+    """What fetch_and_extract_build used to do: save, then shell out"""
+    archive = os.path.join(outdir, os.path.basename(key))
+    with store.open(key) as stream, open(archive, "wb") as f:
+        shutil.copyfileobj(stream, f, 1 << 20)
+    if key.endswith(".zip"):
+        subprocess.run(["unzip", "-q", archive, "-d", outdir], check=True)
+    else:
+        subprocess.run(["tar", "xfz", archive, "-C", outdir], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mb", type=int, default=200)
+    parser.add_argument("--rate-mb", type=float, default=100.0)
+    parser.add_argument("--files", type=int, default=2000)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    try:
+        tree = make_build(os.path.join(work, "src"), args.mb, args.files)
+        store = FakeS3(os.path.join(work, "bucket"), args.rate_mb * 1e6)
+        tgz = os.path.join(work, "build.tar.gz")
+        with tarfile.open(tgz, "w:gz", compresslevel=1) as tar:
+            tar.add(tree, arcname="preprocessor")
+        store.put(PREFIX + "/main/1234/preprocessor-1234.tar.gz", tgz)
+        zipname = os.path.join(work, "build.zip")
+        with zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as z:
+            for root, _, names in os.walk(tree):
+                for name in names:
+                    path = os.path.join(root, name)
+                    z.write(path, os.path.relpath(path, os.path.dirname(tree)))
+        store.put(PREFIX + "/other/1234/preprocessor-1234.zip", zipname)
+
+        for branch in ("main", "other"):
+            key = store.locate(PREFIX, branch, "1234")
+            kind = "zip" if key.endswith(".zip") else "tar.gz"
+            out = tempfile.mkdtemp(dir=work)
+            t0 = time.time()
+            legacy(store, key, out)
+            print("%-7s download, then extract  %6.2fs" % (kind, time.time() - t0))
+            out = tempfile.mkdtemp(dir=work)
+            t0 = time.time()
+            _, result = fetch_and_extract(store, PREFIX, branch, "1234", out)
+            print("%-7s streaming               %6.2fs  %d members, %.1f MB/s, sha256 %s" % (
+                kind, time.time() - t0, result["members"],
+                result["bytes_per_second"] / 1e6, result["sha256"][:16]))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+`tar cfz` against packager.package() on a synthetic set of preprocessor
+outputs:
+
+    python bench_packager.py [--mb 200] [--files 2000] [--level 6] [--workers 4]
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import packager
+from bench_artifacts import make_build
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mb", type=int, default=200)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--level", type=int, default=packager.LEVEL)
+    parser.add_argument("--workers", type=int, default=packager.WORKERS)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    try:
+        tree = make_build(os.path.join(work, "src"), args.mb, args.files)
+        names = sorted(os.path.relpath(os.path.join(root, name), tree)
+                       for root, _, files in os.walk(tree) for name in files)
+
+        out = os.path.join(work, "legacy.tar.gz")
+        t0 = time.time()
+        subprocess.run("cd {0} && tar cfz {1} {2}".format(tree, out, " ".join(names)),
+                       shell=True, check=True)
+        print("tar cfz                 %6.2fs  %d bytes" % (time.time() - t0, os.path.getsize(out)))
+
+        out = os.path.join(work, "packed.tar.gz")
+        result = packager.package(tree, names, out, level=args.level, workers=args.workers)
+        print("package, %d workers     %6.2fs  %d bytes, %.1f MB/s" % (
+            args.workers, result["seconds"], result["compressed_bytes"],
+            result["bytes_per_second"] / 1e6))
+        # the gzip members read back as one tar, matching the manifest
+        check = os.path.join(work, "check")
+        os.makedirs(check)
+        subprocess.run(["tar", "xfz", out, "-C", check], check=True)
+        bad = [entry["name"] for entry in result["manifest"]
+               if _sha256(os.path.join(check, entry["name"])) != entry["sha256"]]
+        print("tar xfz: %d files, %d not matching the manifest" % (len(result["manifest"]), len(bad)))
+    finally:
+        shutil.rmtree(work)
+
+
+def _sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Latency and recall of the vector store backends on a synthetic corpus.
+Recall@k is measured against exact float32 search.
+
+    python bench_vector_store.py [--size 100000] [--dim 384] [--weaviate]
+
+--weaviate also loads the corpus into a scratch class on WEAVIATE_URL.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from ingest import class_schema, connect
+from vector_store import LocalStore, WeaviateStore
+
+BENCH_CLASS_NAME = "VectorStoreBench"
+
+
+def make_corpus(size, dim, queries, seed=0):
+    """Clustered unit vectors, and queries that are noisy copies of some"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(size // 100, 1), dim)).astype(np.float32)
+    corpus = centers[rng.integers(0, len(centers), size)]
+    corpus += 0.5 * rng.standard_normal((size, dim)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    picks = rng.integers(0, size, queries)
+    q = corpus[picks] + 0.1 * rng.standard_normal((queries, dim)).astype(np.float32)
+    return corpus, q
+
+
+def load(store, ids, corpus, batch=5000):
+    for i in range(0, len(ids), batch):
+        store.upsert({ids[j]: ({"filename": str(j)}, corpus[j])
+                      for j in range(i, min(i + batch, len(ids)))})
+    store.save()
+
+
+def measure(name, store, queries, truth, ids, k):
+    store.search(queries[0], k)     # warm up
+    t0 = time.time()
+    found = [store.search(q, k) for q in queries]
+    dt = time.time() - t0
+    recall = np.mean([len({h.uuid for h in hits} & {ids[i] for i in exact}) / k
+                      for hits, exact in zip(found, truth)])
+    print("%-18s %8.2f ms/query   recall@%d %.3f" % (name, 1000 * dt / len(queries), k, recall))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--weaviate", action="store_true")
+    args = parser.parse_args()
+
+    corpus, queries = make_corpus(args.size, args.dim, args.queries)
+    ids = [str(uuid.UUID(int=i)) for i in range(args.size)]
+    scores = queries @ corpus.T
+    truth = np.argsort(-scores, axis=1)[:, :args.k]
+
+    for quantize in (False, True):
+        directory = tempfile.mkdtemp()
+        try:
+            store = LocalStore(directory, quantize=quantize)
+            load(store, ids, corpus)
+            t0 = time.time()
+            store = LocalStore(directory)
+            print("%-18s %8.2f ms to open (memory-mapped)" % (
+                "local int8" if quantize else "local float32", 1000 * (time.time() - t0)))
+            measure("local int8" if quantize else "local float32",
+                    store, queries, truth, ids, args.k)
+        finally:
+            shutil.rmtree(directory)
+
+    if args.weaviate:
+        client = connect()
+        if BENCH_CLASS_NAME in [c["class"] for c in client.schema.get()["classes"]]:
+            client.schema.delete_class(BENCH_CLASS_NAME)
+        client.schema.create_class(class_schema(BENCH_CLASS_NAME))
+        try:
+            store = WeaviateStore(client, BENCH_CLASS_NAME, properties=["filename"])
+            load(store, ids, corpus)
+            measure("weaviate hnsw", store, queries, truth, ids, args.k)
+        finally:
+            client.schema.delete_class(BENCH_CLASS_NAME)
+
+
+if __name__ == "__main__":
+    main()
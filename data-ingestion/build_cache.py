@@ -0,0 +1,245 @@
+"""
+On-host cache of extracted preprocessor builds, shared by every worker
+process, keyed by (branch, revision).
+
+    cache = BuildCache("/var/cache/preprocessor", max_bytes=20 << 30)
+    with cache.acquire(branch, revision, install=extract_into) as lease:
+        run_with(lease.path)
+
+A build is installed once: install() fills a temporary directory, which
+is renamed into place when it's complete, so nobody ever sees half a
+build. While a lease is held the build can't be evicted: each lease
+holds a shared flock on the build's lock file, and eviction needs an
+exclusive one. Locks go away with the process that held them, so a
+crashed job never pins a build for good. When the builds add up to more
+than max_bytes, the least recently used ones nobody holds are removed.
+
+    <root>/index.db         SQLite: key, branch, revision, size, last_used, ...
+    <root>/builds/<key>/    an extracted build
+    <root>/locks/<key>      held shared by leases, exclusive to install/evict
+    <root>/tmp/             installs in progress
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = int(os.environ.get("PREPROCESSOR_CACHE_MAX_BYTES", 20 << 30))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    key TEXT PRIMARY KEY,
+    branch TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    installed REAL NOT NULL,
+    last_used REAL NOT NULL,
+    located TEXT
+);
+"""
+
+
+def build_key(branch, revision):
+    """Readable and unique directory name for a build"""
+    digest = hashlib.sha256("{0}\0{1}".format(branch, revision).encode("utf-8")).hexdigest()
+    readable = re.sub(r"[^\w.-]", "_", "{0}-{1}".format(os.path.basename(branch), revision))
+    return "{0}-{1}".format(readable[:64], digest[:12])
+
+
+def tree_size(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Lease(object):
+    """A build that is safe to use until release()"""
+
+    def __init__(self, key, path, located, lock_file):
+        self.key = key
+        self.path = path
+        # what locate() found when the build was installed, or None
+        self.located = located
+        self._lock_file = lock_file
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class BuildCache(object):
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        """
+        :param root: directory shared by all processes using the cache
+        :param max_bytes: disk budget for extracted builds
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        for sub in ("builds", "locks", "tmp"):
+            os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.root, "index.db"),
+                                 timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def _lock(self, key, mode):
+        f = open(os.path.join(self.root, "locks", key), "a")
+        try:
+            fcntl.flock(f, mode)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def build_path(self, key):
+        return os.path.join(self.root, "builds", key)
+
+    def _row(self, key):
+        return self._db().execute(
+            "SELECT located FROM builds WHERE key = ?", (key,)).fetchone()
+
+    def acquire(self, branch, revision, install, locate=None):
+        """Lease the build of (branch, revision), installing it if needed
+
+        :param install: callable(directory) that fills an empty directory
+            with the extracted build
+        :param locate: optional callable(directory) -> path in the build
+            worth remembering (e.g. the preprocessor's home), computed once
+            at install time and returned as lease.located
+        :returns: Lease, to be released when the build is no longer in use
+        """
+        key = build_key(branch, revision)
+        path = self.build_path(key)
+        lock = self._lock(key, fcntl.LOCK_SH)
+        row = self._row(key)
+        if row is not None and os.path.isdir(path):
+            self.hits += 1
+            self._touch(key)
+            logger.info("preprocessor build {0} {1} is cached at {2}".format(branch, revision, path))
+            return Lease(key, path, _absolute(path, row[0]), lock)
+        # upgrade to exclusive to install; someone else may have done it
+        # while we waited
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            row = self._row(key)
+            if row is None or not os.path.isdir(path):
+                self.misses += 1
+                row = (self._install(key, branch, revision, install, locate),)
+            else:
+                self.hits += 1
+                self._touch(key)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        lease = Lease(key, path, _absolute(path, row[0]), lock)
+        self.evict(keep=key)
+        return lease
+
+    def _install(self, key, branch, revision, install, locate):
+        path = self.build_path(key)
+        if os.path.exists(path):
+            # left by an install whose index update never happened
+            self._remove_tree(path)
+        tmp = tempfile.mkdtemp(prefix=key + ".", dir=os.path.join(self.root, "tmp"))
+        t0 = time.time()
+        try:
+            install(tmp)
+            located = None
+            if locate is not None:
+                located = os.path.relpath(locate(tmp), tmp)
+            size = tree_size(tmp)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        now = time.time()
+        self._db().execute("INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (key, branch, revision, size, now, now, located))
+        logger.info("installed preprocessor build {0} {1} ({2} bytes) in {3:.1f}s".format(
+            branch, revision, size, now - t0))
+        return located
+
+    def _touch(self, key):
+        self._db().execute("UPDATE builds SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    def _remove_tree(self, path):
+        # rename first so a half-deleted build is never mistaken for one
+        trash = tempfile.mkdtemp(prefix="evicted.", dir=os.path.join(self.root, "tmp"))
+        os.rename(path, os.path.join(trash, "build"))
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def evict(self, keep=None):
+        """Remove least recently used builds nobody holds until the rest
+        fit in max_bytes
+
+        :param keep: key of a build not to evict
+        :returns: keys of the builds removed
+        """
+        db = self._db()
+        rows = db.execute("SELECT key, size FROM builds ORDER BY last_used").fetchall()
+        total = sum(size for _, size in rows)
+        removed = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                lock = self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue        # in use
+            try:
+                # it may have been used, or evicted, while we looked
+                if db.execute("SELECT 1 FROM builds WHERE key = ?", (key,)).fetchone() is None:
+                    continue
+                db.execute("DELETE FROM builds WHERE key = ?", (key,))
+                if os.path.isdir(self.build_path(key)):
+                    self._remove_tree(self.build_path(key))
+            finally:
+                lock.close()
+            total -= size
+            removed.append(key)
+            logger.info("evicted preprocessor build {0} ({1} bytes)".format(key, size))
+        if total > self.max_bytes:
+            logger.warning("preprocessor builds in use take {0} bytes, over the budget of {1}".format(
+                total, self.max_bytes))
+        return removed
+
+    def stats(self):
+        count, size = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM builds").fetchone()
+        return {"builds": count, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+
+def _absolute(path, located):
+    return None if located is None else os.path.normpath(os.path.join(path, located))
@@ -0,0 +1,142 @@
+"""
+Split Python source into chunks along module, class and function
+boundaries, so each chunk fits in what the embedding model reads
+(all-MiniLM-L6-v2 silently drops everything past 256 word pieces).
+
+Top-level functions and classes become one chunk each if they fit. A
+class that doesn't fit is split into its methods, and anything that
+still doesn't fit is cut into overlapping windows of lines. Module-level
+code between definitions is grouped into `<module>` chunks. Comments
+and blank lines go with the statement that follows them, so every line
+of the file ends up in some chunk.
+"""
+
+import ast
+import os
+import re
+from collections import namedtuple
+
+MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 200))
+OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 32))
+MODULE = "<module>"
+
+Chunk = namedtuple("Chunk", "filename qualname start_line end_line text")
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+_DEFS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def estimate_tokens(text):
+    """Rough token count: identifiers, numbers and punctuation"""
+    return len(_TOKEN.findall(text))
+
+
+class _Chunker:
+    def __init__(self, filename, lines, max_tokens, overlap, count_tokens):
+        self.filename = filename
+        self.lines = lines
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.count_tokens = count_tokens
+        self.chunks = []
+
+    def text(self, start, end):
+        return "".join(self.lines[start - 1:end])
+
+    def emit(self, qualname, start, end):
+        """Add lines start..end (1-based, inclusive) as one chunk, or as
+        overlapping windows if they are too long"""
+        if start > end:
+            return
+        text = self.text(start, end)
+        if not text.strip():
+            return
+        if self.count_tokens(text) <= self.max_tokens:
+            self.chunks.append(Chunk(self.filename, qualname, start, end, text))
+            return
+        self.windows(qualname, start, end)
+
+    def windows(self, qualname, start, end):
+        counts = [self.count_tokens(line) for line in self.lines[start - 1:end]]
+        first = start
+        while first <= end:
+            total = 0
+            last = first
+            while last <= end and (last == first or
+                                   total + counts[last - start] <= self.max_tokens):
+                total += counts[last - start]
+                last += 1
+            last -= 1
+            self.chunks.append(Chunk(self.filename, qualname, first, last,
+                                     self.text(first, last)))
+            if last == end:
+                return
+            # back up so the next window repeats about `overlap` tokens
+            nxt = last + 1
+            carried = 0
+            while nxt - 1 > first and carried + counts[nxt - 1 - start] <= self.overlap:
+                nxt -= 1
+                carried += counts[nxt - start]
+            first = nxt
+
+    def body(self, statements, prefix, start, end):
+        """Chunk a module or class body covering lines start..end
+
+        The lines of a class statement itself go with the first thing in
+        its body.
+        Args:
+            prefix (str): qualified name of the enclosing class, if any
+        """
+        glue_name = prefix.rstrip(".") or MODULE
+        glue = []       # (start, end) of consecutive non-def statements
+        pos = start
+
+        def flush():
+            if glue:
+                self.emit(glue_name, glue[0][0], glue[-1][1])
+                del glue[:]
+
+        for i, node in enumerate(statements):
+            node_start = pos
+            node_end = node.end_lineno
+            if i == len(statements) - 1:
+                node_end = max(node_end, end)
+            pos = node_end + 1
+            if not isinstance(node, _DEFS):
+                glue.append((node_start, node_end))
+                continue
+            flush()
+            qualname = prefix + node.name
+            text = self.text(node_start, node_end)
+            if self.count_tokens(text) <= self.max_tokens or not isinstance(node, ast.ClassDef):
+                self.emit(qualname, node_start, node_end)
+            else:
+                self.body(node.body, qualname + ".", node_start, node_end)
+        flush()
+        if not statements and start <= end:
+            self.emit(glue_name, start, end)
+
+
+def chunk_source(source, filename, max_tokens=MAX_TOKENS,
+                 overlap=OVERLAP_TOKENS, count_tokens=estimate_tokens):
+    """Split Python source into chunks
+
+    Args:
+        source (str): the file's content
+        filename (str): recorded on each chunk
+        max_tokens (int): budget per chunk, as counted by count_tokens
+        overlap (int): tokens repeated between windows of an oversized body
+        count_tokens (callable): str -> int
+    Returns:
+        list: Chunk tuples in file order, with 1-based inclusive line ranges
+    """
+    lines = source.splitlines(keepends=True)
+    chunker = _Chunker(filename, lines, max_tokens, overlap, count_tokens)
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        chunker.emit(MODULE, 1, len(lines))
+        return chunker.chunks
+    chunker.body(tree.body, "", 1, len(lines))
+    return chunker.chunks
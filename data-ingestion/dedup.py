@@ -0,0 +1,220 @@
+"""
+Near-duplicate detection for chunks about to be embedded.
+
+Monorepos are full of vendored copies, generated files and forks of the
+same module. With a Deduplicator, ingestion embeds and stores one
+representative of each group of near-identical chunks, and lists where
+the others are in the representative's "aliases" property.
+
+Chunks are compared by MinHash signatures of their token shingles,
+after comments and whitespace are dropped, and candidates are found with
+LSH: the signature is cut into bands, and chunks sharing any band are
+compared. A chunk joins the first representative whose estimated
+Jaccard similarity is at least `threshold`; otherwise it becomes a
+representative itself. Comparing with representatives only, rather than
+with every member, keeps groups from drifting apart one small edit at a
+time.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", 0.9))
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+BANDS = 32
+
+# hashes are taken modulo the Mersenne prime 2**61 - 1
+_MASK61 = (1 << 61) - 1
+_PRIME = np.uint64(_MASK61)
+_LOW31 = np.uint64((1 << 31) - 1)
+_LOW30 = np.uint64((1 << 30) - 1)
+_COMMENT = re.compile(r"#[^\n]*")
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def tokens(code):
+    """Tokens of code with its comments left out
+
+    >>> tokens("x = 1  # one")
+    ['x', '=', '1']
+    """
+    return _TOKEN.findall(_COMMENT.sub("", code))
+
+
+def shingles(words, size=SHINGLE_SIZE):
+    """Hashes of every run of `size` tokens
+
+    Returns:
+        np.ndarray: uint64, one per distinct shingle
+    """
+    if len(words) <= size:
+        runs = [" ".join(words)]
+    else:
+        runs = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((_hash61(run) for run in runs), dtype=np.uint64, count=len(runs))
+
+
+def _hash61(text):
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") & _MASK61
+
+
+def alias(properties):
+    """Where a chunk is, e.g. /src/vendor/x.py:10-24"""
+    return "{0}:{1}-{2}".format(properties["path"], properties["start_line"],
+                                properties["end_line"])
+
+
+def _mod61(x):
+    """x modulo 2**61 - 1, for x below 2**64"""
+    x = (x & _PRIME) + (x >> np.uint64(61))
+    x = (x & _PRIME) + (x >> np.uint64(61))
+    return np.where(x >= _PRIME, x - _PRIME, x)
+
+
+def _mulmod61(a, x):
+    """a * x modulo 2**61 - 1, elementwise, for a and x below 2**61
+
+    The product doesn't fit in 64 bits, so both are split at bit 31 and
+    the pieces folded with 2**61 = 1 (mod 2**61 - 1).
+    """
+    a_hi, a_lo = a >> np.uint64(31), a & _LOW31
+    x_hi, x_lo = x >> np.uint64(31), x & _LOW31
+    # a*x = a_hi*x_hi*2**62 + mid*2**31 + a_lo*x_lo, and 2**62 = 2
+    mid = a_hi * x_lo + a_lo * x_hi
+    # mid*2**31 = (mid >> 30)*2**61 + (mid & (2**30 - 1))*2**31
+    folded = (mid >> np.uint64(30)) + ((mid & _LOW30) << np.uint64(31))
+    return _mod61(_mod61(a_hi * x_hi * np.uint64(2) + folded) + a_lo * x_lo)
+
+
+class MinHasher:
+    """Hash functions (a*x + b) mod 2**61 - 1, with a and b uniform in
+    [1, 2**61 - 1), standing in for random permutations of the shingles"""
+
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MASK61, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.b = rng.randint(1, _MASK61, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def signature(self, hashes):
+        """
+        Returns:
+            np.ndarray: uint64, the minimum of each hash function over
+                the shingles
+        """
+        x = np.asarray(hashes, dtype=np.uint64)[:, None]
+        permuted = _mod61(_mulmod61(self.a[None, :], x) + self.b)
+        return permuted.min(axis=0)
+
+
+class Deduplicator:
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM, bands=BANDS,
+                 shingle_size=SHINGLE_SIZE):
+        """
+        Args:
+            threshold (float): estimated Jaccard similarity from which two
+                chunks count as duplicates
+            num_perm (int): hash functions in a signature
+            bands (int): LSH bands; more find more candidates at lower
+                similarity, at more comparisons
+        """
+        assert num_perm % bands == 0, (num_perm, bands)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm)
+        self.buckets = {}       # (band, bytes of the band) -> representative UUIDs
+        self.signatures = {}    # representative UUID -> signature
+        self.exact = {}         # hash of the tokens -> representative UUID
+        self.aliases = {}       # representative UUID -> aliases
+        self.chunks = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def _bands(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def find(self, signature):
+        """
+        Returns:
+            str: UUID of the representative the signature is a near
+                duplicate of, None if there's none
+        """
+        candidates = []
+        for key in self._bands(signature):
+            candidates.extend(self.buckets.get(key, ()))
+        best, best_similarity = None, self.threshold
+        for object_id in dict.fromkeys(candidates):
+            similarity = float(np.mean(self.signatures[object_id] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = object_id, similarity
+        return best
+
+    def _add(self, object_id, digest, signature):
+        self.exact[digest] = object_id
+        self.signatures[object_id] = signature
+        self.aliases[object_id] = []
+        for key in self._bands(signature):
+            self.buckets.setdefault(key, []).append(object_id)
+
+    def filter(self, docs_by_file):
+        """Take the duplicates out of a batch of documents
+
+        A duplicate's (UUID, properties) is replaced by (UUID of its
+        representative, None), so it's left out of embedding and storing
+        but the representative is still recorded for its file.
+        Args:
+            docs_by_file (list): (filepath, read_source(filepath)) pairs
+        Returns:
+            tuple: (docs_by_file without duplicates, updates), where
+                updates maps the UUIDs of representatives stored by earlier
+                batches to the properties to change on them: new aliases
+        """
+        with self._lock:
+            in_batch = {}
+            changed = set()
+            result = []
+            for filepath, docs in docs_by_file:
+                kept = []
+                for object_id, properties in docs:
+                    self.chunks += 1
+                    words = tokens(properties["code"])
+                    digest = hashlib.sha256(" ".join(words).encode("utf-8")).digest()
+                    rep = self.exact.get(digest)
+                    signature = None
+                    if rep is None:
+                        signature = self.hasher.signature(shingles(words, self.shingle_size))
+                        rep = self.find(signature)
+                    if rep is None or rep == object_id:
+                        if rep is None:
+                            self._add(object_id, digest, signature)
+                        in_batch[object_id] = properties
+                        properties["aliases"] = list(self.aliases[object_id])
+                        kept.append((object_id, properties))
+                        continue
+                    self.duplicates += 1
+                    self.aliases[rep].append(alias(properties))
+                    changed.add(rep)
+                    kept.append((rep, None))
+                result.append((filepath, kept))
+            updates = {}
+            for rep in changed:
+                if rep in in_batch:
+                    in_batch[rep]["aliases"] = list(self.aliases[rep])
+                else:
+                    updates[rep] = {"aliases": list(self.aliases[rep])}
+            return result, updates
+
+    def stats(self):
+        return {"chunks": self.chunks, "duplicates": self.duplicates,
+                "representatives": len(self.signatures)}
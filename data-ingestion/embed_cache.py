@@ -0,0 +1,303 @@
+"""
+Cache of embeddings keyed by (model name, content hash), so text that
+was embedded before, under any path, branch or Weaviate instance, never
+goes through the model again.
+
+Vectors live in a flat float32 (or float16) matrix that readers
+memory-map, so a hit is a view into the page cache rather than a copy.
+A SQLite index maps content hashes to rows. Writers append under an
+flock; when the matrix grows past max_bytes, the most recently used rows
+are compacted into a new file (a new "generation") and the rest dropped.
+Readers notice the generation change and remap. Hits update the LRU
+order in batches, so lookups don't queue up on SQLite's write lock.
+
+    <root>/<model>/index.db
+    <root>/<model>/vectors.<generation>
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = int(os.environ.get("EMBED_CACHE_MAX_BYTES", 4 << 30))
+# fraction of max_bytes kept after a compaction, so it doesn't run
+# again on the very next write
+COMPACT_TO = 0.8
+# hits are remembered and their last_used written in one transaction
+# once there are this many, or this many seconds have passed, rather
+# than every lookup taking SQLite's write lock
+TOUCH_BATCH = 1024
+TOUCH_SECONDS = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+    key TEXT PRIMARY KEY,
+    row INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def content_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, root, model_name, dtype="float32", max_bytes=MAX_BYTES):
+        """
+        Args:
+            root (str): directory shared by all processes using the cache
+            model_name (str): embeddings of different models are kept apart
+            dtype (str): "float32", or "float16" to halve the disk and
+                page cache used
+            max_bytes (int): size of the vector matrix before compaction
+        """
+        self.dir = os.path.join(root, re.sub(r"[^\w.-]", "_", model_name))
+        os.makedirs(self.dir, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._map_lock = threading.Lock()
+        self._map = None
+        self._map_generation = None
+        self._touch_lock = threading.Lock()
+        self._touched = {}          # key -> when it was last hit
+        self._touched_at = time.time()
+        self._db().executescript(SCHEMA)
+        self._check_dtype(self._db())
+
+    def _db(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.dir, "index.db"),
+                                 timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def _meta(self, db, name, default=None):
+        row = db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def _check_dtype(self, db):
+        # the matrix is raw bytes, so reading it as another dtype would
+        # quietly give garbage
+        stored = self._meta(db, "dtype")
+        if stored is not None and stored != self.dtype.name:
+            raise ValueError("{0} holds {1} vectors, not {2}".format(
+                self.dir, stored, self.dtype.name))
+
+    def _vectors_path(self, generation):
+        return os.path.join(self.dir, "vectors.{0}".format(generation))
+
+    def _writer_lock(self):
+        f = open(os.path.join(self.dir, "lock"), "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _matrix(self, generation, dim, need_rows):
+        """Memory-mapped matrix of the given generation, with at least
+        need_rows rows; remapped when another process has grown it"""
+        with self._map_lock:
+            m = self._map
+            if m is None or self._map_generation != generation or len(m) < need_rows:
+                path = self._vectors_path(generation)
+                rows = os.path.getsize(path) // (dim * self.dtype.itemsize)
+                m = np.memmap(path, dtype=self.dtype, mode="r", shape=(rows, dim))
+                self._map = m
+                self._map_generation = generation
+            return m
+
+    def get_many(self, texts):
+        """
+        Returns:
+            list: a read-only vector view for each text, None on a miss
+        """
+        keys = [content_key(text) for text in texts]
+        for _ in range(3):
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                generation = self._meta(db, "generation")
+                dim = self._meta(db, "dim")
+                rows = {}
+                for i in range(0, len(keys), 500):
+                    part = keys[i:i + 500]
+                    rows.update(db.execute(
+                        "SELECT key, row FROM rows WHERE key IN ({0})".format(
+                            ",".join("?" * len(part))), part))
+            finally:
+                db.execute("COMMIT")
+            if not rows:
+                break
+            try:
+                m = self._matrix(generation, dim, max(rows.values()) + 1)
+                break
+            except FileNotFoundError:
+                # compacted away between reading the index and mapping it
+                continue
+        else:
+            rows = {}
+        result = [m[rows[key]] if key in rows else None for key in keys]
+        found = sum(1 for v in result if v is not None)
+        self.hits += found
+        self.misses += len(keys) - found
+        if rows:
+            self._touch(rows)
+        return result
+
+    def _touch(self, keys):
+        now = time.time()
+        with self._touch_lock:
+            self._touched.update(dict.fromkeys(keys, now))
+            due = (len(self._touched) >= TOUCH_BATCH
+                   or now - self._touched_at >= TOUCH_SECONDS)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the last_used times of recent hits to the index"""
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+            self._touched_at = time.time()
+        if not touched:
+            return
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("UPDATE rows SET last_used = MAX(last_used, ?) WHERE key = ?",
+                           [(when, key) for key, when in touched.items()])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def put_many(self, texts, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            raise ValueError("need one vector per text, got shape {0}".format(vectors.shape))
+        keys = [content_key(text) for text in texts]
+        # before compacting, which keeps the most recently used rows
+        self.flush()
+        with self._writer_lock():
+            db = self._db()
+            generation = self._meta(db, "generation")
+            dim = self._meta(db, "dim")
+            self._check_dtype(db)
+            if generation is None:
+                generation, dim = 0, vectors.shape[1]
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', 0), ('dim', ?)",
+                           (dim,))
+            # caches made before the dtype was recorded get it now
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('dtype', ?)", (self.dtype.name,))
+            if vectors.shape[1] != dim:
+                raise ValueError("cache holds {0}-d vectors, got {1}-d".format(
+                    dim, vectors.shape[1]))
+            path = self._vectors_path(generation)
+            row_bytes = dim * self.dtype.itemsize
+            # append after the last row the index knows of, not at the end
+            # of the file: a writer that died mid-write leaves part of a
+            # row there, which would shift every row after it
+            last = db.execute("SELECT MAX(row) FROM rows").fetchone()[0]
+            first = 0 if last is None else last + 1
+            with open(path, "ab") as f:
+                f.truncate(first * row_bytes)
+                f.write(vectors.tobytes())
+            now = time.time()
+            # one transaction, rather than a commit per row
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT OR IGNORE INTO rows VALUES (?, ?, ?)",
+                               [(key, first + i, now) for i, key in enumerate(keys)])
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            if (first + len(keys)) * row_bytes > self.max_bytes:
+                self._compact(db, generation, dim)
+
+    def _compact(self, db, generation, dim):
+        """Keep the most recently used rows in a new generation. Called
+        with the writer lock held."""
+        row_bytes = dim * self.dtype.itemsize
+        keep = int(self.max_bytes * COMPACT_TO) // row_bytes
+        old = np.memmap(self._vectors_path(generation), dtype=self.dtype, mode="r")
+        old = old.reshape(-1, dim)
+        survivors = db.execute(
+            "SELECT key, row, last_used FROM rows ORDER BY last_used DESC LIMIT ?",
+            (keep,)).fetchall()
+        new_generation = generation + 1
+        tmp = self._vectors_path(new_generation) + ".tmp"
+        with open(tmp, "wb") as f:
+            for i in range(0, len(survivors), 4096):
+                part = [row for _, row, _ in survivors[i:i + 4096]]
+                f.write(np.ascontiguousarray(old[part]).tobytes())
+        os.rename(tmp, self._vectors_path(new_generation))
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM rows")
+            db.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                           [(key, i, last_used)
+                            for i, (key, _, last_used) in enumerate(survivors)])
+            db.execute("UPDATE meta SET value = ? WHERE name = 'generation'",
+                       (new_generation,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        # readers may still have generation-1 mapped, which is fine since
+        # unlinking keeps the data alive for them; older ones are gone
+        stale = self._vectors_path(generation - 1)
+        if os.path.exists(stale):
+            os.remove(stale)
+        logger.info("embedding cache compacted to %d rows (generation %d)",
+                    len(survivors), new_generation)
+
+    def encode(self, texts, encoder):
+        """Embeddings for texts, calling the model only for cache misses
+
+        Args:
+            texts (list): strings to embed
+            encoder (callable): list of strings -> 2-d array, e.g. a
+                SentenceTransformer's encode
+        Returns:
+            ndarray: float32 matrix with one row per text
+        """
+        found = self.get_many(texts)
+        missing = [i for i, v in enumerate(found) if v is None]
+        if missing:
+            # the same text may come up twice in one batch
+            unique = {}
+            for i in missing:
+                unique.setdefault(texts[i], len(unique))
+            fresh = np.asarray(encoder(list(unique)), dtype=np.float32)
+            self.put_many(list(unique), fresh)
+            for i in missing:
+                found[i] = fresh[unique[texts[i]]]
+        if not found:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(found).astype(np.float32, copy=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
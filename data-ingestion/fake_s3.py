@@ -0,0 +1,74 @@
+"""
+A stand-in for S3ArtifactStore that serves archives from a local
+directory, optionally at a limited rate to look like a network:
+
+    store = FakeS3("/tmp/bucket", bytes_per_second=50e6)
+    key, result = artifacts.fetch_and_extract(store, "preprocessor/preprocessor",
+                                              "main", "1234", outdir)
+"""
+
+import os
+import time
+
+from artifacts import ARCHIVE_SUFFIXES, ExtractionError
+
+
+class ThrottledReader(object):
+    def __init__(self, f, bytes_per_second=None):
+        self.f = f
+        self.bytes_per_second = bytes_per_second
+        self.started = time.time()
+        self.sent = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sent += len(data)
+        if self.bytes_per_second:
+            ahead = self.sent / self.bytes_per_second - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeS3(object):
+    def __init__(self, root, bytes_per_second=None):
+        """
+        :param root: directory standing in for the bucket; keys are paths under it
+        :param bytes_per_second: download rate to simulate, None for no limit
+        """
+        self.root = root
+        self.bytes_per_second = bytes_per_second
+
+    def put(self, key, path):
+        """Copy a local file into the bucket"""
+        dest = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(path, "rb") as src, open(dest, "wb") as dst:
+            dst.write(src.read())
+
+    def locate(self, prefix, branch, revision):
+        found = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, self.root)
+                if (key.startswith(prefix) and os.path.basename(branch) in key and
+                        revision in key and key.endswith(ARCHIVE_SUFFIXES)):
+                    found.append((os.path.getmtime(path), key))
+        if not found:
+            raise ExtractionError("no archive of {0} {1} under {2}".format(
+                branch, revision, os.path.join(self.root, prefix)))
+        return max(found)[1]
+
+    def open(self, key):
+        return ThrottledReader(open(os.path.join(self.root, key), "rb"),
+                               self.bytes_per_second)
@@ -1,73 +1,540 @@
+import argparse
+import logging
 import os
+import time
+
 import weaviate
-from sentence_transformers import SentenceTransformer
+from weaviate.exceptions import UnexpectedStatusCodeException
+from weaviate.util import generate_uuid5
+
+from chunker import chunk_source
+from embed_cache import EmbeddingCache
+from manifest import Manifest
+
+logger = logging.getLogger(__name__)
+
+WEAVIATE_URL = os.environ.get("WEAVIATE_URL", "http://localhost:8080")
+# WEAVIATE_URL = "http://weaviate:8080"
+CLASS_NAME = "PythonSource"
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# files read and embedded together, and sentences per forward pass
+FILE_BATCH_SIZE = int(os.environ.get("FILE_BATCH_SIZE", 256))
+ENCODE_BATCH_SIZE = int(os.environ.get("ENCODE_BATCH_SIZE", 64))
+# objects per Weaviate batch request, and how often to retry failures
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 100))
+IMPORT_RETRIES = 3
 
-# Initialize Weaviate client
-client = weaviate.Client("http://localhost:8080")
-# client = weaviate.Client("http://weaviate:8080")
+# HNSW index settings, see https://weaviate.io/developers/weaviate/config-refs/schema/vector-index
+HNSW_EF = int(os.environ.get("HNSW_EF", -1))     # -1 lets Weaviate pick ef per query
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 128))
+HNSW_MAX_CONNECTIONS = int(os.environ.get("HNSW_MAX_CONNECTIONS", 64))
+VECTOR_DISTANCE = os.environ.get("VECTOR_DISTANCE", "cosine")
+MIGRATION_CLASS_NAME = CLASS_NAME + "Migration"
+MIGRATION_PAGE_SIZE = 200
 
-# Check if the 'PythonSource' class already exists, and create it if it doesn't
-if not 'PythonSource' in [class_name['class'] for class_name in client.schema.get()['classes']]:
-    # Define Weaviate schema for storing Python source code and vectors
-    schema = {
-        "classes": [
+
+def class_schema(class_name=CLASS_NAME):
+    """Weaviate schema for storing Python source code. The embedding is
+    the object's own vector, so it goes into the HNSW index."""
+    return {
+        "class": class_name,
+        "description": "A class representing Python source code files along with their vector embeddings",
+        "vectorizer": "none",
+        "vectorIndexType": "hnsw",
+        "vectorIndexConfig": {
+            "ef": HNSW_EF,
+            "efConstruction": HNSW_EF_CONSTRUCTION,
+            "maxConnections": HNSW_MAX_CONNECTIONS,
+            "distance": VECTOR_DISTANCE,
+        },
+        "properties": [
+            {
+                "name": "filename",
+                "dataType": ["string"],
+                "description": "The name of the source code file"
+            },
+            {
+                "name": "code",
+                "dataType": ["text"],
+                "description": "The source code of this chunk of the file"
+            },
+            {
+                "name": "path",
+                "dataType": ["text"],
+                "description": "Absolute path of the source code file"
+            },
+            {
+                "name": "qualname",
+                "dataType": ["text"],
+                "description": "Qualified name of the function or class, or <module>"
+            },
             {
-                "class": "PythonSource",
-                "description": "A class representing Python source code files along with their vector embeddings",
-                "properties": [
-                    {
-                        "name": "filename",
-                        "dataType": ["string"],
-                        "description": "The name of the source code file"
-                    },
-                    {
-                        "name": "code",
-                        "dataType": ["text"],
-                        "description": "The content of the source code file"
-                    },
-                    {
-                        "name": "vector",
-                        "dataType": ["number[]"],
-                        "description": "Vector embedding of the source code"
-                    }
-                ]
+                "name": "start_line",
+                "dataType": ["int"],
+                "description": "First line of the chunk, counting from 1"
+            },
+            {
+                "name": "end_line",
+                "dataType": ["int"],
+                "description": "Last line of the chunk"
+            },
+            {
+                "name": "aliases",
+                "dataType": ["text[]"],
+                "description": "Other places with near-identical code, as path:start_line-end_line"
             }
         ]
     }
-    client.schema.create(schema)
 
-# Load the Sentence Transformer model for generating vectors
-model = SentenceTransformer('all-MiniLM-L6-v2')
 
-def embed_and_store(filepath):
+def connect(url=WEAVIATE_URL):
+    """Initialize Weaviate client, creating the schema if needed"""
+    client = weaviate.Client(url)
+    # Check if the 'PythonSource' class already exists, and create it if it doesn't
+    if not CLASS_NAME in [class_name['class'] for class_name in client.schema.get()['classes']]:
+        client.schema.create_class(class_schema())
+    else:
+        # add properties that are newer than the class
+        existing = [p["name"] for p in client.schema.get(CLASS_NAME)["properties"]]
+        for prop in class_schema()["properties"]:
+            if prop["name"] not in existing:
+                client.schema.property.create(CLASS_NAME, prop)
+    return client
+
+
+# reuse embeddings of text seen before, see embed_cache.py
+EMBED_CACHE_DIR = os.environ.get("EMBED_CACHE_DIR")
+EMBED_CACHE_DTYPE = os.environ.get("EMBED_CACHE_DTYPE", "float32")
+
+_model = None
+_embed_cache = None
+
+
+def get_model():
+    """Load the Sentence Transformer model for generating vectors"""
+    global _model
+    if _model is None:
+        # imported here, since loading torch takes a while and code that
+        # only reads stored vectors doesn't need it
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def get_embed_cache():
+    global _embed_cache
+    if _embed_cache is None and EMBED_CACHE_DIR:
+        _embed_cache = EmbeddingCache(EMBED_CACHE_DIR, MODEL_NAME, dtype=EMBED_CACHE_DTYPE)
+    return _embed_cache
+
+
+def encode(codes, batch_size=ENCODE_BATCH_SIZE):
+    """Embed a list of strings, batch_size sentences per forward pass,
+    skipping the model for anything already in the embedding cache"""
+    cache = get_embed_cache()
+    if cache is None:
+        return get_model().encode(codes, batch_size=batch_size)
+    return cache.encode(codes, lambda texts: get_model().encode(texts, batch_size=batch_size))
+
+
+def iter_source_files(source_dir):
+    for root, _, files in os.walk(source_dir):
+        for file in files:
+            if file.endswith('.py'):
+                yield os.path.join(root, file)
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def object_uuid(filepath, name=""):
+    """Deterministic UUID, so storing a file again replaces its objects
+
+    Args:
+        name (str): tells apart the chunks of one file
+    """
+    return generate_uuid5(os.path.abspath(filepath) + name, CLASS_NAME)
+
+
+def import_objects(client, objects, retries=IMPORT_RETRIES, class_name=CLASS_NAME):
+    """Write objects through Weaviate's batch import
+
+    Objects that come back with errors are sent again, up to `retries`
+    more times. Each one has a fixed UUID so a retry can't duplicate it.
+    Args:
+        objects (dict): UUID -> (data object, vector)
+        class_name (str): where to put them
+    Returns:
+        set: UUIDs of the objects that still failed
+    """
+    pending = objects
+    for attempt in range(retries + 1):
+        failed = []
+
+        def check(results):
+            for result in results or []:
+                errors = result.get("result", {}).get("errors")
+                if errors:
+                    logger.warning("object %s failed: %s", result.get("id"), errors)
+                    failed.append(result.get("id"))
+
+        client.batch.configure(
+            batch_size=IMPORT_BATCH_SIZE,
+            timeout_retries=3,
+            connection_error_retries=3,
+            callback=check
+        )
+        with client.batch as batch:
+            for object_id, (data_object, vector) in pending.items():
+                batch.add_data_object(
+                    data_object=data_object,
+                    class_name=class_name,
+                    uuid=object_id,
+                    vector=vector
+                )
+        if not failed:
+            return set()
+        pending = {object_id: pending[object_id] for object_id in failed
+                   if object_id in pending}
+        if attempt < retries:
+            logger.info("retrying %d failed objects", len(pending))
+            time.sleep(2 ** attempt)
+    return set(pending)
+
+
+def delete_objects(client, uuids):
+    for object_id in uuids:
+        try:
+            client.data_object.delete(uuid=object_id, class_name=CLASS_NAME)
+        except UnexpectedStatusCodeException as e:
+            logger.warning("could not delete %s: %s", object_id, e)
+
+
+def read_source(filepath):
+    """Read a file and split it into the objects to store for it
+
+    Returns:
+        list: (UUID, properties) pairs, one per chunk; the "code"
+            property is what gets embedded
+    """
     with open(filepath, 'r') as file:
         code = file.read()
-    
-    # Generate a vector embedding
-    vector = model.encode(code).tolist()
-
-    # Metadata for the file
-    filename = os.path.basename(filepath)
-    
-    # Create a data object to store in Weaviate
-    data_object = {
-        "filename": filename,
-        "code": code,
-        "vector": vector
-    }
+    path = os.path.abspath(filepath)
+    docs = []
+    seen = {}
+    for chunk in chunk_source(code, os.path.basename(filepath)):
+        # name chunks by qualname rather than line number, so editing
+        # one function doesn't give every chunk after it a new UUID
+        n = seen[chunk.qualname] = seen.get(chunk.qualname, -1) + 1
+        docs.append((object_uuid(filepath, "::{0}#{1}".format(chunk.qualname, n)), {
+            "filename": chunk.filename,
+            "code": chunk.text,
+            "path": path,
+            "qualname": chunk.qualname,
+            "start_line": chunk.start_line,
+            "end_line": chunk.end_line
+        }))
+    return docs
+
+
+def codes_to_embed(docs_by_file):
+    """The "code" of every object, leaving out the duplicates a
+    Deduplicator took out"""
+    return [properties["code"] for _, docs in docs_by_file
+            for _, properties in docs if properties is not None]
+
+
+def store_docs(store, docs_by_file, vectors, updates=None):
+    """Store already embedded objects in one go
+
+    Args:
+        store (VectorStore): where to put them
+        docs_by_file (list): (filepath, read_source(filepath)) pairs, where
+            properties of None stand for an object stored for another chunk
+        vectors (list): one embedding per object with properties, in the
+            same order
+        updates (dict): UUID -> properties to change on objects already
+            stored, from Deduplicator.filter()
+    Returns:
+        dict: filepath -> list of UUIDs stored for it, None if any failed
+    """
+    objects = {}
+    vectors = iter(vectors)
+    for _, docs in docs_by_file:
+        for object_id, properties in docs:
+            if properties is not None:
+                objects[object_id] = (properties, next(vectors))
+    failed = store.upsert(objects)
+    if updates:
+        failed = failed | store.update_properties(updates)
+    return {filepath: None if any(object_id in failed for object_id, _ in docs)
+            else list(dict.fromkeys(object_id for object_id, _ in docs))
+            for filepath, docs in docs_by_file}
+
+
+def embed_and_store_batch(store, filepaths, encode_batch_size=ENCODE_BATCH_SIZE,
+                          dedup=None):
+    """Embed a batch of files with one encode() call and store them
+    with one batch import
+
+    Args:
+        dedup (Deduplicator): embed one of each group of near-identical
+            chunks only
+    Returns:
+        dict: filepath -> list of UUIDs stored for it, None if it failed
+    """
+    docs_by_file = [(filepath, read_source(filepath)) for filepath in filepaths]
+    updates = None
+    if dedup is not None:
+        docs_by_file, updates = dedup.filter(docs_by_file)
+    codes = codes_to_embed(docs_by_file)
+
+    # Generate vector embeddings, batch_size sentences per forward pass
+    vectors = encode(codes, batch_size=encode_batch_size)
+    return store_docs(store, docs_by_file, vectors, updates)
+
+
+def embed_and_store(store, filepath):
+    return embed_and_store_batch(store, [filepath])
+
+
+def ingest(store, filepaths, file_batch_size=FILE_BATCH_SIZE, on_stored=None,
+           dedup=None):
+    """
+    Args:
+        on_stored (callable): called with (filepath, uuids) for each file
+            that was stored
+        dedup (Deduplicator): see embed_and_store_batch()
+    """
+    t0 = time.time()
+    stored = failed = 0
+    for batch in batched(filepaths, file_batch_size):
+        for filepath, uuids in embed_and_store_batch(store, batch, dedup=dedup).items():
+            if uuids is None:
+                failed += 1
+                continue
+            stored += 1
+            if on_stored is not None:
+                on_stored(filepath, uuids)
+        logger.info("%d files stored, %.1f docs/sec",
+                    stored, stored / (time.time() - t0))
+    dt = time.time() - t0
+    logger.info("done: %d stored, %d failed in %.1f seconds (%.1f docs/sec)",
+                stored, failed, dt, stored / dt if dt else 0.0)
+    if get_embed_cache() is not None:
+        get_embed_cache().flush()
+        logger.info("embedding cache: %s", get_embed_cache().stats())
+    if dedup is not None:
+        logger.info("duplicates: %s", dedup.stats())
+    return stored, failed
+
+
+def ingest_incremental(store, source_dir, manifest_path, run=ingest, dedup=None):
+    """Only store new and changed files, and delete objects for files
+    that are gone. Files that fail to store stay out of the manifest, so
+    the next run tries them again.
+
+    Files deduplicated against each other share objects, so when one
+    of them changes or goes, the others are stored again too.
+    Args:
+        run (callable): ingest() or pipeline.run_pipeline()
+        dedup (Deduplicator): passed on to run
+    """
+    manifest = Manifest(manifest_path)
+    changed, unchanged, removed = manifest.diff(iter_source_files(source_dir))
+    sharing = manifest.sharing([filepath for filepath, _ in changed] + removed)
+    changed += [(filepath, dict(manifest.entries[filepath])) for filepath in sharing]
+    logger.info("%d new or changed, %d sharing objects with those, %d unchanged, %d removed",
+                len(changed) - len(sharing), len(sharing), unchanged - len(sharing),
+                len(removed))
+    entries = dict(changed)
+    stale = []
+
+    def on_stored(filepath, uuids):
+        stale.extend(manifest.update(filepath, entries[filepath], uuids))
+
+    try:
+        run(store, [filepath for filepath, _ in changed], on_stored=on_stored, dedup=dedup)
+        for filepath in removed:
+            stale.extend(manifest.remove(filepath))
+        store.delete(manifest.unreferenced(stale))
+    finally:
+        manifest.save()
+
+
+def class_names(client):
+    return [c['class'] for c in client.schema.get()['classes']]
+
+
+def copy_objects(client, src, dst, vector_property=None, rekey=None):
+    """Copy every object of class `src` into class `dst`, keeping UUIDs
+
+    Args:
+        vector_property (str): take the vector from this property of the
+            old objects instead of from their own vector
+        rekey (callable): properties -> UUID to store the object under
+            instead, or None to keep its own
+    Returns:
+        int: number of objects copied
+    """
+    properties = [p["name"] for p in client.schema.get(src)["properties"]]
+    keep = [p for p in properties if p != vector_property]
+    copied = 0
+    cursor = None
+    while True:
+        q = (client.query.get(src, properties)
+             .with_additional(["id", "vector"])
+             .with_limit(MIGRATION_PAGE_SIZE))
+        if cursor is not None:
+            q = q.with_after(cursor)
+        page = q.do()["data"]["Get"][src]
+        if not page:
+            return copied
+        objects = {}
+        for obj in page:
+            vector = obj[vector_property] if vector_property else obj["_additional"]["vector"]
+            properties = {p: obj[p] for p in keep}
+            object_id = (rekey and rekey(properties)) or obj["_additional"]["id"]
+            objects[object_id] = (properties, vector)
+        failed = import_objects(client, objects, class_name=dst)
+        if failed:
+            raise RuntimeError("could not copy {0} objects to {1}".format(len(failed), dst))
+        copied += len(page)
+        cursor = page[-1]["_additional"]["id"]
+        logger.info("copied %d objects from %s to %s", copied, src, dst)
+
+
+def legacy_rekey(source_dir):
+    """For objects stored before UUIDs were deterministic: the UUID
+    ingestion gives the first chunk of the same file under source_dir,
+    so ingesting the file again replaces the object instead of adding
+    to it.
+
+    Old objects only know the file's name, so a file is found by name,
+    and by its code when several files have that name.
+    Returns:
+        callable: properties -> UUID, or None if the file isn't found
+    """
+    by_name = {}
+    for filepath in iter_source_files(source_dir):
+        by_name.setdefault(os.path.basename(filepath), []).append(filepath)
+    found = [0, 0]
+
+    def rekey(properties):
+        candidates = by_name.get(properties.get("filename"), [])
+        for filepath in candidates:
+            try:
+                if len(candidates) > 1:
+                    with open(filepath) as f:
+                        if f.read() != properties.get("code"):
+                            continue
+                docs = read_source(filepath)
+            except (OSError, UnicodeDecodeError):
+                continue
+            if docs:
+                found[0] += 1
+                return docs[0][0]
+        found[1] += 1
+        if found[1] <= 10:
+            logger.warning("%s isn't under %s, keeping its UUID",
+                           properties.get("filename"), source_dir)
+        return None
+
+    rekey.found = found
+    return rekey
+
+
+def migrate_vector_property(client, source_dir=None):
+    """Move embeddings stored in the old `vector` property into object
+    vectors, recreating PythonSource with the HNSW settings above.
+
+    Objects are copied to a temporary class, PythonSource is recreated,
+    and they are copied back. If this is interrupted, running it again
+    picks up from where it stopped.
+    Args:
+        source_dir (str): where the files of the old objects are, to
+            give them the UUIDs ingestion does (see legacy_rekey)
+    """
+    names = class_names(client)
+    if CLASS_NAME not in names and MIGRATION_CLASS_NAME not in names:
+        logger.info("no %s class yet, nothing to migrate", CLASS_NAME)
+        return
+    if CLASS_NAME in names:
+        properties = [p["name"] for p in client.schema.get(CLASS_NAME)["properties"]]
+        if "vector" in properties:
+            if MIGRATION_CLASS_NAME in names:
+                client.schema.delete_class(MIGRATION_CLASS_NAME)
+            client.schema.create_class(class_schema(MIGRATION_CLASS_NAME))
+            rekey = legacy_rekey(source_dir) if source_dir else None
+            copy_objects(client, CLASS_NAME, MIGRATION_CLASS_NAME, vector_property="vector",
+                         rekey=rekey)
+            if rekey is not None:
+                logger.info("%d objects given the UUIDs of their files, %d not found",
+                            *rekey.found)
+            client.schema.delete_class(CLASS_NAME)
+        elif MIGRATION_CLASS_NAME not in names:
+            logger.info("%s has no vector property, nothing to migrate", CLASS_NAME)
+            return
+        else:
+            # interrupted while copying back: start that step over
+            client.schema.delete_class(CLASS_NAME)
+    client.schema.create_class(class_schema())
+    copy_objects(client, MIGRATION_CLASS_NAME, CLASS_NAME)
+    client.schema.delete_class(MIGRATION_CLASS_NAME)
 
-    # Store the data object in Weaviate
-    client.data_object.create(
-        data_object=data_object,
-        class_name="PythonSource"
-    )
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
     # Define the directory containing the Python source files
-    source_dir = '/path/to/source/code'
+    parser.add_argument("source_dir", nargs="?", default='/path/to/source/code')
+    parser.add_argument("--manifest",
+                        help="only re-ingest what changed since the run that wrote this file")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="read, embed and write in parallel stages")
+    parser.add_argument("--local-store", metavar="DIR",
+                        help="write to a local vector index instead of Weaviate")
+    parser.add_argument("--lexical", metavar="FILE",
+                        help="also keep a BM25 index of identifiers in this file")
+    parser.add_argument("--quantize", action="store_true",
+                        help="keep the local index as int8")
+    parser.add_argument("--dedup", action="store_true",
+                        help="embed one of each group of near-identical chunks, "
+                             "listing the others as its aliases")
+    parser.add_argument("--migrate", action="store_true",
+                        help="move embeddings from the old vector property into object vectors")
+    args = parser.parse_args()
 
-    # Iterate over all Python files in the specified directory
-    for root, _, files in os.walk(source_dir):
-        for file in files:
-            if file.endswith('.py'):
-                embed_and_store(os.path.join(root, file))
+    from vector_store import LocalStore, WeaviateStore
+    if args.local_store:
+        store = LocalStore(args.local_store, quantize=args.quantize)
+    else:
+        if args.migrate:
+            migrate_vector_property(weaviate.Client(WEAVIATE_URL), args.source_dir)
+        store = WeaviateStore(connect())
+    if args.lexical:
+        from lexical import LexicalIndex, LexicallyIndexed
+        store = LexicallyIndexed(store, LexicalIndex(args.lexical))
+    dedup = None
+    if args.dedup:
+        from dedup import Deduplicator
+        dedup = Deduplicator()
+    run = ingest
+    if args.pipeline:
+        from pipeline import run_pipeline
+        run = run_pipeline
+    if args.manifest:
+        ingest_incremental(store, args.source_dir, args.manifest, run=run, dedup=dedup)
+    else:
+        # Iterate over all Python files in the specified directory
+        run(store, iter_source_files(args.source_dir), dedup=dedup)
+    store.save()
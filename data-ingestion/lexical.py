@@ -0,0 +1,244 @@
+"""
+BM25 index over the identifiers and words in each stored chunk, and
+search that fuses it with vector search.
+
+Embeddings are poor at exact names: `submit_preflight` or
+`PP_OUTPUT_TARBALL` may not be anywhere near the top of a nearVector
+query. Identifiers are indexed whole and split into their parts, so
+`submit_preflight` matches "submit_preflight", "submit" and "preflight".
+A query that is just an identifier found in the index is answered from
+here alone, without embedding it.
+"""
+
+import json
+import keyword
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+from vector_store import Hit, VectorStore
+
+logger = logging.getLogger(__name__)
+
+K1 = 1.2
+B = 0.75
+# reciprocal rank fusion constant, see Cormack et al. 2009
+RRF_K = 60
+
+_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+_CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+# keep these out of the index, they're in nearly every chunk
+_STOP = set(keyword.kwlist) | {"self", "cls", "none", "true", "false"}
+
+# what's kept per chunk so lexical-only answers can say where it is
+META = ("filename", "path", "qualname", "start_line", "end_line")
+
+
+def tokenize(text):
+    """Identifiers and words, lowercased, each followed by its parts
+
+    >>> tokenize("def submitPreflight(app_path):")
+    ['submitpreflight', 'submit', 'preflight', 'app_path', 'app', 'path']
+    """
+    terms = []
+    for word in _WORD.findall(text):
+        lower = word.lower()
+        if lower in _STOP or len(word) < 2:
+            continue
+        terms.append(lower)
+        parts = [p.lower() for piece in word.split("_") for p in _CAMEL.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(p for p in parts if len(p) > 1 and p not in _STOP)
+    return terms
+
+
+class LexicalIndex:
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str): JSON file to load from and save to
+        """
+        self.path = path
+        self.postings = {}      # term -> {uuid: term frequency}
+        self.lengths = {}       # uuid -> number of terms
+        self.meta = {}          # uuid -> properties in META
+        self.doc_terms = {}     # uuid -> its terms, to remove it without a full scan
+        self.total_length = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.postings = data["postings"]
+            self.lengths = data["lengths"]
+            self.meta = data["meta"]
+            self.total_length = sum(self.lengths.values())
+            # not saved, since it's the postings turned inside out
+            for term, docs in self.postings.items():
+                for object_id in docs:
+                    self.doc_terms.setdefault(object_id, []).append(term)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, object_id, text, properties):
+        """Index one chunk; use update() for chunks that may be indexed"""
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[object_id] = tf
+        self.doc_terms[object_id] = list(counts)
+        n = sum(counts.values())
+        self.lengths[object_id] = n
+        self.total_length += n
+        self.meta[object_id] = {name: properties.get(name) for name in META}
+
+    def update(self, chunks):
+        """Index chunks, replacing any that are already indexed
+
+        Args:
+            chunks (list): (uuid, text, properties) triples
+        """
+        self.remove([object_id for object_id, _, _ in chunks
+                     if object_id in self.lengths])
+        for object_id, text, properties in chunks:
+            self.add(object_id, text, properties)
+
+    def remove(self, uuids):
+        uuids = {object_id for object_id in uuids if object_id in self.lengths}
+        if not uuids:
+            return
+        for object_id in uuids:
+            self.total_length -= self.lengths.pop(object_id)
+            self.meta.pop(object_id, None)
+            for term in self.doc_terms.pop(object_id, ()):
+                docs = self.postings[term]
+                del docs[object_id]
+                if not docs:
+                    del self.postings[term]
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"postings": self.postings, "lengths": self.lengths,
+                       "meta": self.meta}, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def search(self, query, k=10):
+        """
+        Returns:
+            list: (uuid, BM25 score) pairs, best first
+        """
+        if not self.lengths:
+            return []
+        n = len(self.lengths)
+        avg = self.total_length / n
+        scores = Counter()
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for object_id, tf in docs.items():
+                norm = K1 * (1 - B + B * self.lengths[object_id] / avg)
+                scores[object_id] += idf * tf * (K1 + 1) / (tf + norm)
+        return scores.most_common(k)
+
+    def lookup(self, name, k=10):
+        """Chunks mentioning identifier `name`, definitions of it first
+
+        Returns:
+            list: (uuid, score) pairs, or [] if the name isn't indexed
+        """
+        term = name.rsplit(".", 1)[-1].lower()
+        if term not in self.postings:
+            return []
+        hits = self.search(term, k=max(k, 50))
+        defines = [(object_id, score) for object_id, score in hits
+                   if (self.meta[object_id].get("qualname") or "").lower().endswith(term)]
+        others = [hit for hit in hits if hit not in defines]
+        return (defines + others)[:k]
+
+
+class LexicallyIndexed(VectorStore):
+    """A VectorStore that also keeps a LexicalIndex of what it stores"""
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def upsert(self, objects):
+        failed = self.store.upsert(objects)
+        self.index.update([(object_id, properties["code"], properties)
+                           for object_id, (properties, _) in objects.items()
+                           if object_id not in failed])
+        return failed
+
+    def delete(self, uuids):
+        self.store.delete(uuids)
+        self.index.remove(uuids)
+
+    def update_properties(self, updates):
+        # aliases and the like; nothing the lexical index looks at
+        return self.store.update_properties(updates)
+
+    def search(self, vector, k=5):
+        return self.store.search(vector, k)
+
+    def get(self, uuids):
+        return self.store.get(uuids)
+
+    def save(self):
+        self.store.save()
+        self.index.save()
+
+
+def is_identifier(query):
+    return bool(_IDENTIFIER.match(query.strip()))
+
+
+def hybrid_search(query, index, store, encoder, k=5, depth=None):
+    """Fuse BM25 and vector rankings with reciprocal rank fusion
+
+    A query that is a single identifier present in the index is answered
+    from the index alone, and `encoder` isn't called.
+    Args:
+        query (str): what to look for
+        index (LexicalIndex): built while ingesting
+        store (VectorStore): where the vectors and properties are
+        encoder (callable): str -> query vector
+        k (int): number of results
+        depth (int): candidates taken from each ranking, default 4*k
+    Returns:
+        list: Hits, best first, scored by fused rank
+    """
+    depth = depth or 4 * k
+    if is_identifier(query):
+        lexical = index.lookup(query.strip(), k)
+        if lexical:
+            return _resolve(store, [(object_id, score) for object_id, score in lexical], {})
+    lexical = index.search(query, depth)
+    vector_hits = store.search(encoder(query), depth)
+    fused = Counter()
+    for rank, (object_id, _) in enumerate(lexical):
+        fused[object_id] += 1.0 / (RRF_K + rank + 1)
+    for rank, hit in enumerate(vector_hits):
+        fused[hit.uuid] += 1.0 / (RRF_K + rank + 1)
+    known = {hit.uuid: hit.properties for hit in vector_hits}
+    return _resolve(store, fused.most_common(k), known)
+
+
+def _resolve(store, ranked, known):
+    """Turn (uuid, score) pairs into Hits, fetching missing properties
+
+    UUIDs the store no longer has, because the lexical index missed a
+    delete, are left out.
+    """
+    missing = [object_id for object_id, _ in ranked if object_id not in known]
+    if missing:
+        known = dict(known, **store.get(missing))
+    gone = [object_id for object_id, _ in ranked if object_id not in known]
+    if gone:
+        logger.warning("%d lexical hits are not in the store: %s", len(gone), gone)
+    return [Hit(object_id, score, known[object_id]) for object_id, score in ranked
+            if object_id in known]
@@ -0,0 +1,123 @@
+"""
+Record of what has already been ingested, so a re-index only touches
+files that were added, changed or removed since the last run.
+
+The manifest is a JSON file mapping each file's absolute path to its
+size, mtime, content hash and the UUIDs of the objects stored for it.
+"""
+
+import hashlib
+import json
+import os
+
+
+def content_hash(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        # write a new file and rename it over the old one, so a crash
+        # never leaves a half-written manifest behind
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def diff(self, filepaths):
+        """Compare files on disk with the manifest
+
+        A file whose size and mtime haven't changed is taken as unchanged
+        without reading it; otherwise its content hash decides.
+        Args:
+            filepaths (iterable): every file that should be ingested now
+        Returns:
+            tuple: (changed, unchanged, removed) where changed is a list of
+                (path, entry) for new or modified files with the new entry
+                to record once stored, unchanged a count, and removed a
+                list of paths that are in the manifest but gone from disk
+        """
+        changed = []
+        unchanged = 0
+        seen = set()
+        for filepath in filepaths:
+            filepath = os.path.abspath(filepath)
+            seen.add(filepath)
+            st = os.stat(filepath)
+            old = self.entries.get(filepath)
+            if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime_ns:
+                unchanged += 1
+                continue
+            entry = {
+                "size": st.st_size,
+                "mtime": st.st_mtime_ns,
+                "sha256": content_hash(filepath),
+                "uuids": old["uuids"] if old else [],
+            }
+            if old and old["sha256"] == entry["sha256"]:
+                # touched but not modified
+                self.entries[filepath] = entry
+                unchanged += 1
+                continue
+            changed.append((filepath, entry))
+        removed = [p for p in self.entries if p not in seen]
+        return changed, unchanged, removed
+
+    def update(self, filepath, entry, uuids):
+        """Record what was stored for a file
+
+        Returns:
+            list: UUIDs that were stored for the file before but aren't now
+        """
+        stale = [u for u in entry["uuids"] if u not in uuids]
+        self.entries[filepath] = dict(entry, uuids=list(uuids))
+        return stale
+
+    def sharing(self, filepaths):
+        """Files that share stored objects with any of filepaths, directly
+        or through other files, as deduplicated files do
+
+        Returns:
+            list: paths in the manifest, not among filepaths
+        """
+        users = {}
+        for path, entry in self.entries.items():
+            for u in entry["uuids"]:
+                users.setdefault(u, []).append(path)
+        seen = set(filepaths)
+        todo = [p for p in filepaths if p in self.entries]
+        found = []
+        while todo:
+            for u in self.entries[todo.pop()]["uuids"]:
+                for path in users[u]:
+                    if path not in seen:
+                        seen.add(path)
+                        found.append(path)
+                        todo.append(path)
+        return found
+
+    def unreferenced(self, uuids):
+        """
+        Returns:
+            list: those of uuids that no file in the manifest uses
+        """
+        used = {u for entry in self.entries.values() for u in entry["uuids"]}
+        return [u for u in uuids if u not in used]
+
+    def remove(self, filepath):
+        """
+        Returns:
+            list: UUIDs that were stored for the file
+        """
+        return self.entries.pop(filepath)["uuids"]
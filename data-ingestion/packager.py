@@ -0,0 +1,150 @@
+"""
+Pack files into a compressed tar, compressing on several threads.
+
+    result = package(app_path, names, '/tmp/out.tar.gz', level=6)
+    result['manifest']      # name, size and sha256 of every file
+    result['bytes_per_second']
+
+The tar is written as a stream and cut into blocks that are compressed
+at the same time (zlib and zstd let go of the GIL while they work) and
+written out in order:
+
+    gzip    each block is a gzip member of its own; a gzip file may hold
+            several one after another, and gunzip, tar and Python read
+            them as one stream
+    zstd    zstandard's own worker threads, if the zstandard module is
+            installed
+
+The manifest is also written next to the archive, as <archive>.manifest.json.
+"""
+
+import collections
+import json
+import logging
+import os
+import tarfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from artifacts import HashingReader
+
+logger = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+SUFFIXES = {GZIP: '.tar.gz', ZSTD: '.tar.zst'}
+
+FORMAT = os.environ.get('PACKAGE_FORMAT', GZIP)
+LEVEL = int(os.environ.get('PACKAGE_LEVEL', 6))
+WORKERS = int(os.environ.get('PACKAGE_WORKERS', os.cpu_count() or 1))
+BLOCK_SIZE = 1 << 20
+
+
+def _gzip_member(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+class ParallelGzipWriter(object):
+    """File-like object that gzips what is written to it, a block at a
+    time on a pool of threads, into another file"""
+
+    def __init__(self, out, level=LEVEL, workers=WORKERS, block_size=BLOCK_SIZE):
+        self.out = out
+        self.level = level
+        self.block_size = block_size
+        self.bytes_in = 0
+        self._buffer = bytearray()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gzip')
+        self._pending = collections.deque()
+        # enough blocks in flight to keep every thread busy, and no more,
+        # so memory stays bounded however much is written
+        self._max_pending = 2 * workers
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(_gzip_member, block, self.level))
+        while len(self._pending) > self._max_pending:
+            self.out.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._pool is None:
+            return
+        if self._buffer or not self.bytes_in:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self.out.write(self._pending.popleft().result())
+        self._pool.shutdown()
+        self._pool = None
+
+
+def _compressor(fmt, out, level, workers):
+    if fmt == GZIP:
+        return ParallelGzipWriter(out, level, workers)
+    if fmt == ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('the zstd format needs the zstandard module')
+        cctx = zstandard.ZstdCompressor(level=level, threads=workers)
+        return cctx.stream_writer(out, closefd=False)
+    raise ValueError('unknown archive format {0!r}'.format(fmt))
+
+
+def package(root, names, out_path, fmt=FORMAT, level=LEVEL, workers=WORKERS):
+    """Write the files root/name for each of names to a compressed tar
+
+    :param root: the directory names are relative to, and in the archive
+    :param names: relative paths of the files to pack
+    :param out_path: the archive to write
+    :param fmt: GZIP or ZSTD
+    :param level: compression level (1-9 for gzip, 1-22 for zstd)
+    :param workers: threads compressing
+    :returns: dict with the manifest (a list of name, size and sha256),
+        files, bytes (of the files), compressed_bytes (of the archive),
+        seconds and bytes_per_second
+    """
+    t0 = time.time()
+    manifest = []
+    with open(out_path, 'wb') as out:
+        compressor = _compressor(fmt, out, level, workers)
+        try:
+            with tarfile.open(fileobj=compressor, mode='w|') as tar:
+                for name in names:
+                    path = os.path.join(root, name)
+                    info = tar.gettarinfo(path, arcname=name)
+                    if not info.isreg():
+                        tar.addfile(info)
+                        continue
+                    with open(path, 'rb') as f:
+                        reader = HashingReader(f)
+                        tar.addfile(info, reader)
+                    manifest.append({'name': name, 'size': info.size,
+                                     'sha256': reader.sha256.hexdigest()})
+        finally:
+            compressor.close()
+        compressed = out.tell()
+    with open(out_path + '.manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    seconds = time.time() - t0
+    total = sum(entry['size'] for entry in manifest)
+    result = {
+        'manifest': manifest,
+        'files': len(manifest),
+        'bytes': total,
+        'compressed_bytes': compressed,
+        'seconds': seconds,
+        'bytes_per_second': total / seconds if seconds else 0.0,
+    }
+    logger.info('packed {0} files, {1} bytes, into {2} ({3} bytes) at {4:.1f} MB/s'.format(
+        len(manifest), total, out_path, compressed, result['bytes_per_second'] / 1e6))
+    return result
@@ -0,0 +1,294 @@
+"""
+Staged ingestion: each step runs concurrently with the others, connected
+by bounded queues so memory stays flat however big the source tree is.
+
+    walk -> read (process pool) -> embed (one thread, full batches) -> write
+
+The embedding model lives in this process and only ever sees full
+batches; reading files happens in worker processes, and writing to
+the store happens in its own thread while the next batch is encoded.
+The workers are spawned rather than forked: they start while the embed
+thread is loading the model, and a fork then could copy a lock some
+other thread holds.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ingest import (
+    ENCODE_BATCH_SIZE,
+    codes_to_embed,
+    encode,
+    get_embed_cache,
+    read_source,
+    store_docs,
+)
+
+logger = logging.getLogger(__name__)
+
+READ_WORKERS = int(os.environ.get("READ_WORKERS", os.cpu_count() or 1))
+# files per task sent to a read worker, to keep inter-process overhead low
+READ_TASK_SIZE = 32
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))
+
+_DONE = object()
+
+
+class Aborted(Exception):
+    pass
+
+
+class StageStats:
+    """Items handled, time spent working, and how full the input queue
+    was each time the stage went to it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.depth_max = 0
+
+    def sample(self, q):
+        depth = q.qsize()
+        self.depth_samples += 1
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def report(self):
+        elapsed = (self.finished or time.time()) - (self.started or time.time())
+        return {
+            "items": self.items,
+            "items_per_sec": self.items / elapsed if elapsed else 0.0,
+            "busy_fraction": self.busy / elapsed if elapsed else 0.0,
+            "queue_depth_mean": (self.depth_total / self.depth_samples
+                                 if self.depth_samples else 0.0),
+            "queue_depth_max": self.depth_max,
+        }
+
+
+def read_sources(filepaths):
+    """Runs in a read worker"""
+    result = []
+    for filepath in filepaths:
+        try:
+            result.append((filepath, read_source(filepath)))
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning("skipping %s: %s", filepath, e)
+    return result
+
+
+class Pipeline:
+    def __init__(self, store, read_workers=READ_WORKERS,
+                 encode_batch_size=ENCODE_BATCH_SIZE, queue_size=QUEUE_SIZE,
+                 dedup=None):
+        """
+        Args:
+            store (VectorStore): where to write
+            read_workers (int): processes reading files
+            encode_batch_size (int): objects per encode() call
+            queue_size (int): batches allowed to wait between two stages
+            dedup (Deduplicator): leave out near-identical chunks before
+                they are embedded
+        """
+        self.store = store
+        self.dedup = dedup
+        self.read_workers = read_workers
+        self.encode_batch_size = encode_batch_size
+        self.paths = queue.Queue(maxsize=queue_size * READ_TASK_SIZE)
+        self.docs = queue.Queue(maxsize=queue_size * encode_batch_size)
+        self.embedded = queue.Queue(maxsize=queue_size)
+        self.stats = {name: StageStats(name)
+                      for name in ("walk", "read", "embed", "write")}
+        self._abort = threading.Event()
+        self._errors = []
+
+    def _put(self, q, item):
+        while True:
+            if self._abort.is_set():
+                raise Aborted()
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q, stats):
+        stats.sample(q)
+        while True:
+            if self._abort.is_set():
+                raise Aborted()
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+
+    def _stage(self, name, target, *args):
+        def run():
+            stats = self.stats[name]
+            stats.started = time.time()
+            try:
+                target(stats, *args)
+            except Aborted:
+                pass
+            except Exception as e:      # pylint: disable=broad-except
+                logger.exception("%s stage failed", name)
+                self._errors.append(e)
+                self._abort.set()
+            finally:
+                stats.finished = time.time()
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _walk(self, stats, filepaths):
+        for filepath in filepaths:
+            self._put(self.paths, filepath)
+            stats.items += 1
+        self._put(self.paths, _DONE)
+
+    def _read(self, stats):
+        # at most two tasks per worker in flight, so reading can't run
+        # ahead of embedding by more than that
+        in_flight = threading.BoundedSemaphore(2 * self.read_workers)
+        futures = queue.Queue()
+
+        def forward():
+            try:
+                while True:
+                    future = futures.get()
+                    if future is _DONE:
+                        return
+                    t0 = time.time()
+                    for item in future.result():
+                        self._put(self.docs, item)
+                        stats.items += 1
+                    in_flight.release()
+                    stats.busy += time.time() - t0
+            except Aborted:
+                pass
+            except Exception as e:      # pylint: disable=broad-except
+                logger.exception("read worker failed")
+                self._errors.append(e)
+                self._abort.set()
+
+        forwarder = threading.Thread(target=forward, daemon=True)
+        forwarder.start()
+        with ProcessPoolExecutor(self.read_workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            done = False
+            while not done:
+                task = []
+                while len(task) < READ_TASK_SIZE:
+                    filepath = self._get(self.paths, stats)
+                    if filepath is _DONE:
+                        done = True
+                        break
+                    task.append(filepath)
+                if task:
+                    while not in_flight.acquire(timeout=0.5):
+                        if self._abort.is_set():
+                            raise Aborted()
+                    futures.put(pool.submit(read_sources, task))
+            futures.put(_DONE)
+            forwarder.join()
+        self._put(self.docs, _DONE)
+
+    def _embed(self, stats):
+        done = False
+        while not done:
+            batch = []
+            count = 0
+            while count < self.encode_batch_size:
+                item = self._get(self.docs, stats)
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+                count += len(item[1])
+            if not batch:
+                break
+            t0 = time.time()
+            updates = None
+            if self.dedup is not None:
+                batch, updates = self.dedup.filter(batch)
+            codes = codes_to_embed(batch)
+            vectors = encode(codes, batch_size=self.encode_batch_size)
+            stats.busy += time.time() - t0
+            stats.items += len(codes)
+            self._put(self.embedded, (batch, vectors, updates))
+        self._put(self.embedded, _DONE)
+
+    def _write(self, stats, on_stored, counts):
+        while True:
+            item = self._get(self.embedded, stats)
+            if item is _DONE:
+                return
+            batch, vectors, updates = item
+            t0 = time.time()
+            for filepath, uuids in store_docs(self.store, batch, vectors, updates).items():
+                if uuids is None:
+                    counts["failed"] += 1
+                    continue
+                counts["stored"] += 1
+                if on_stored is not None:
+                    on_stored(filepath, uuids)
+            stats.busy += time.time() - t0
+            stats.items += len(vectors)
+
+    def run(self, filepaths, on_stored=None, report_every=30):
+        """Ingest files through all stages
+
+        Args:
+            filepaths (iterable): files to ingest, consumed lazily
+            on_stored (callable): called with (filepath, uuids) for each
+                file that was stored, from the writer thread
+            report_every (float): seconds between progress reports
+        Returns:
+            tuple: (stored, failed) file counts
+        """
+        counts = {"stored": 0, "failed": 0}
+        threads = [
+            self._stage("walk", self._walk, filepaths),
+            self._stage("read", self._read),
+            self._stage("embed", self._embed),
+            self._stage("write", self._write, on_stored, counts),
+        ]
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=report_every)
+                if thread.is_alive():
+                    self.log_report()
+        self.log_report()
+        if get_embed_cache() is not None:
+            get_embed_cache().flush()
+            logger.info("embedding cache: %s", get_embed_cache().stats())
+        if self.dedup is not None:
+            logger.info("duplicates: %s", self.dedup.stats())
+        if self._errors:
+            raise self._errors[0]
+        return counts["stored"], counts["failed"]
+
+    def report(self):
+        return {name: stats.report() for name, stats in self.stats.items()}
+
+    def log_report(self):
+        for name, r in self.report().items():
+            logger.info("%-5s %8d items %8.1f/sec  busy %3.0f%%  "
+                        "input queue mean %.1f max %d",
+                        name, r["items"], r["items_per_sec"],
+                        100 * r["busy_fraction"],
+                        r["queue_depth_mean"], r["queue_depth_max"])
+
+
+def run_pipeline(store, filepaths, on_stored=None, dedup=None, **kwargs):
+    """Same interface as ingest.ingest()"""
+    return Pipeline(store, dedup=dedup, **kwargs).run(filepaths, on_stored=on_stored)
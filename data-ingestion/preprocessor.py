@@ -10,9 +10,24 @@ from worker_python3.static_scanner_qa_utils.utils import (
     fetch_env_var,
 )
 
+from artifacts import ARCHIVE_SUFFIXES, S3ArtifactStore, extract_file, stream_and_extract
+from build_cache import BuildCache
+import packager
+import snapshot
+
+import fnmatch
+import itertools
 import logging
 import os
 import pprint
+import resource
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
 
@@ -21,9 +36,34 @@ long_ago = datetime(2000, 1, 1, 0, 0, 0, 0)   # don't allow start_time = None
 
 HOME_LINUX = '/home/ec2-user' if os.path.exists('/home/ec2-user') else '/work'
 
+PREFLIGHT_PARALLELISM = int(os.environ.get('PREFLIGHT_PARALLELISM', 2))
+PREFLIGHT_TIMEOUT = float(os.environ['PREFLIGHT_TIMEOUT']) if os.environ.get('PREFLIGHT_TIMEOUT') else None
+# where to snapshot the app binary during a preflight, by default next to
+# the app binary root, so the preprocessor doesn't find it there
+PREFLIGHT_SNAPSHOT_DIR = os.environ.get('PREFLIGHT_SNAPSHOT_DIR')
+
 
 class Preprocessor(object):
-    def __init__(self, branch, revision, store_dir, store_name, extra_preprocessor_args):
+    def __init__(self, branch, revision, store_dir, store_name, extra_preprocessor_args,
+                 artifact_store=None, keep_archive=False, build_cache=None):
+        """
+        :param artifact_store: where to stream the build from (see artifacts.py);
+            by default S3ArtifactStore of $PREPROCESSOR_BUCKET if that's set,
+            otherwise the build is downloaded with s3_bucket() and then extracted
+        :param keep_archive: with an artifact store, also save the archive as store_name
+        :param build_cache: BuildCache to deploy from instead of extracting
+            into store_dir; by default one in $PREPROCESSOR_CACHE_DIR if
+            that's set
+        """
+        if artifact_store is None and os.environ.get('PREPROCESSOR_BUCKET'):
+            artifact_store = S3ArtifactStore(os.environ['PREPROCESSOR_BUCKET'])
+        if build_cache is None and os.environ.get('PREPROCESSOR_CACHE_DIR'):
+            build_cache = BuildCache(os.environ['PREPROCESSOR_CACHE_DIR'])
+        self.artifact_store = artifact_store
+        self.keep_archive = keep_archive
+        self.build_cache = build_cache
+        self._lease = None
+        self._preproc_path = None
         self._branch = branch
         self._revision = revision
         self._store_dir = os.path.abspath(store_dir)
@@ -34,7 +74,8 @@ class Preprocessor(object):
             if extra_preprocessor_args[0] == extra_preprocessor_args[-1] == '"':
                 extra_preprocessor_args = extra_preprocessor_args[1:-1]
             extra_preprocessor_args = extra_preprocessor_args.replace('\\"', '"')
-        self._extra_preprocessor_args = extra_preprocessor_args.strip().split() if extra_preprocessor_args else []
+        # quoted as for a shell, which is what they used to go through
+        self._extra_preprocessor_args = shlex.split(extra_preprocessor_args) if extra_preprocessor_args else []
 
     @property
     def extra_preprocessor_args(self):
@@ -45,49 +86,73 @@ class Preprocessor(object):
     def store_dir(self):
         return self._store_dir
 
+    @property
+    def build_dir(self):
+        """:returns: where the extracted build is, in the build cache or store_dir"""
+        return self._lease.path if self._lease is not None else self._store_dir
+
     @property
     def store_name(self):
         return self._store_name
 
     def fetch_and_extract_build(self, branch, revision, outname, outdir,
                                 is_scs=False):
-        logger.info('saving preprocessor build {0} from S3 bucket to {1}'.format(revision, outname))
+        """Download the preprocessor build and extract it into outdir
+
+        With an artifact store the archive is extracted as it downloads
+        and never saved, unless keep_archive is set. Otherwise s3_bucket()
+        downloads it to outname first.
+        :returns: dict with the archive's sha256, bytes and bytes_per_second
+        :raises ExtractionError: if the archive can't be extracted
+        """
         assert not is_scs, 'SCS not yet implemented here'     # TODO
 
         prefix = "preprocessor/preprocessor"
         assert os.path.isdir(outdir)
         outname = os.path.realpath(os.path.join(os.getcwd(), outname))
-        found = s3_bucket(prefix, branch, revision, download=outname)
-        if found.endswith(".tar.gz") and not outname.endswith(".tar.gz"):
-            assert not outname.endswith(".zip"), (found, outname)
-            outname += ".tar.gz"
-        if found.endswith(".zip") and not outname.endswith(".zip"):
-            assert not outname.endswith(".tar.gz"), (found, outname)
-            outname += ".zip"
-        assert os.path.isfile(outname), outname
-        self._store_name = outname
-        logger.info('extracting %s to %s', outname, outdir)
-        if outname.endswith("zip"):
-            os.system('(cd {0}; unzip {1} >/dev/null)'.format(outdir, outname))
-        elif outname.endswith("tar.gz"):
-            os.system('(cd {0}; tar xfz {1})'.format(outdir, outname))
+        store = self.artifact_store
+        if store is not None:
+            key = store.locate(prefix, branch, revision)
+            keep = None
+            if self.keep_archive:
+                keep = outname
+                if not outname.endswith(ARCHIVE_SUFFIXES):
+                    keep += '.zip' if key.endswith('.zip') else '.tar.gz'
+            logger.info('streaming preprocessor build {0} from {1} to {2}'.format(key, store, outdir))
+            stream = store.open(key)
+            try:
+                result = stream_and_extract(stream, key, outdir, keep_archive=keep)
+            finally:
+                stream.close()
+            self._store_name = keep or key
         else:
-            logging.warning("Cannot figure how to extract {0}".format(outname))
+            logger.info('saving preprocessor build {0} from S3 bucket to {1}'.format(revision, outname))
+            found = s3_bucket(prefix, branch, revision, download=outname)
+            if found.endswith(".tar.gz") and not outname.endswith(".tar.gz"):
+                assert not outname.endswith(".zip"), (found, outname)
+                outname += ".tar.gz"
+            if found.endswith(".zip") and not outname.endswith(".zip"):
+                assert not outname.endswith(".tar.gz"), (found, outname)
+                outname += ".zip"
+            assert os.path.isfile(outname), outname
+            self._store_name = outname
+            logger.info('extracting %s to %s', outname, outdir)
+            result = extract_file(outname, outdir)
         # what's the correct name for the log4j.xml file? nobody knows
-        cmd = ("cp /work/preflight_log4j.xml " + outdir +
-               "/preprocessor/preflight_log4j.xml")
-        r = os.system(cmd)
-        logger.debug("Exit status of {0} is {1}".format(cmd, r))
-        cmd = ("cp /work/preflight_log4j.xml " + outdir +
-               "/preprocessor/preflight_log4j2.xml")
-        r = os.system(cmd)
-        logger.debug("Exit status of {0} is {1}".format(cmd, r))
+        log4j = '/work/preflight_log4j.xml'
+        if os.path.isfile(log4j):
+            for name in ('preflight_log4j.xml', 'preflight_log4j2.xml'):
+                _install_file(log4j, os.path.join(outdir, 'preprocessor', name))
+        else:
+            logger.warning('{0} not found, the preprocessor logs as it pleases'.format(log4j))
+        return result
 
     def fetch_and_extract_preprocessor(self):
         # pylint: disable=no-member
         assert isinstance(self, Preprocessor)
         self.fetch_and_extract_build(self._branch, self._revision, self._store_name, self._store_dir)
-        assert os.path.isfile(self._store_name), self._store_name
+        if self.artifact_store is None or self.keep_archive:
+            assert os.path.isfile(self._store_name), self._store_name
         assert os.path.isdir(self._store_dir), self._store_dir
         files = os.listdir(self._store_dir)
         assert len(files) > 0
@@ -115,20 +180,36 @@ class Preprocessor(object):
         return self._revision
 
     def deploy_preprocessor(self):
+        """Fetch and extract the build, or with a build cache, lease it
+        from there and only fetch it if no job on this host has yet
+
+        Call release_preprocessor() when done with it.
         """
-        :return:
-        """
-        self.fetch_and_extract_preprocessor()
+        if self.build_cache is None:
+            self.fetch_and_extract_preprocessor()
+            return
+        if self._lease is not None:
+            return
+
+        def install(outdir):
+            self.fetch_and_extract_build(self._branch, self._revision, self._store_name, outdir)
+
+        self._lease = self.build_cache.acquire(self._branch, self._revision, install,
+                                               locate=_find_preproc_path)
+        self._preproc_path = self._lease.located
+
+    def release_preprocessor(self):
+        """Let the build cache evict this build once no other job uses it"""
+        if self._lease is not None:
+            self._lease.release()
+            self._lease = None
+            self._preproc_path = None
 
     def get_preproc_path(self, is_scs=False):
         """ Return path to 'Preprocessor' folder """
-        # pylint: disable=maybe-no-member
-        p = "/lib/preprocessor.jar"
-        preproc_jar = find_file(p, self._store_dir)
-        r = preproc_jar.replace(p, "")
-        assert os.path.isdir(r), r
-        return r
-        # pylint: enable=maybe-no-member
+        if self._preproc_path is None:
+            self._preproc_path = _find_preproc_path(self.build_dir)
+        return self._preproc_path
 
     def get_preflight_paths(self, request_info, preproc_path):
         """
@@ -147,17 +228,32 @@ class Preprocessor(object):
         if os.path.exists(php_folder_path):
             os.system("chmod -R 755 %s" % php_folder_path)
 
-        java_bin_path = find_java(self.store_dir)
+        java_bin_path = find_java(self.build_dir)
         assert os.path.exists(java_bin_path), "Java bin path '%s' does not exist!" % java_bin_path
 
         return (binary_eh_path, compile_xml_path, java_bin_path)
 
-    def submit_preflight(self, request_info):
-        """ Run preprocessor directly, without enginehost (STATICQA-6179) """
+    def submit_preflight(self, request_info, timeout=None, usage=None):
+        """ Run preprocessor directly, without enginehost (STATICQA-6179)
+
+        The preprocessor runs as a child process with its own working
+        directory and PATH, so several preflights can run at once in one
+        worker.
+        :param request_info: PreprocessorRequest object
+        :param timeout: seconds to let the preprocessor run, None for no limit
+        :param usage: dict to fill in with the peak RSS, in KB, of the
+            preprocessor (preprocessor_max_rss_kb) and of this worker
+            process so far (worker_max_rss_kb), how the app binary was
+            snapshotted, and how fast the outputs were packed
+        :returns: the job status, 'Finished', 'Failed' or 'TimedOut'
+        """
+        if usage is None:
+            usage = {}
         assert request_info['app_ver_binary_root'] is not None
         assert os.path.isdir(request_info['app_ver_binary_root']), request_info['app_ver_binary_root']
         assert isinstance(request_info['app_ver_main_binary_files'], list), request_info['app_ver_main_binary_files']
         assert request_info['env_dir'], request_info['env_dir']
+        self._job_status = 'Running'
         # get and update paths
         logger.info("app_ver_binary_root = {0}".format(request_info['app_ver_binary_root']))
         logger.info("app_ver_main_binary_files = {0}".format(request_info['app_ver_main_binary_files']))
@@ -165,73 +261,259 @@ class Preprocessor(object):
         is_scs = ('scs_test_worker' in self.store_dir.lower() or
                   'scs_test_worker' in request_info['app_ver_binary_root'].lower())
         PREPROC_PATH = self.get_preproc_path(is_scs)
-        init_dir = os.getcwd()
-        os.chdir(PREPROC_PATH)
-        os.system('chmod 755 PreflightPreprocessor.sh')
+        script = os.path.join(PREPROC_PATH, 'PreflightPreprocessor.sh')
+        os.chmod(script, 0o755)
         binary_eh_path, compile_xml_path, java_bin_path = self.get_preflight_paths(request_info, PREPROC_PATH)
 
         # copy preflight_log4j.xml to where preprocessor expects it to be
-        os.system('mkdir -p dist/conf')  # Preprocessor expects ...log4j.xml to be here
-        os.system('cp preflight_log4j.xml dist/conf/')
+        conf_dir = os.path.join(PREPROC_PATH, 'dist', 'conf')
+        _install_file(os.path.join(PREPROC_PATH, 'preflight_log4j.xml'),
+                      os.path.join(conf_dir, 'preflight_log4j.xml'))
 
         # set up preproc command
         assert request_info['env_dir'] is not None, request_info
-        preproc_cmd = (
-            './PreflightPreprocessor.sh ' +
-            ' --app_binary_root ' + binary_eh_path +
-            ' --output_file_path ' + compile_xml_path +
-            ' --environments_path ' + request_info['env_dir']
-            + " " + (" ".join(self.extra_preprocessor_args) if isinstance(self.extra_preprocessor_args, (list, tuple))
-   else self.extra_preprocessor_args)
-        )
-        if not logger.isEnabledFor(logging.DEBUG):
-            preproc_cmd += " > /dev/null 2>&1"
-        # check to see if /tmp is mounted with "noexec"
-        cmd = 'mount | grep " /tmp" | grep noexec'
-        r = os.system(cmd)
-        if r == 0:
-            logger.error("/tmp directory was mounted with 'noexec' option, REMOUNT IT")
-            # zero exit status means it is mounted with noexec and that's a problem
-            os.system("sudo mount /tmp -o remount,exec")
+        extra_args = self.extra_preprocessor_args
+        if not isinstance(extra_args, (list, tuple)):
+            extra_args = shlex.split(extra_args)
+        preproc_cmd = [
+            script,
+            '--app_binary_root', binary_eh_path,
+            '--output_file_path', compile_xml_path,
+            '--environments_path', request_info['env_dir'],
+        ] + list(extra_args)
+        _check_tmp_exec()
 
         # Update preproc to use correct JDK, e.g. .../preprocessor/Preprocessor/Java/bin/java
         # Add the java_bin_path First so the correct java is found there
-        initial_env_path = os.environ['PATH']
-        os.environ['PATH'] = java_bin_path + os.pathsep + initial_env_path
+        env = dict(os.environ)
+        env['PATH'] = java_bin_path + os.pathsep + env.get('PATH', '')
+
+        # run preflight preprocessor to generate veracodegen.war files;
+        # the app binary is put back afterwards if it's gone, from a
+        # snapshot rather than a copy in memory
+        snap = None
+        if self._app_path and os.path.isfile(self._app_path):
+            snap = snapshot.take(self._app_path, PREFLIGHT_SNAPSHOT_DIR or os.path.dirname(
+                os.path.abspath(request_info['app_ver_binary_root'])))
+            usage['snapshot'] = snap.method
+
+        show_cmdline(' '.join(shlex.quote(arg) for arg in preproc_cmd),
+                     src=self, app_path=self._app_path)
+        quiet = not logger.isEnabledFor(logging.DEBUG)
         try:
-            # run preflight preprocessor to generate veracodegen.war files
-            R = None
-            if os.path.isfile(self._app_path):
-                inf = open(self._app_path, "rb")
-                R = inf.read()
-                inf.close()
-
-            show_cmdline(preproc_cmd, src=self, app_path=self._app_path)
-            retcode = os.system(preproc_cmd)
-            if retcode != 0:
-                logger.error('\n\n\n * * * PREPROCESSOR FAILED * * *\n\n\n')
-                self._job_status = 'Failed'
+            retcode, rusage = _run(preproc_cmd, cwd=PREPROC_PATH, env=env, timeout=timeout,
+                                   output=subprocess.DEVNULL if quiet else None)
+        except subprocess.TimeoutExpired:
+            logger.error('\n\n\n * * * PREPROCESSOR TIMED OUT after {0}s * * *\n\n\n'.format(timeout))
+            self._job_status = 'TimedOut'
+            return self._job_status
+        finally:
+            if snap is not None:
+                snap.restore()
+            usage['worker_max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['preprocessor_max_rss_kb'] = rusage.ru_maxrss
+        logger.info('preprocessor peak RSS {0} KB, worker peak RSS {1} KB'.format(
+            usage['preprocessor_max_rss_kb'], usage['worker_max_rss_kb']))
+        if retcode != 0:
+            logger.error('\n\n\n * * * PREPROCESSOR FAILED * * *\n\n\n')
+            self._job_status = 'Failed'
+            return self._job_status
+        pp_out_files = fetch_env_var('PP_OUTPUT_TARBALL')
+        if pp_out_files and self._app_path:
+            files = sorted(
+                os.path.relpath(os.path.join(root, name), self._app_path)
+                for root, _, names in os.walk(self._app_path)
+                for name in fnmatch.filter(names, pp_out_files)
+            )
+            logger.debug(files)
+            if files:
+                tarballname = '/tmp/pp_output_files_{0}{1}'.format(
+                    time.time(), packager.SUFFIXES[packager.FORMAT])
+                logger.info('writing {0} to {1}'.format(files, tarballname))
+                packed = packager.package(self._app_path, files, tarballname)
+                usage['output_bytes_per_second'] = packed['bytes_per_second']
+        self._job_status = 'Finished'
+        return self._job_status
+
+
+def _find_preproc_path(build_dir):
+    """:returns: the folder in build_dir with lib/preprocessor.jar"""
+    # pylint: disable=maybe-no-member
+    p = "/lib/preprocessor.jar"
+    preproc_jar = find_file(p, build_dir)
+    r = preproc_jar.replace(p, "")
+    assert os.path.isdir(r), r
+    return r
+    # pylint: enable=maybe-no-member
+
+
+def _install_file(src, dst):
+    """Copy src to dst so that a preprocessor reading dst never sees
+    half a file, even with another job copying it at the same time"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '{0}.{1}.{2}.tmp'.format(dst, os.getpid(), threading.get_ident())
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+_tmp_checked = threading.Lock()
+_tmp_exec_ok = False
+
+
+def _check_tmp_exec():
+    """The preprocessor unpacks and runs things in /tmp, so /tmp can't be
+    mounted with "noexec". Checked once per process."""
+    global _tmp_exec_ok
+    with _tmp_checked:
+        if _tmp_exec_ok:
+            return
+        with open('/proc/mounts') as f:
+            noexec = any(fields[1] == '/tmp' and 'noexec' in fields[3].split(',')
+                         for fields in (line.split() for line in f) if len(fields) > 3)
+        if noexec:
+            logger.error("/tmp directory was mounted with 'noexec' option, REMOUNT IT")
+            if subprocess.run(['sudo', 'mount', '/tmp', '-o', 'remount,exec']).returncode != 0:
+                # look again next time, someone may have fixed it
+                logger.error("could not remount /tmp with 'exec'")
                 return
-            if R and not os.path.isfile(self._app_path):
-                open(self._app_path, "wb").write(R)
-            pp_out_files = fetch_env_var('PP_OUTPUT_TARBALL')
-            if pp_out_files:
-                cmd = "(cd {0}; find . -type f -name {1}".format(self._app_path, pp_out_files)
-                logger.debug(cmd)
-                files = [f.strip() for f in os.popen(cmd)]
-                logger.debug(files)
-                if files:
-                    tarballname = '/tmp/pp_output_files_{0}.tar.gz'.format(time.time())
-                    cmd = '(cd {0}; tar cfz {1} {2})'.format(
-                        self._app_path, tarballname, " ".join(files)
-                    )
-                    logger.info(cmd)
-                    os.system(cmd)
-            self._job_status = 'Finished'
+        _tmp_exec_ok = True
+
+
+def _run(cmd, cwd, env, timeout=None, output=None):
+    """Run cmd in its own process group, so that on a timeout the JVM the
+    preprocessor script starts is killed along with the script
+
+    :returns: the exit status, and the resource usage of cmd and the
+        children it waited for, such as the JVM
+    :raises subprocess.TimeoutExpired: after killing everything
+    """
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=output, stderr=output,
+                            start_new_session=True)
+    try:
+        return _wait(proc, timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        raise
+
+
+def _wait(proc, timeout=None):
+    """Popen.wait(), but with wait4() so the child's rusage isn't lost
+
+    :returns: the exit status and the resource usage
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return proc.returncode, rusage
+        if deadline is not None and time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+class PreflightJob(object):
+    """One preflight in a PreprocessorQueue, and how it's going"""
+
+    def __init__(self, job_id, preprocessor, request_info, timeout):
+        self.job_id = job_id
+        self.preprocessor = preprocessor
+        self.request_info = request_info
+        self.timeout = timeout
+        self.status = 'Queued'
+        self.error = None
+        self.submitted = datetime.now()
+        self.started = long_ago
+        self.finished = long_ago
+        self.future = None
+        self.usage = {}
+
+    def run(self):
+        self.status = 'Running'
+        self.started = datetime.now()
+        try:
+            self.status = self.preprocessor.submit_preflight(self.request_info, timeout=self.timeout,
+                                                             usage=self.usage)
+        except Exception as e:
+            logger.exception('preflight job {0} failed'.format(self.job_id))
+            self.error = e
+            self.status = 'Failed'
         finally:
-            os.environ['PATH'] = initial_env_path
-        os.chdir(init_dir)
+            self.finished = datetime.now()
+        return self.status
+
+    def as_dict(self):
+        return {
+            'job_id': self.job_id,
+            'branch': self.preprocessor.branch,
+            'revision': self.preprocessor.revision,
+            'status': self.status,
+            'error': None if self.error is None else repr(self.error),
+            'submitted': self.submitted.isoformat(),
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat(),
+            'usage': dict(self.usage),
+        }
 
 
 class PreprocessorQueue(JobQueue):
-    pass
+    """Runs preflights on a pool of worker threads, so one host can
+    preprocess several app builds at once"""
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param parallelism: preflights allowed to run at once
+        :param timeout: default seconds each preflight may run, None for no limit
+        """
+        parallelism = kwargs.pop('parallelism', PREFLIGHT_PARALLELISM)
+        self._timeout = kwargs.pop('timeout', PREFLIGHT_TIMEOUT)
+        super(PreprocessorQueue, self).__init__(*args, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=parallelism,
+                                            thread_name_prefix='preflight')
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._next_id = itertools.count(1)
+
+    def submit_preflight(self, preprocessor, request_info, timeout=None):
+        """
+        :param preprocessor: a deployed Preprocessor
+        :param request_info: PreprocessorRequest object
+        :param timeout: seconds this preflight may run, instead of the queue's default
+        :returns: job id, for job_status() and wait()
+        """
+        job = PreflightJob(next(self._next_id), preprocessor, request_info,
+                           self._timeout if timeout is None else timeout)
+        with self._jobs_lock:
+            self._jobs[job.job_id] = job
+        job.future = self._executor.submit(job.run)
+        logger.info('queued preflight job {0} for {1} {2}'.format(
+            job.job_id, preprocessor.branch, preprocessor.revision))
+        return job.job_id
+
+    def job_status(self, job_id):
+        """:returns: 'Queued', 'Running', 'Finished', 'Failed' or 'TimedOut'"""
+        with self._jobs_lock:
+            return self._jobs[job_id].status
+
+    def jobs(self):
+        """:returns: a dict describing each job, in the order submitted"""
+        with self._jobs_lock:
+            return [self._jobs[job_id].as_dict() for job_id in sorted(self._jobs)]
+
+    def wait(self, job_ids=None, timeout=None):
+        """Wait for jobs to finish
+
+        :param job_ids: the jobs to wait for, all of them by default
+        :param timeout: seconds to wait at most
+        :returns: dict of job id to status
+        """
+        with self._jobs_lock:
+            jobs = [self._jobs[j] for j in (job_ids or sorted(self._jobs))]
+        futures.wait([job.future for job in jobs], timeout=timeout)
+        return {job.job_id: job.status for job in jobs}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
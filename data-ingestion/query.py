@@ -0,0 +1,49 @@
+"""
+Nearest-neighbour retrieval over what ingest.py stored:
+
+    python query.py "how are environment variables parsed" [k]
+    python query.py --local-store DIR "how are environment variables parsed" [k]
+    python query.py --lexical FILE submit_preflight
+"""
+
+import argparse
+import json
+
+from ingest import connect, encode
+from lexical import LexicalIndex, hybrid_search
+from vector_store import LocalStore, WeaviateStore
+
+
+def near_vector(client, vector, k=5):
+    """Top-k objects closest to `vector`, using Weaviate's HNSW index
+
+    Returns:
+        list: Hits, best first
+    """
+    return WeaviateStore(client).search(vector, k)
+
+
+def search(store, text, k=5):
+    """Embed `text` with the ingestion model and return its top-k neighbours"""
+    return store.search(encode([text])[0], k)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("text")
+    parser.add_argument("k", nargs="?", type=int, default=5)
+    parser.add_argument("--local-store", metavar="DIR")
+    parser.add_argument("--lexical", metavar="FILE",
+                        help="fuse with the BM25 index ingest.py --lexical wrote")
+    args = parser.parse_args()
+    store = LocalStore(args.local_store) if args.local_store else WeaviateStore(connect())
+    if args.lexical:
+        hits = hybrid_search(args.text, LexicalIndex(args.lexical), store,
+                             lambda text: encode([text])[0], args.k)
+    else:
+        hits = search(store, args.text, args.k)
+    for hit in hits:
+        print(json.dumps({"path": hit.properties["path"],
+                          "qualname": hit.properties["qualname"],
+                          "lines": [hit.properties["start_line"], hit.properties["end_line"]],
+                          "score": hit.score}))
@@ -0,0 +1,130 @@
+"""
+Keep a file safe from being deleted while something runs, without
+reading it into memory.
+
+    snap = take(path, directory)
+    try:
+        run_something()
+    finally:
+        snap.restore()      # puts path back if it's gone, else drops the copy
+
+The snapshot is made the cheapest way the filesystem allows:
+
+    reflink     a copy-on-write clone (btrfs, XFS, ...), instant and
+                independent of the original
+    hardlink    another name for the same inode, instant, but it shares
+                the original's contents, so it only protects against the
+                file being deleted or replaced, not edited in place
+    copy        a streamed copy, in constant memory however big the file
+
+Clones and links only work within one filesystem; when directory is on
+another one, or not writable, the snapshot is a copy in the temporary
+directory instead.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+METHODS = (REFLINK, HARDLINK, COPY)
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as s, open(dst, 'xb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _copy(src, dst):
+    # copyfile uses sendfile() where it can, otherwise a small buffer
+    shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+_MAKERS = {REFLINK: _reflink, HARDLINK: os.link, COPY: _copy}
+
+
+class Snapshot(object):
+    def __init__(self, path, copy, method):
+        self.path = path
+        self.copy = copy
+        self.method = method
+
+    def restore(self):
+        """Put the file back if it has gone, then drop the snapshot
+
+        :returns: True if the file had to be put back
+        """
+        if self.copy is None:
+            return False
+        restored = not os.path.isfile(self.path)
+        if restored:
+            logger.warning('{0} disappeared, restoring it from its snapshot'.format(self.path))
+            # same filesystem as the file's directory, unless the copy
+            # had to go to the temporary directory
+            try:
+                os.replace(self.copy, self.path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                _copy(self.copy, self.path)
+        self.discard()
+        return restored
+
+    def discard(self):
+        if self.copy is not None:
+            try:
+                os.unlink(self.copy)
+            except FileNotFoundError:
+                pass
+            self.copy = None
+
+    def __repr__(self):
+        return 'Snapshot({0!r}, {1!r}, {2!r})'.format(self.path, self.copy, self.method)
+
+
+def take(path, directory=None, methods=METHODS):
+    """Snapshot a file
+
+    :param path: the file
+    :param directory: where to keep the snapshot; the file's own directory
+        by default. Same filesystem as the file for a reflink or hardlink.
+    :param methods: the ways to try, in order
+    :returns: Snapshot
+    """
+    directory = directory or os.path.dirname(os.path.abspath(path))
+    name = '.{0}.snapshot.{1}.{2}'.format(os.path.basename(path), os.getpid(),
+                                          threading.get_ident())
+    for method in methods:
+        copy = os.path.join(directory, name)
+        try:
+            _MAKERS[method](path, copy)
+        except OSError as e:
+            if method != COPY:
+                logger.debug('no {0} of {1}: {2}'.format(method, path, e))
+                continue
+            # directory isn't writable or is full; try the temp directory
+            if os.path.exists(copy):
+                os.unlink(copy)
+            fd, copy = tempfile.mkstemp(prefix=name)
+            os.close(fd)
+            _copy(path, copy)
+        logger.info('snapshot of {0} is a {1}'.format(path, method))
+        return Snapshot(path, copy, method)
+    raise ValueError('no way to snapshot {0} among {1}'.format(path, methods))
@@ -0,0 +1,164 @@
+import hashlib
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+import pytest
+
+from artifacts import ExtractionError, extract_file, fetch_and_extract
+from fake_s3 import FakeS3
+
+PREFIX = "preprocessor/preprocessor"
+
+
+def make_files(count=400):
+    """Two files in each of `count` directories"""
+    return {"preprocessor/d%03d/f%d.txt" % (i // 2, i): ("file %d\n" % i).encode() * (i + 1)
+            for i in range(2 * count)}
+
+
+def make_tgz(path, files):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def make_zip(path, files):
+    # writestr() adds no entries for the directories
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+
+
+def sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def check_extracted(outdir, files):
+    for name, data in files.items():
+        with open(os.path.join(outdir, name), "rb") as f:
+            assert f.read() == data, name
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FakeS3(str(tmp_path / "bucket"))
+
+
+@pytest.mark.parametrize("suffix,make", [(".tar.gz", make_tgz), (".zip", make_zip)])
+def test_stream_and_extract(tmp_path, store, suffix, make):
+    files = make_files(50)
+    archive = str(tmp_path / ("build" + suffix))
+    make(archive, files)
+    store.put(PREFIX + "/main/1234/preprocessor-1234" + suffix, archive)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    key, result = fetch_and_extract(store, PREFIX, "main", "1234", str(outdir),
+                                    expected_sha256=sha256(archive))
+    assert key.endswith(suffix)
+    assert result["sha256"] == sha256(archive)
+    assert result["bytes"] == os.path.getsize(archive)
+    assert result["members"] == len(files)
+    check_extracted(str(outdir), files)
+
+
+@pytest.mark.parametrize("suffix,make", [(".tar.gz", make_tgz), (".zip", make_zip)])
+def test_extract_file(tmp_path, suffix, make):
+    files = make_files(50)
+    archive = str(tmp_path / ("build" + suffix))
+    make(archive, files)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    result = extract_file(archive, str(outdir), expected_sha256=sha256(archive))
+    assert result["sha256"] == sha256(archive)
+    assert result["bytes"] == os.path.getsize(archive)
+    assert result["members"] == len(files)
+    check_extracted(str(outdir), files)
+    # extracted in place, no copy of the archive made next to the files
+    assert os.listdir(str(outdir)) == ["preprocessor"]
+
+
+def test_zip_without_directory_entries(tmp_path, store, monkeypatch):
+    real_makedirs = os.makedirs
+
+    def slow_makedirs(name, *args, **kwargs):
+        # widen the window between zipfile checking that a directory
+        # doesn't exist and creating it
+        time.sleep(0.001)
+        return real_makedirs(name, *args, **kwargs)
+
+    monkeypatch.setattr(os, "makedirs", slow_makedirs)
+    files = make_files(200)
+    archive = str(tmp_path / "build.zip")
+    make_zip(archive, files)
+    with zipfile.ZipFile(archive) as z:
+        assert not any(info.is_dir() for info in z.infolist())
+    store.put(PREFIX + "/main/1234/preprocessor-1234.zip", archive)
+    # the threads used to race each other creating the directories
+    for attempt in range(5):
+        outdir = tmp_path / ("out%d" % attempt)
+        outdir.mkdir()
+        fetch_and_extract(store, PREFIX, "main", "1234", str(outdir), workers=8)
+        check_extracted(str(outdir), files)
+
+
+def test_keep_archive(tmp_path, store):
+    archive = str(tmp_path / "build.tar.gz")
+    make_tgz(archive, make_files(5))
+    store.put(PREFIX + "/main/1234/preprocessor-1234.tar.gz", archive)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    kept = str(tmp_path / "kept.tar.gz")
+    fetch_and_extract(store, PREFIX, "main", "1234", str(outdir), keep_archive=kept)
+    assert sha256(kept) == sha256(archive)
+
+
+def test_checksum_mismatch(tmp_path, store):
+    archive = str(tmp_path / "build.tar.gz")
+    make_tgz(archive, make_files(5))
+    store.put(PREFIX + "/main/1234/preprocessor-1234.tar.gz", archive)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    with pytest.raises(ExtractionError):
+        fetch_and_extract(store, PREFIX, "main", "1234", str(outdir), expected_sha256="0" * 64)
+
+
+@pytest.mark.parametrize("suffix,make", [(".tar.gz", make_tgz), (".zip", make_zip)])
+def test_truncated_archive(tmp_path, store, suffix, make):
+    archive = str(tmp_path / ("build" + suffix))
+    make(archive, {"preprocessor/big": os.urandom(1 << 20)})
+    with open(archive, "rb+") as f:
+        f.truncate(os.path.getsize(archive) // 2)
+    store.put(PREFIX + "/main/1234/preprocessor-1234" + suffix, archive)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    with pytest.raises(ExtractionError):
+        fetch_and_extract(store, PREFIX, "main", "1234", str(outdir))
+
+
+@pytest.mark.parametrize("suffix,make", [(".tar.gz", make_tgz), (".zip", make_zip)])
+def test_member_outside_outdir(tmp_path, store, suffix, make):
+    archive = str(tmp_path / ("build" + suffix))
+    make(archive, {"../escaped": b"x"})
+    store.put(PREFIX + "/main/1234/preprocessor-1234" + suffix, archive)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    with pytest.raises(ExtractionError):
+        fetch_and_extract(store, PREFIX, "main", "1234", str(outdir))
+    assert not (tmp_path / "escaped").exists()
+
+
+def test_locate(tmp_path, store):
+    archive = str(tmp_path / "build.tar.gz")
+    make_tgz(archive, make_files(1))
+    store.put(PREFIX + "/main/1234/preprocessor-1234.tar.gz", archive)
+    store.put(PREFIX + "/other/1234/preprocessor-1234.tar.gz", archive)
+    store.put(PREFIX + "/main/1234/preprocessor-1234.txt", archive)
+    assert store.locate(PREFIX, "main", "1234") == PREFIX + "/main/1234/preprocessor-1234.tar.gz"
+    with pytest.raises(ExtractionError):
+        store.locate(PREFIX, "main", "9999")
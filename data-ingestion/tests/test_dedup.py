@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+
+from dedup import Deduplicator, MinHasher, shingles, tokens
+
+
+def make_pair(rng, size, overlap):
+    """Two sets of distinct tokens sharing `overlap` of `size`"""
+    common = ["c%d" % i for i in range(overlap)]
+    left = common + ["l%d" % i for i in range(size - overlap)]
+    right = common + ["r%d" % i for i in range(size - overlap)]
+    return left, right
+
+
+def test_estimate_tracks_true_jaccard():
+    rng = random.Random(0)
+    hasher = MinHasher()
+    errors = []
+    for _ in range(60):
+        size = rng.randint(40, 200)
+        left, right = make_pair(rng, size, rng.randint(0, size))
+        a, b = shingles(left, 1), shingles(right, 1)
+        true = len(set(a) & set(b)) / len(set(a) | set(b))
+        estimate = float(np.mean(hasher.signature(a) == hasher.signature(b)))
+        errors.append(estimate - true)
+    errors = np.abs(errors)
+    # with 128 hash functions the standard error is at most 0.044
+    assert errors.mean() < 0.04, errors.mean()
+    assert errors.max() < 0.15, errors.max()
+
+
+def test_identical_and_disjoint():
+    hasher = MinHasher()
+    words = tokens("def f(x):\n    return x + 1\n" * 10)
+    assert (hasher.signature(shingles(words)) == hasher.signature(shingles(words))).all()
+    other = tokens(" ".join("w%d" % i for i in range(100)))
+    assert np.mean(hasher.signature(shingles(words)) == hasher.signature(shingles(other))) < 0.05
+
+
+def doc(uuid, path, code):
+    return uuid, {"path": path, "start_line": 1, "end_line": code.count("\n"), "code": code}
+
+
+def test_deduplicator_keeps_distinct_and_aliases_copies():
+    body = "".join("def f%d(x):\n    return x * %d + %d\n\n" % (i, i, i * i) for i in range(30))
+    commented = body.replace("return", "# the answer\n    return", 1)
+    distinct = "".join("def g%d(y):\n    y.append(%d)\n    return len(y)\n\n" % (i, i) for i in range(30))
+    d = Deduplicator()
+    result, updates = d.filter([
+        ("a.py", [doc("u1", "a.py", body)]),
+        ("b.py", [doc("u2", "b.py", commented)]),
+        ("c.py", [doc("u3", "c.py", distinct)]),
+    ])
+    assert result[1][1] == [("u1", None)]
+    assert result[2][1][0][0] == "u3"
+    assert result[0][1][0][1]["aliases"] == ["b.py:1-%d" % commented.count("\n")]
+    assert updates == {}
+    # a later batch updates the representative already stored
+    result, updates = d.filter([("d.py", [doc("u4", "d.py", body)])])
+    assert result == [("d.py", [("u1", None)])]
+    assert updates == {"u1": {"aliases": ["b.py:1-%d" % commented.count("\n"),
+                                          "d.py:1-%d" % body.count("\n")]}}
@@ -0,0 +1,72 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import embed_cache
+from embed_cache import EmbeddingCache
+
+
+def last_used(cache, text):
+    db = sqlite3.connect(cache.dir + "/index.db")
+    try:
+        return db.execute("SELECT last_used FROM rows WHERE key = ?",
+                          (embed_cache.content_key(text),)).fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.put_many(["a", "b"], np.array([[1.0, 2.0], [3.0, 4.0]]))
+    found = cache.get_many(["b", "c", "a"])
+    assert found[0].tolist() == [3.0, 4.0]
+    assert found[1] is None
+    assert found[2].tolist() == [1.0, 2.0]
+    assert cache.stats()["hits"] == 2
+
+
+def test_append_after_a_torn_write(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.put_many(["a"], np.array([[1.0, 1.0]]))
+    # a writer died partway through a row
+    with open(cache._vectors_path(0), "ab") as f:
+        f.write(b"\0" * 5)
+    cache.put_many(["b"], np.array([[2.0, 2.0]]))
+    cache.put_many(["c"], np.array([[3.0, 3.0]]))
+    reader = EmbeddingCache(str(tmp_path), "model")
+    assert [v.tolist() for v in reader.get_many(["a", "b", "c"])] == [
+        [1.0, 1.0], [2.0, 2.0], [3.0, 3.0]]
+
+
+def test_hits_are_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(embed_cache, "TOUCH_BATCH", 3)
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.put_many(["a", "b", "c"], np.eye(3))
+    stored = last_used(cache, "a")
+    cache.get_many(["a"])
+    cache.get_many(["a", "b"])
+    assert last_used(cache, "a") == stored
+    cache.get_many(["c"])
+    assert last_used(cache, "a") > stored
+    assert last_used(cache, "c") > stored
+
+
+def test_compaction_keeps_recent_hits(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=4 * 8 * 4)
+    texts = ["t{0}".format(i) for i in range(3)]
+    cache.put_many(texts, np.arange(24, dtype=np.float32).reshape(3, 8))
+    cache.get_many(["t0"])
+    # the pending hit on t0 is written before the compaction this triggers
+    cache.put_many(["t3", "t4"], np.ones((2, 8)))
+    found = cache.get_many(["t0", "t1", "t2", "t3", "t4"])
+    assert found[0].tolist() == list(range(8))
+    assert found[1] is None and found[2] is None
+
+
+def test_reopening_with_another_dtype(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", dtype="float32")
+    cache.put_many(["a"], np.array([[1.0, 2.0, 3.0, 4.0]]))
+    with pytest.raises(ValueError, match="float32"):
+        EmbeddingCache(str(tmp_path), "model", dtype="float16")
+    assert EmbeddingCache(str(tmp_path), "model").get_many(["a"])[0].tolist() == [1, 2, 3, 4]
@@ -0,0 +1,46 @@
+import numpy as np
+
+from lexical import LexicalIndex, hybrid_search
+from vector_store import LocalStore
+
+
+def chunk(name):
+    return {"filename": name + ".py", "code": "def {0}(): pass".format(name),
+            "path": "/src/{0}.py".format(name), "qualname": name,
+            "start_line": 1, "end_line": 1, "aliases": []}
+
+
+def test_hits_missing_from_the_store_are_dropped(tmp_path):
+    store = LocalStore(str(tmp_path))
+    index = LexicalIndex()
+    names = ["submit_preflight", "submit_build", "fetch_build"]
+    for i, name in enumerate(names):
+        store.upsert({name: (chunk(name), np.eye(3)[i])})
+        index.add(name, chunk(name)["code"], chunk(name))
+    # deleted from the store behind the lexical index's back
+    store.delete(["submit_build"])
+
+    hits = hybrid_search("submit_build", index, store, encoder=None)
+    assert "submit_build" not in [hit.uuid for hit in hits]
+    assert all(hit.properties["code"] for hit in hits)
+
+    hits = hybrid_search("submit build", index, store, encoder=lambda q: np.eye(3)[1])
+    assert "submit_build" not in [hit.uuid for hit in hits]
+    assert {hit.uuid for hit in hits} == {"submit_preflight", "fetch_build"}
+    assert all(hit.properties["code"] for hit in hits)
+
+
+def test_remove_after_reloading(tmp_path):
+    path = str(tmp_path / "lexical.json")
+    index = LexicalIndex(path)
+    index.update([(name, chunk(name)["code"], chunk(name))
+                  for name in ("submit_preflight", "submit_build")])
+    index.save()
+    index = LexicalIndex(path)
+    index.update([("submit_build", "def fetch(): pass", chunk("submit_build"))])
+    index.remove(["submit_preflight"])
+    assert "preflight" not in index.postings
+    assert "build" not in index.postings
+    assert set(index.postings["fetch"]) == {"submit_build"}
+    assert index.lookup("submit_preflight") == []
+    assert index.total_length == index.lengths["submit_build"]
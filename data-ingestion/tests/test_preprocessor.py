@@ -0,0 +1,50 @@
+import subprocess
+
+import pytest
+
+pytest.importorskip("worker_python3")
+
+import preprocessor     # noqa: E402
+from preprocessor import Preprocessor       # noqa: E402
+
+
+def make(tmp_path, extra_args):
+    return Preprocessor("main", "1234", str(tmp_path), "preprocessor.zip", extra_args)
+
+
+def test_extra_args_keep_their_quoting(tmp_path):
+    assert make(tmp_path, '--opt "a b" -x').extra_preprocessor_args == ["--opt", "a b", "-x"]
+
+
+def test_escaped_extra_args(tmp_path):
+    # as passed on a command line that went through a shell once already
+    args = make(tmp_path, '"--opt \\"a b\\" -x"').extra_preprocessor_args
+    assert args == ["--opt", "a b", "-x"]
+
+
+def test_no_extra_args(tmp_path):
+    assert make(tmp_path, "").extra_preprocessor_args == []
+
+
+def test_failed_remount_is_checked_again(monkeypatch, tmp_path):
+    mounts = tmp_path / "mounts"
+    mounts.write_text("tmpfs /tmp tmpfs rw,nosuid,noexec 0 0\n")
+    real_open = open
+    monkeypatch.setattr(preprocessor, "open",
+                        lambda path, *a, **kw: real_open(mounts if path == "/proc/mounts" else path,
+                                                         *a, **kw),
+                        raising=False)
+    calls = []
+
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 1 if len(calls) == 1 else 0)
+
+    monkeypatch.setattr(preprocessor.subprocess, "run", run)
+    monkeypatch.setattr(preprocessor, "_tmp_exec_ok", False)
+    preprocessor._check_tmp_exec()
+    assert not preprocessor._tmp_exec_ok
+    preprocessor._check_tmp_exec()
+    assert preprocessor._tmp_exec_ok
+    preprocessor._check_tmp_exec()
+    assert len(calls) == 2
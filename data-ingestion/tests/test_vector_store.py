@@ -0,0 +1,170 @@
+"""
+One set of behavioral tests, run against every VectorStore backend.
+The Weaviate ones need a server at WEAVIATE_URL and are skipped without one.
+"""
+
+import uuid
+
+import numpy as np
+import pytest
+import requests
+
+from ingest import WEAVIATE_URL, class_schema
+from vector_store import LocalStore, WeaviateStore
+
+TEST_CLASS_NAME = "VectorStoreTest"
+DIM = 16
+
+
+class Backend:
+    """Makes a store, and opens it again as a later process would"""
+
+    def __init__(self, name, make, reopen):
+        self.name = name
+        self.make = make
+        self.reopen = reopen
+
+    def __repr__(self):
+        return self.name
+
+
+def _local(tmp_path, quantize):
+    directory = str(tmp_path / "index")
+    return Backend("local int8" if quantize else "local float32",
+                   lambda: LocalStore(directory, quantize=quantize),
+                   lambda store: LocalStore(directory, quantize=quantize))
+
+
+def _weaviate():
+    try:
+        requests.get(WEAVIATE_URL + "/v1/.well-known/ready", timeout=1).raise_for_status()
+    except requests.RequestException:
+        pytest.skip("no Weaviate at {0}".format(WEAVIATE_URL))
+    import weaviate
+    client = weaviate.Client(WEAVIATE_URL)
+    if TEST_CLASS_NAME in [c["class"] for c in client.schema.get()["classes"]]:
+        client.schema.delete_class(TEST_CLASS_NAME)
+    client.schema.create_class(class_schema(TEST_CLASS_NAME))
+    return Backend("weaviate",
+                   lambda: WeaviateStore(client, TEST_CLASS_NAME),
+                   lambda store: WeaviateStore(client, TEST_CLASS_NAME)), client
+
+
+@pytest.fixture(params=["float32", "int8", "weaviate"])
+def backend(request, tmp_path):
+    if request.param == "weaviate":
+        backend, client = _weaviate()
+        yield backend
+        client.schema.delete_class(TEST_CLASS_NAME)
+    else:
+        yield _local(tmp_path, quantize=request.param == "int8")
+
+
+def object_id(i):
+    return str(uuid.UUID(int=i + 1))
+
+
+def properties(i):
+    return {"filename": "f{0}.py".format(i), "code": "def f{0}(): pass".format(i),
+            "path": "/src/f{0}.py".format(i), "qualname": "f{0}".format(i),
+            "start_line": 1, "end_line": 1, "aliases": []}
+
+
+def vectors(count, seed=0):
+    rng = np.random.default_rng(seed)
+    v = rng.standard_normal((count, DIM)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def objects(vs, first=0):
+    return {object_id(first + i): (properties(first + i), v) for i, v in enumerate(vs)}
+
+
+def test_search_finds_the_nearest(backend):
+    store = backend.make()
+    vs = vectors(20)
+    assert store.upsert(objects(vs)) == set()
+    store.save()
+    for i in (0, 7, 19):
+        hits = store.search(vs[i], k=3)
+        assert hits[0].uuid == object_id(i)
+        assert hits[0].score == pytest.approx(1.0, abs=0.02)
+        assert hits[0].properties["qualname"] == "f{0}".format(i)
+        assert [h.score for h in hits] == sorted((h.score for h in hits), reverse=True)
+
+
+def test_upsert_replaces_the_same_uuid(backend):
+    store = backend.make()
+    vs = vectors(5)
+    store.upsert(objects(vs))
+    store.save()
+    changed = dict(properties(2), qualname="renamed")
+    store.upsert({object_id(2): (changed, -vs[2])})
+    store.save()
+    assert store.get([object_id(2)])[object_id(2)]["qualname"] == "renamed"
+    assert store.search(-vs[2], k=1)[0].uuid == object_id(2)
+
+
+def test_delete(backend):
+    store = backend.make()
+    vs = vectors(5)
+    store.upsert(objects(vs))
+    store.save()
+    store.delete([object_id(1), object_id(3)])
+    store.save()
+    assert set(store.get([object_id(i) for i in range(5)])) == {object_id(0), object_id(2),
+                                                               object_id(4)}
+    found = {h.uuid for h in store.search(vs[1], k=5)}
+    assert found == {object_id(0), object_id(2), object_id(4)}
+
+
+def test_update_properties_keeps_the_vector(backend):
+    store = backend.make()
+    vs = vectors(5)
+    store.upsert(objects(vs))
+    store.save()
+    assert store.update_properties({object_id(4): {"aliases": ["/vendor/f4.py:1-1"]}}) == set()
+    store.save()
+    assert store.get([object_id(4)])[object_id(4)]["aliases"] == ["/vendor/f4.py:1-1"]
+    assert store.get([object_id(4)])[object_id(4)]["qualname"] == "f4"
+    assert store.search(vs[4], k=1)[0].uuid == object_id(4)
+
+
+def test_reopen(backend):
+    store = backend.make()
+    vs = vectors(10)
+    store.upsert(objects(vs))
+    store.save()
+    store = backend.reopen(store)
+    assert store.search(vs[3], k=1)[0].uuid == object_id(3)
+    store.upsert(objects(vectors(5, seed=1), first=10))
+    store.save()
+    assert store.search(vs[3], k=1)[0].uuid == object_id(3)
+    assert len(store.get([object_id(i) for i in range(15)])) == 15
+
+
+def test_reopen_empty(backend):
+    store = backend.make()
+    store.save()
+    store = backend.reopen(store)
+    assert store.search(vectors(1)[0], k=3) == []
+    vs = vectors(3)
+    assert store.upsert(objects(vs)) == set()
+    store.save()
+    store = backend.reopen(store)
+    assert store.search(vs[1], k=1)[0].uuid == object_id(1)
+
+
+def test_reopen_after_deleting_everything(backend):
+    store = backend.make()
+    vs = vectors(3)
+    store.upsert(objects(vs))
+    store.save()
+    store.delete([object_id(i) for i in range(3)])
+    store.save()
+    store = backend.reopen(store)
+    assert store.search(vs[0], k=3) == []
+    store.upsert(objects(vectors(2, seed=1), first=3))
+    store.save()
+    store = backend.reopen(store)
+    assert {h.uuid for h in store.search(vs[0], k=5)} == {object_id(3), object_id(4)}
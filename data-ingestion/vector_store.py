@@ -0,0 +1,298 @@
+"""
+Where embedded chunks are kept and searched. Ingestion and retrieval
+only use the VectorStore interface, so they work the same against
+Weaviate or against a local index that needs no server:
+
+    WeaviateStore(client)      the PythonSource class in Weaviate
+    LocalStore(directory)      a NumPy matrix on disk, memory-mapped
+"""
+
+import json
+import logging
+import os
+from collections import namedtuple
+
+import numpy as np
+import requests
+from weaviate.exceptions import UnexpectedStatusCodeException
+
+from ingest import CLASS_NAME, delete_objects, import_objects
+
+logger = logging.getLogger(__name__)
+
+PROPERTIES = ["filename", "code", "path", "qualname", "start_line", "end_line", "aliases"]
+# rows of an int8 matrix converted to float32 at a time while searching
+SEARCH_BLOCK = 1 << 16
+
+# score is a similarity: higher is closer
+Hit = namedtuple("Hit", "uuid score properties")
+
+
+class VectorStore:
+    def upsert(self, objects):
+        """Add objects, replacing any with the same UUID
+
+        Args:
+            objects (dict): UUID -> (properties, vector)
+        Returns:
+            set: UUIDs of objects that could not be stored
+        """
+        raise NotImplementedError
+
+    def delete(self, uuids):
+        raise NotImplementedError
+
+    def update_properties(self, updates):
+        """Change some properties of stored objects, keeping their vectors
+
+        Args:
+            updates (dict): UUID -> properties to set
+        Returns:
+            set: UUIDs of objects that could not be updated
+        """
+        raise NotImplementedError
+
+    def search(self, vector, k=5):
+        """
+        Returns:
+            list: up to k Hits, best first
+        """
+        raise NotImplementedError
+
+    def get(self, uuids):
+        """
+        Returns:
+            dict: UUID -> properties, for the ones that exist
+        """
+        raise NotImplementedError
+
+    def save(self):
+        """Make everything stored so far durable"""
+
+
+class WeaviateStore(VectorStore):
+    def __init__(self, client, class_name=CLASS_NAME, properties=PROPERTIES):
+        self.client = client
+        self.class_name = class_name
+        self.properties = list(properties)
+
+    def upsert(self, objects):
+        return import_objects(
+            self.client,
+            {object_id: (properties, [float(x) for x in vector])
+             for object_id, (properties, vector) in objects.items()},
+            class_name=self.class_name
+        )
+
+    def delete(self, uuids):
+        delete_objects(self.client, uuids)
+
+    def update_properties(self, updates):
+        failed = set()
+        for object_id, properties in updates.items():
+            try:
+                # PATCH: merged into the object, the vector is left alone
+                self.client.data_object.update(properties, class_name=self.class_name,
+                                               uuid=object_id)
+            except (UnexpectedStatusCodeException, requests.RequestException) as e:
+                logger.warning("could not update %s: %s", object_id, e)
+                failed.add(object_id)
+        return failed
+
+    def get(self, uuids):
+        found = {}
+        for object_id in uuids:
+            obj = self.client.data_object.get_by_id(object_id, class_name=self.class_name)
+            if obj is not None:
+                found[object_id] = {name: obj["properties"].get(name)
+                                    for name in self.properties}
+        return found
+
+    def search(self, vector, k=5):
+        result = (self.client.query.get(self.class_name, self.properties)
+                  .with_near_vector({"vector": [float(x) for x in vector]})
+                  .with_limit(k)
+                  .with_additional(["id", "distance"])
+                  .do())
+        if "errors" in result:
+            raise RuntimeError(result["errors"])
+        hits = []
+        for obj in result["data"]["Get"][self.class_name]:
+            extra = obj.pop("_additional")
+            hits.append(Hit(extra["id"], 1.0 - extra["distance"], obj))
+        return hits
+
+
+class LocalStore(VectorStore):
+    """Brute-force cosine search over a matrix of unit vectors
+
+    The matrix is saved with np.save and memory-mapped when loaded, so
+    opening a big index is instant and only the pages a search touches
+    are read. With quantize=True vectors are kept as int8 with one scale
+    per row, a quarter of the memory at a small cost in recall.
+
+        <directory>/vectors.npy     float32 or int8, one row per object
+        <directory>/scales.npy      per-row scales (int8 only)
+        <directory>/objects.jsonl   UUID and properties of each row
+    """
+
+    def __init__(self, directory, quantize=False):
+        self.directory = directory
+        self.quantize = quantize
+        self._ids = []
+        self._properties = []
+        self._row = {}
+        self._vectors = None
+        self._scales = None
+        self._added = []        # rows not yet merged into _vectors
+        self._deleted = set()
+        if os.path.exists(os.path.join(directory, "objects.jsonl")):
+            self._load()
+
+    def _load(self):
+        with open(os.path.join(self.directory, "objects.jsonl")) as f:
+            for line in f:
+                obj = json.loads(line)
+                self._row[obj["uuid"]] = len(self._ids)
+                self._ids.append(obj["uuid"])
+                self._properties.append(obj["properties"])
+        vectors = np.load(os.path.join(self.directory, "vectors.npy"), mmap_mode="r")
+        if vectors.dtype == np.int8:
+            self.quantize = True
+        elif self.quantize and len(vectors):
+            raise ValueError("{0} holds float vectors, not int8".format(self.directory))
+        if not len(vectors):
+            # saved before anything was stored, or after everything was
+            # deleted; the next upsert starts the matrix afresh
+            return
+        if self.quantize:
+            self._scales = np.load(os.path.join(self.directory, "scales.npy"), mmap_mode="r")
+        self._vectors = vectors
+
+    def __len__(self):
+        return len(self._ids) - len(self._deleted)
+
+    def _encode(self, vectors):
+        """Unit-normalize and, if quantizing, turn into int8 plus scales"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+        if not self.quantize:
+            return vectors, None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+    def _merge(self):
+        if not self._added:
+            return
+        vectors, scales = self._encode(self._added)
+        if self._vectors is None or not len(self._vectors):
+            self._vectors, self._scales = vectors, scales
+        else:
+            # np.concatenate copies, which also detaches from the memmap
+            self._vectors = np.concatenate([self._vectors, vectors])
+            if self.quantize:
+                self._scales = np.concatenate([self._scales, scales])
+        self._added = []
+
+    def upsert(self, objects):
+        replace = {}
+        for object_id, (properties, vector) in objects.items():
+            row = self._row.get(object_id)
+            if row is not None and row < len(self._ids) - len(self._added):
+                replace[row] = vector
+                self._properties[row] = properties
+                self._deleted.discard(row)
+            elif row is not None:
+                self._added[row - (len(self._ids) - len(self._added))] = vector
+                self._properties[row] = properties
+                self._deleted.discard(row)
+            else:
+                self._row[object_id] = len(self._ids)
+                self._ids.append(object_id)
+                self._properties.append(properties)
+                self._added.append(vector)
+        if replace:
+            rows = sorted(replace)
+            vectors, scales = self._encode([replace[r] for r in rows])
+            if not self._vectors.flags.writeable:
+                self._vectors = np.array(self._vectors)
+                if self.quantize:
+                    self._scales = np.array(self._scales)
+            self._vectors[rows] = vectors
+            if self.quantize:
+                self._scales[rows] = scales
+        return set()
+
+    def delete(self, uuids):
+        for object_id in uuids:
+            row = self._row.get(object_id)
+            if row is not None:
+                self._deleted.add(row)
+
+    def update_properties(self, updates):
+        failed = set()
+        for object_id, properties in updates.items():
+            row = self._row.get(object_id)
+            if row is None or row in self._deleted:
+                failed.add(object_id)
+            else:
+                self._properties[row] = dict(self._properties[row], **properties)
+        return failed
+
+    def get(self, uuids):
+        rows = ((object_id, self._row.get(object_id)) for object_id in uuids)
+        return {object_id: self._properties[row] for object_id, row in rows
+                if row is not None and row not in self._deleted}
+
+    def search(self, vector, k=5):
+        self._merge()
+        if self._vectors is None or not len(self):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if self.quantize:
+            # widen int8 rows a block at a time rather than all at once
+            scores = np.empty(len(self._vectors), dtype=np.float32)
+            for i in range(0, len(scores), SEARCH_BLOCK):
+                block = self._vectors[i:i + SEARCH_BLOCK].astype(np.float32)
+                scores[i:i + SEARCH_BLOCK] = block @ query
+            scores *= self._scales
+        else:
+            scores = self._vectors @ query
+        if self._deleted:
+            scores[list(self._deleted)] = -np.inf
+        k = min(k, len(self))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [Hit(self._ids[i], float(scores[i]), self._properties[i]) for i in top]
+
+    def save(self):
+        """Write the index, dropping deleted rows, then map it again"""
+        self._merge()
+        os.makedirs(self.directory, exist_ok=True)
+        keep = [i for i in range(len(self._ids)) if i not in self._deleted]
+        if self._vectors is not None:
+            vectors = self._vectors[keep]
+        else:
+            # nothing stored yet: an empty matrix of the right type, whose
+            # width the first upsert after loading it will decide
+            vectors = np.zeros((0, 0), np.int8 if self.quantize else np.float32)
+        self._atomic_save("vectors.npy", vectors)
+        if self.quantize:
+            scales = self._scales[keep] if self._scales is not None else np.zeros(0, np.float32)
+            self._atomic_save("scales.npy", scales)
+        tmp = os.path.join(self.directory, "objects.jsonl.tmp")
+        with open(tmp, "w") as f:
+            for i in keep:
+                f.write(json.dumps({"uuid": self._ids[i],
+                                    "properties": self._properties[i]}) + "\n")
+        os.replace(tmp, os.path.join(self.directory, "objects.jsonl"))
+        self.__init__(self.directory, self.quantize)
+
+    def _atomic_save(self, name, array):
+        tmp = os.path.join(self.directory, name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp, os.path.join(self.directory, name))
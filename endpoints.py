@@ -0,0 +1,221 @@
+"""
+Spread requests over several Ollama servers.
+
+    OLLAMA_HOST=http://gpu1:11434,http://gpu2:11434 python foo.py
+
+An EndpointPool picks a server for each request:
+
+- "least_outstanding" sends it to the server with the fewest requests in
+  flight;
+- "affinity" prefers servers that already have the model loaded, so a
+  model isn't loaded on every box, and spills over to the others only
+  when those are much busier.
+
+Servers that fail `failure_threshold` times in a row are taken out of
+rotation (the circuit opens) for `cooldown` seconds, then get one request
+to show they're back; no other request goes there until that one is
+over. Optionally a background thread probes every server with
+GET /api/ps, which also tells which models each one has loaded.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger()
+
+LEAST_OUTSTANDING = "least_outstanding"
+AFFINITY = "affinity"
+
+FAILURE_THRESHOLD = 3
+COOLDOWN = 30.0
+PROBE_INTERVAL = 10.0
+PROBE_TIMEOUT = 2.0
+# with affinity, go to a server without the model once every server
+# with it has this many more requests in flight than the idlest server
+AFFINITY_SPILL = 4
+
+
+class NoEndpointAvailable(requests.ConnectionError):
+    pass
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.open_until = 0.0       # circuit is open until this time
+        self.trial_in_flight = False    # a request is testing the half-open circuit
+        self.models = set()         # models known to be loaded here
+        self.requests = 0
+
+    def available(self, now):
+        return self.healthy and self.open_until <= now and not self.trial_in_flight
+
+    def __repr__(self):
+        return "Endpoint({0!r}, outstanding={1}, healthy={2})".format(
+            self.url, self.outstanding, self.healthy)
+
+
+class EndpointPool:
+    def __init__(self, urls, policy=LEAST_OUTSTANDING,
+                 failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN,
+                 session=None):
+        """
+        Args:
+            urls (list): base URLs of the Ollama servers
+            policy (str): LEAST_OUTSTANDING or AFFINITY
+            failure_threshold (int): failures in a row that open the circuit
+            cooldown (float): seconds a server is left alone after that
+            session (Session): used for the health probes
+        """
+        assert policy in (LEAST_OUTSTANDING, AFFINITY), policy
+        self.endpoints = [Endpoint(url) for url in urls]
+        assert self.endpoints, "no Ollama endpoints"
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._prober = None
+
+    @classmethod
+    def from_string(cls, hosts, **kwargs):
+        """A pool for a comma-separated list of URLs, as in OLLAMA_HOST"""
+        return cls([h.strip() for h in hosts.split(",") if h.strip()], **kwargs)
+
+    def choose(self, model, exclude=()):
+        """Pick a server for a request and count it as in flight
+
+        Call release() once the request is over, passing it `trial`.
+        Args:
+            model (str): for the affinity policy
+            exclude (iterable): Endpoints already tried for this request
+        Returns:
+            tuple: (Endpoint, trial), where to send it and whether it is
+                the one request testing a half-open circuit
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints
+                          if e not in exclude and e.available(now)]
+            if not candidates:
+                # rather than fail outright, try a server whose circuit
+                # is open; it may well have recovered
+                candidates = [e for e in self.endpoints
+                              if e not in exclude and e.healthy and not e.trial_in_flight]
+            if not candidates:
+                raise NoEndpointAvailable(
+                    "no Ollama endpoint available of {0}".format(
+                        [e.url for e in self.endpoints]))
+            endpoint = min(candidates, key=lambda e: e.outstanding)
+            if self.policy == AFFINITY:
+                warm = [e for e in candidates if model in e.models]
+                if warm:
+                    best = min(warm, key=lambda e: e.outstanding)
+                    if best.outstanding - endpoint.outstanding < AFFINITY_SPILL:
+                        endpoint = best
+            trial = endpoint.failures >= self.failure_threshold
+            if trial:
+                # half open: let this one request through, and keep the
+                # others away until it's done
+                endpoint.trial_in_flight = True
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint, trial
+
+    def release(self, endpoint, model=None, failed=False, trial=False):
+        """
+        Args:
+            endpoint (Endpoint): from choose()
+            model (str): the model that answered, now loaded there
+            failed (bool): the server couldn't be reached, or broke off
+            trial (bool): from choose(); only the trial request ends the
+                half-open state, not one that was in flight before the
+                circuit opened
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if trial:
+                endpoint.trial_in_flight = False
+            if failed:
+                self._failed(endpoint)
+            else:
+                endpoint.failures = 0
+                endpoint.open_until = 0.0
+                if model:
+                    endpoint.models.add(model)
+
+    def left(self, exclude=()):
+        """
+        Returns:
+            int: servers choose() could still pick besides those in exclude
+        """
+        with self._lock:
+            return sum(1 for e in self.endpoints
+                       if e not in exclude and e.healthy and not e.trial_in_flight)
+
+    def _failed(self, endpoint):
+        endpoint.failures += 1
+        if endpoint.failures >= self.failure_threshold:
+            endpoint.open_until = time.time() + self.cooldown
+            logger.warning("%s failed %d times in a row, leaving it alone for %.0fs",
+                           endpoint.url, endpoint.failures, self.cooldown)
+
+    def probe(self, endpoint):
+        try:
+            response = self.session.get(endpoint.url + "/api/ps", timeout=PROBE_TIMEOUT)
+            response.raise_for_status()
+            models = {m["name"] for m in response.json().get("models", [])}
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                if endpoint.healthy:
+                    logger.warning("%s is down: %s", endpoint.url, e)
+                endpoint.healthy = False
+            return False
+        with self._lock:
+            if not endpoint.healthy:
+                logger.info("%s is back", endpoint.url)
+            endpoint.healthy = True
+            # Ollama reports "llama3:latest" for "llama3"
+            endpoint.models = models | {name.split(":")[0] for name in models
+                                        if name.endswith(":latest")}
+        return True
+
+    def probe_all(self):
+        for endpoint in self.endpoints:
+            self.probe(endpoint)
+
+    def start_probes(self, interval=PROBE_INTERVAL):
+        """Probe every server now, then every `interval` seconds in a
+        daemon thread until close()"""
+        self.probe_all()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.probe_all()
+
+        self._prober = threading.Thread(target=run, daemon=True)
+        self._prober.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._prober is not None:
+            self._prober.join()
+            self._prober = None
+
+    def report(self):
+        """
+        Returns:
+            list: a dict per server with its state and request count
+        """
+        with self._lock:
+            return [{"url": e.url, "healthy": e.healthy, "outstanding": e.outstanding,
+                     "requests": e.requests, "failures": e.failures,
+                     "models": sorted(e.models)} for e in self.endpoints]
@@ -8,7 +8,22 @@ inconsistent sometimes, and poorly documented other times.
 import logging
 import json
 import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+from context_window import ContextWindow
+from endpoints import EndpointPool, NoEndpointAvailable
+from llm_cache import ResponseCache
+from metrics import CallTimer, JsonLinesSink, MetricsRegistry
+from snippets import default_index
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 logger = logging.getLogger()
 level = logging.INFO
@@ -23,148 +38,555 @@ logger.info("Logger %s is set up", logger)
 
 PLACEHOLDER = object()
 
+# Connecting should be quick; reading can take a long time because a
+# big model may have to be loaded before the first token comes back.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 20*60
+POOL_MAXSIZE = 10
+# how long Ollama keeps a model (and its KV cache) loaded after a request
+KEEP_ALIVE = "30m"
+# Ollama sends one HTTP chunk per token, so this mostly matters for the
+# final message of /api/generate, which carries the whole context
+STREAM_CHUNK_SIZE = 4096
+# answers from a server that's overloaded or restarting; another server
+# in the pool may do better
+RETRY_STATUS = (502, 503, 504)
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def make_session(pool_maxsize=POOL_MAXSIZE, pool_connections=1):
+    """Build a requests Session with a keep-alive connection pool
+
+    Args:
+        pool_maxsize (int): connections kept open per host
+        pool_connections (int): number of per-host pools to cache
+    Returns:
+        Session: a session that reuses TCP connections between requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=True
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def shared_session():
+    """Return the process-wide session, so many LLM instances can share
+    one connection pool
+    """
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = make_session()
+        return _shared_session
+
+
+def placeholder_turns(messages):
+    """Resolve each PLACEHOLDER with the model's answer to the messages
+    before it, leaving the asking to the caller, sync or async
+
+    A generator: it yields the messages to send, is sent the answer to
+    them, and returns a copy of messages with only real messages in it.
+    """
+    messages = messages[:]
+    while PLACEHOLDER in messages:
+        n = messages.index(PLACEHOLDER)
+        answer = yield messages[:n]
+        messages[n] = {"role": "assistant",
+                       "content": answer}
+    return messages
+
+
+def chat_content(response):
+    return response["message"]["content"]
+
+
+def generate_response(response):
+    return response["response"]
+
+
 class LLM:
-    def __init__(self, model):
+    def __init__(self, model, session=None,
+                 connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT,
+                 pool_maxsize=POOL_MAXSIZE,
+                 cache=None, options=None, context_window=None,
+                 metrics=None, endpoints=None):
+        """
+        Args:
+            model (str): name of the Ollama model
+            session (Session): connection pool to use, e.g. shared_session();
+                by default this instance gets a pool of its own
+            connect_timeout (float): seconds allowed to open a connection
+            read_timeout (float): seconds allowed between bytes of a response
+            pool_maxsize (int): size of this instance's own pool
+            cache (ResponseCache): reuse earlier answers to the same requests
+            options (dict): Ollama model options, e.g. {"temperature": 0}
+            context_window (ContextWindow): fit each chat turn's messages
+                into a token budget before sending them
+            metrics (list): sinks, e.g. a MetricsRegistry, that get the
+                timings of every request (see metrics.py)
+            endpoints (EndpointPool): Ollama servers to spread requests
+                over; one is made, and probed in the background, when
+                OLLAMA_HOST is a comma-separated list of them. A pool
+                passed in is used as is: call its start_probes() to have
+                it notice servers going down and which models they have
+        """
         self.ollama_host = os.environ.get(
             "OLLAMA_HOST",
              "http://localhost:11434"
         )
+        if endpoints is None and "," in self.ollama_host:
+            endpoints = EndpointPool.from_string(self.ollama_host).start_probes()
+        self.endpoints = endpoints
         self.model = model
+        self.session = session or make_session(
+            pool_maxsize=pool_maxsize,
+            pool_connections=len(endpoints.endpoints) if endpoints else 1
+        )
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        self.options = options
+        self.context_window = context_window
+        if metrics is not None and not isinstance(metrics, (list, tuple)):
+            metrics = [metrics]
+        self.metrics = metrics or []
 
     def post(self, url, **data):
         """Do a HTTP POST to the Ollama server
+
+        With an EndpointPool, a server that can't be reached, or answers
+        with one of RETRY_STATUS, is skipped and the request goes to
+        another one; nothing has been streamed back yet at that point.
         Returns:
             Response: whatever is returned by the POST op
         """
+        if self.endpoints is not None:
+            return self.post_to_pool(url, **data)
         logger.info(self.ollama_host + url)
         # logger.info(data)
-        return requests.post(
+        return self.session.post(
             self.ollama_host + url,
             stream=True,
-            timeout=20*60,
+            timeout=self.timeout,
             json=data
         )
 
+    def post_to_pool(self, url, **data):
+        tried = []
+        error = None
+        while True:
+            try:
+                endpoint, trial = self.endpoints.choose(self.model, exclude=tried)
+            except NoEndpointAvailable:
+                # the others went down meanwhile; what went wrong with
+                # the last one says more
+                if error is not None:
+                    raise error
+                raise
+            tried.append(endpoint)
+            # servers the probes found down don't count
+            last = not self.endpoints.left(exclude=tried)
+            logger.info(endpoint.url + url)
+            try:
+                response = self.session.post(
+                    endpoint.url + url,
+                    stream=True,
+                    timeout=self.timeout,
+                    json=data
+                )
+            except requests.ConnectionError as e:
+                self.endpoints.release(endpoint, failed=True, trial=trial)
+                if last:
+                    raise
+                error = e
+                logger.warning("%s: %s, trying another endpoint", endpoint.url, e)
+                continue
+            except BaseException:
+                # e.g. a ReadTimeout: not worth retrying elsewhere, but the
+                # request mustn't stay counted as in flight
+                self.endpoints.release(endpoint, failed=True, trial=trial)
+                raise
+            if response.status_code in RETRY_STATUS and not last:
+                response.close()
+                self.endpoints.release(endpoint, failed=True, trial=trial)
+                logger.warning("%s: HTTP %d, trying another endpoint",
+                               endpoint.url, response.status_code)
+                continue
+            # iter_tokens() releases the endpoint when the stream is over
+            response.endpoint = endpoint
+            response.trial = trial
+            return response
+
     def chat(self, _prompt=None, messages=None):
         assert _prompt is None, "handle this case later"
         assert isinstance(messages, list), messages
+        return self.run_thru(self.resolve_placeholders(messages))
 
-        def run_thru(msgs):
-            response = self.post(
-                url="/api/chat",
-                model=self.model,
-                # messages=mgrp
-                messages=msgs
-            )
-            answer = self.print_streamed_response(
-                response,
-                lambda response: response["message"]["content"]
-            )
-            return answer
-
-        messages = messages[:]
-        while PLACEHOLDER in messages:
-            n = messages.index(PLACEHOLDER)
-            answer = run_thru(messages[:n])
-            messages[n] = {"role": "assistant",
-                           "content": answer}
-        run_thru(messages)
-
-    def print_streamed_response(self, response, selector):
-        assert callable(selector), selector
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                json_response = json.loads(line)
-                if "error" in json_response:
-                    logger.warning(line)
-                    logger.warning(json_response)
-                    break
-                if json_response.get('done', False):
-                    break
-                full_response += selector(json_response)
+    def run_thru(self, msgs):
+        return self.answer("/api/chat", chat_content, messages=self.fit(msgs))
+
+    def fit(self, messages):
+        if self.context_window is None:
+            return messages
+        return self.context_window.fit(messages)
+
+    def resolve_placeholders(self, messages):
+        """Replace each PLACEHOLDER with the model's answer to the
+        messages before it
+        Returns:
+            list: a copy of messages with only real messages in it
+        """
+        turns = placeholder_turns(messages)
+        answer = None
+        try:
+            while True:
+                answer = self.run_thru(turns.send(answer))
+        except StopIteration as done:
+            return done.value
+
+    def chat_with_context(self, messages, keep_alive=KEEP_ALIVE):
+        """Like chat(), but only new turns are sent to the model
+
+        The conversation runs in a ChatSession, so the model keeps the
+        tokens it has already seen and each PLACEHOLDER costs a prefill of
+        the turns since the last one instead of the whole history.
+        Conversations with literal assistant messages can't be replayed
+        into the model's context, so those fall back to chat().
+        Returns:
+            str: the answer to the last turn
+        """
+        assert isinstance(messages, list), messages
+        if any(m is not PLACEHOLDER and m["role"] == "assistant"
+               for m in messages):
+            return self.chat(messages=messages)
+        system = "\n".join(m["content"] for m in messages
+                           if m is not PLACEHOLDER and m["role"] == "system")
+        session = ChatSession(self, system=system or None,
+                              keep_alive=keep_alive)
+        pending = []
+        answer = None
+        for m in messages + [PLACEHOLDER]:
+            if m is PLACEHOLDER:
+                if pending:
+                    answer = session.send("\n\n".join(pending))
+                    pending = []
+            elif m["role"] == "user":
+                pending.append(m["content"])
+        logger.info("context reuse: %s", session.report())
+        return answer
+
+    def stream_chat(self, messages):
+        """Like chat(), but the answer to the last turn is streamed
+
+        PLACEHOLDERs are resolved first, the same way chat() does it.
+        Yields:
+            str: each piece of the final answer as it arrives
+        """
+        assert isinstance(messages, list), messages
+        return self.stream(
+            "/api/chat", chat_content,
+            messages=self.fit(self.resolve_placeholders(messages))
+        )
+
+    def stream_generate(self, _prompt):
+        """Yields:
+            str: each piece of the answer as it arrives
+        """
+        return self.stream("/api/generate", generate_response, prompt=_prompt)
+
+    def stream(self, url, selector, **data):
+        """POST a request for the model and yield its answer as it arrives
+
+        If there is a cache, a cached answer comes back as a single piece,
+        and a fresh one is stored once the model says it's done.
+        Args:
+            url (str): API path, e.g. "/api/chat"
+            selector (callable): picks the text out of one NDJSON message
+        Yields:
+            str: pieces of the answer
+        """
+        if self.options:
+            data["options"] = self.options
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.ollama_host + url, self.model, data)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info("cache hit for %s", url)
+                yield cached
+                return
+        done = []
+        parts = []
+        timer = self.timer(url)
+        response = self.post(url, model=self.model, **data)
+        for piece in self.iter_tokens(response, selector, on_done=done.append,
+                                      timer=timer):
+            parts.append(piece)
+            yield piece
+        if key is not None and done:
+            self.cache.put(key, "".join(parts))
+
+    def answer(self, url, selector, **data):
+        full_response = "".join(self.stream(url, selector, **data))
         logger.info(full_response)
         return full_response
 
+    def timer(self, url, started=None):
+        """A CallTimer for one request, None if there are no sinks"""
+        if not self.metrics:
+            return None
+        return CallTimer(self.metrics, self.model, url, started)
+
+    def iter_tokens(self, response, selector, on_done=None, timer=None):
+        """Yield the pieces of a streamed answer as they arrive
+
+        Args:
+            response (Response): a streamed response from post()
+            selector (callable): picks the text out of one NDJSON message
+            on_done (callable): gets the final "done" message, which has
+                timings and (for /api/generate) the context
+            timer (CallTimer): notes the first token and the done message
+        Yields:
+            str: the text of each message before the final "done" one
+        """
+        assert callable(selector), selector
+        endpoint = getattr(response, "endpoint", None)
+        failed = False
+        answered = False
+        try:
+            # closing the response hands the connection back to the pool
+            with response:
+                stopped = False
+                for line in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                    if line:
+                        json_response = json_loads(line)
+                        if "error" in json_response:
+                            logger.warning(line)
+                            logger.warning(json_response)
+                            stopped = True
+                            break
+                        if json_response.get('done', False):
+                            answered = True
+                            if timer is not None:
+                                timer.done(json_response)
+                            if on_done is not None:
+                                on_done(json_response)
+                            stopped = True
+                            break
+                        if timer is not None:
+                            timer.first()
+                        yield selector(json_response)
+                if stopped:
+                    # read to the end of the stream, otherwise the connection
+                    # is dropped instead of being kept alive; a stream that
+                    # ran out by itself has been read already, and reading
+                    # it again would raise StreamConsumedError
+                    for _ in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        pass
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if endpoint is not None:
+                self.endpoints.release(endpoint, self.model if answered else None, failed,
+                                       trial=getattr(response, "trial", False))
+
+    def print_streamed_response(self, response, selector, log=True):
+        # elapsed is the time until the headers came back
+        timer = self.timer(response.request.path_url,
+                           time.time() - response.elapsed.total_seconds())
+        full_response = "".join(self.iter_tokens(response, selector, timer=timer))
+        if log:
+            logger.info(full_response)
+        return full_response
+
     def generate(self, _prompt):
-        response = self.post(
-            url="/api/generate",
-            model=self.model,
-            prompt=_prompt
-        )
-        self.print_streamed_response(
-            response,
-            lambda response: response["response"]
-        )
+        return self.answer("/api/generate", generate_response, prompt=_prompt)
+
+
+class ChatSession:
+    """A conversation that keeps the model's context warm between turns
+
+    Each turn goes to /api/generate along with the `context` tokens that
+    came back from the previous turn, so Ollama only has to prefill the
+    new prompt. `keep_alive` keeps the model loaded between turns.
+    """
+
+    def __init__(self, llm, system=None, keep_alive=KEEP_ALIVE):
+        """
+        Args:
+            llm (LLM): where to send requests
+            system (str): system prompt, sent with the first turn
+            keep_alive (str): how long Ollama should keep the model loaded
+        """
+        self.llm = llm
+        self.system = system
+        self.keep_alive = keep_alive
+        self.context = None
+        self.turns = []
+
+    def send(self, prompt):
+        """Send one user turn
+
+        Returns:
+            str: the model's answer
+        """
+        data = {"prompt": prompt, "keep_alive": self.keep_alive}
+        if self.context:
+            data["context"] = self.context
+        elif self.system:
+            data["system"] = self.system
+        if self.llm.options:
+            data["options"] = self.llm.options
+        done = []
+        timer = self.llm.timer("/api/generate")
+        response = self.llm.post("/api/generate", model=self.llm.model, **data)
+        answer = "".join(self.llm.iter_tokens(
+            response, generate_response, on_done=done.append, timer=timer))
+        logger.info(answer)
+        if done:
+            self._record(done[0])
+        return answer
 
+    def _record(self, done):
+        reused = len(self.context or [])
+        self.context = done.get("context", self.context)
+        count = done.get("prompt_eval_count", 0)
+        duration = done.get("prompt_eval_duration", 0) / 1e9
+        # assume re-reading the old context would have cost the same
+        # per token as prefilling the new prompt did
+        saved = reused * duration / count if count else 0.0
+        turn = {
+            "prompt_eval_count": count,
+            "prompt_eval_seconds": duration,
+            "reused_tokens": reused,
+            "saved_seconds": saved,
+        }
+        self.turns.append(turn)
+        logger.info("turn %d: prefilled %d tokens in %.2fs, reused %d "
+                    "tokens of context (about %.2fs saved)",
+                    len(self.turns), count, duration, reused, saved)
 
-# model_name = "tinyllama"
-# model_name = "mistral"
-model_name = "llama3"
-# model_name = "codellama"
-llm = LLM(model_name)
+    def report(self):
+        """
+        Returns:
+            dict: prefill totals over all turns so far
+        """
+        return {
+            "turns": len(self.turns),
+            "prompt_eval_count": sum(t["prompt_eval_count"] for t in self.turns),
+            "prompt_eval_seconds": sum(t["prompt_eval_seconds"] for t in self.turns),
+            "reused_tokens": sum(t["reused_tokens"] for t in self.turns),
+            "saved_seconds": sum(t["saved_seconds"] for t in self.turns),
+        }
+
+
+SYSTEM_PROMPT = """
+If a prompt is Python code, then write google-style docstrings
+for all classes, methods and functions that need them.
+Otherwise, use all python code encountered so far as context to answer any
+questions.
+"""
+
+TEST_PROMPT = """Please write some pytest cases for these functions. Test
+cases should be able to run in any order without affecting whether or
+not they pass. Avoid any use of global state. Use mocking or patching
+for anything that touches the environment, files or the network."""
+
+
+def conversation(code, follow_ups=(TEST_PROMPT,)):
+    """The docstring conversation about a piece of code
+
+    Args:
+        code (str): Python source, answered with docstrings
+        follow_ups (list): further questions, each after the model's
+            previous answer
+    Returns:
+        list: messages with a PLACEHOLDER for each answer but the last
+    """
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": code},
+    ]
+    for question in follow_ups:
+        messages.append(PLACEHOLDER)
+        messages.append({"role": "user", "content": question})
+    return messages
 
 
 def code_snippet(pathname, start, finish):
-    with open(pathname, encoding='utf-8') as f:
-        lines = f.readlines()
-        return "\n".join(lines[start-1:finish])
+    """Lines start to finish of a file, both included, counting from 1,
+    read through the shared SnippetIndex, see snippets.py"""
+    return default_index().snippet(pathname, start, finish)
 
 
-Z = """
-def is_truthy(s: str):
-    try:
-        return int(s) != 0
-    except ValueError:
-        return s.lower() in ("true", "yes", "1")
+if __name__ == "__main__":
+    # model_name = "tinyllama"
+    # model_name = "mistral"
+    model_name = "llama3"
+    # model_name = "codellama"
+    cache = None
+    if os.environ.get("LLM_CACHE"):
+        cache = ResponseCache(os.environ["LLM_CACHE"])
+    context_window = None
+    if os.environ.get("CONTEXT_BUDGET"):
+        context_window = ContextWindow(int(os.environ["CONTEXT_BUDGET"]))
+    sinks = []
+    if os.environ.get("LLM_METRICS"):
+        sinks.append(JsonLinesSink(os.environ["LLM_METRICS"]))
+    registry = MetricsRegistry()
+    llm = LLM(model_name, cache=cache, context_window=context_window,
+              metrics=[registry] + sinks)
 
+    Z = """
+    def is_truthy(s: str):
+        try:
+            return int(s) != 0
+        except ValueError:
+            return s.lower() in ("true", "yes", "1")
 
-def fetch_env_var(key, default=""):
-    key = key.upper().replace(" ", "_").replace("-", "_")
-    return os.environ.get(key, default)
 
+    def fetch_env_var(key, default=""):
+        key = key.upper().replace(" ", "_").replace("-", "_")
+        return os.environ.get(key, default)
 
-def set_env_var(key, value):
-    key = key.upper().replace(" ", "_").replace("-", "_")
-    os.environ[key] = str(value)
 
+    def set_env_var(key, value):
+        key = key.upper().replace(" ", "_").replace("-", "_")
+        os.environ[key] = str(value)
 
-def boolean_env_var(key):
-    return is_truthy(fetch_env_var(key, ""))
-"""
 
-Z = open("/mycode.py").read()
-print(Z)
-
-messages = [
-    {
-        "role": "system",
-        "content": """
-        If a prompt is Python code, then write google-style docstrings
-        for all classes, methods and functions that need them.
-        Otherwise, use all python code encountered so far as context to answer any
-        questions.
-        """
-    },
-    {
-        "role": "user",
-        "content": Z
-    },
-    PLACEHOLDER,
-    {
-        "role": "user",
-        "content": """Please write some pytest cases for these functions. Test
+    def boolean_env_var(key):
+        return is_truthy(fetch_env_var(key, ""))
+    """
+
+    Z = open("/mycode.py").read()
+    print(Z)
+
+    messages = conversation(Z, [
+        """Please write some pytest cases for these functions. Test
         cases should be able to run in any order without affecting whether or
         not they pass. Avoid any use of global state. In particular, consider
         using some mocking or patching scheme for set_env_var() to avoid
-        directly modifying the os.environ dictionary."""
-    },
-    PLACEHOLDER,
-    {
-        "role": "user",
-        "content": """Show how these functions could be used to enable debug-level
+        directly modifying the os.environ dictionary.""",
+        """Show how these functions could be used to enable debug-level
         logging when an environment variable `DEBUG` is set to a truthy value."""
-    }
-]
+    ])
 
-llm.chat(messages=messages)
+    if os.environ.get("REUSE_CONTEXT"):
+        llm.chat_with_context(messages)
+    else:
+        llm.chat(messages=messages)
+    if cache is not None:
+        logger.info("cache: %s", cache.stats())
+    logger.info("metrics:\n%s", registry.prometheus())
+    if context_window is not None:
+        logger.info("tokens sent per turn: %s",
+                    [t["tokens"] for t in context_window.report()])
@@ -0,0 +1,150 @@
+"""
+On-disk cache of LLM answers, so re-running the same prompts against
+the same model doesn't pay for inference again.
+
+Entries live in a SQLite file, which takes care of locking when several
+processes share the cache. Least recently used entries are evicted once
+the cache grows past max_bytes, and entries older than ttl seconds are
+treated as missing.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger()
+
+MAX_BYTES = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used);
+"""
+
+
+def make_key(endpoint, model, payload):
+    """Hash a request into a cache key
+
+    Args:
+        endpoint (str): full URL of the API call
+        model (str): name of the model
+        payload (dict): everything else sent, e.g. messages or prompt,
+            plus options
+    Returns:
+        str: hex digest that doesn't depend on dict ordering
+    """
+    canonical = json.dumps(
+        [endpoint, model, payload],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=MAX_BYTES, ttl=None):
+        """
+        Args:
+            path (str): SQLite file to keep the cache in
+            max_bytes (int): total size of cached answers before the least
+                recently used ones are evicted
+            ttl (float): seconds an answer stays valid, None for forever
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60,
+                                 isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    make_key = staticmethod(make_key)
+
+    def get(self, key):
+        """
+        Returns:
+            str: the cached answer, or None on a miss
+        """
+        now = time.time()
+        db = self._db()
+        row = db.execute("SELECT value, created FROM answers WHERE key = ?",
+                         (key,)).fetchone()
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        db.execute("UPDATE answers SET last_used = ? WHERE key = ?",
+                   (now, key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now)
+            )
+            self._evict(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in db.execute(
+                "SELECT key, size FROM answers ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        db.executemany("DELETE FROM answers WHERE key = ?", doomed)
+        logger.info("evicted %d answers from %s", len(doomed), self.path)
+
+    def clear(self):
+        self._db().execute("DELETE FROM answers")
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits and misses in this process, plus the number of
+                entries and bytes in the cache
+        """
+        count, size = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+            "bytes": size,
+        }
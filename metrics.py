@@ -0,0 +1,228 @@
+"""
+Timings of Ollama requests, from the final "done" message of each
+streamed response plus what the client measured itself.
+
+A sink is anything with a record(call) method, where call is the dict
+made by call_record(). Two come with this module:
+
+    MetricsRegistry()          histograms per model in memory, dumped in
+                               the Prometheus text format
+    JsonLinesSink(path)        one JSON line per request
+
+    registry = MetricsRegistry()
+    llm = LLM("llama3", metrics=[registry, JsonLinesSink("calls.jsonl")])
+    ...
+    print(registry.prometheus())
+"""
+
+import json
+import threading
+import time
+
+# load_duration above this means the model wasn't already in memory
+COLD_LOAD_SECONDS = 0.5
+
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500, 1000, 5000)
+
+# histogram name -> (field of the call record, buckets)
+HISTOGRAMS = {
+    "ollama_request_seconds": ("wall_seconds", SECONDS_BUCKETS),
+    "ollama_time_to_first_token_seconds": ("ttft_seconds", SECONDS_BUCKETS),
+    "ollama_load_seconds": ("load_seconds", SECONDS_BUCKETS),
+    "ollama_prompt_eval_seconds": ("prompt_eval_seconds", SECONDS_BUCKETS),
+    "ollama_eval_seconds": ("eval_seconds", SECONDS_BUCKETS),
+    "ollama_queue_seconds": ("queue_seconds", SECONDS_BUCKETS),
+    "ollama_prompt_tokens_per_second": ("prompt_tokens_per_second", TOKENS_PER_SECOND_BUCKETS),
+    "ollama_eval_tokens_per_second": ("eval_tokens_per_second", TOKENS_PER_SECOND_BUCKETS),
+}
+
+# counter name -> field of the call record, summed
+COUNTERS = {
+    "ollama_requests_total": None,
+    "ollama_prompt_tokens_total": "prompt_eval_count",
+    "ollama_eval_tokens_total": "eval_count",
+    "ollama_cold_loads_total": "cold_load",
+}
+
+
+def call_record(model, url, done, started, first_token, finished):
+    """Everything known about one request
+
+    Ollama reports durations in nanoseconds. queue_seconds is the wall
+    time the server didn't account for: waiting for a free slot, plus the
+    network.
+    Args:
+        model (str): model asked
+        url (str): API path, e.g. "/api/chat"
+        done (dict): the final message of the stream
+        started (float): time.time() when the request was sent
+        first_token (float): time.time() when the first piece arrived,
+            None if there was none
+        finished (float): time.time() when the done message arrived
+    Returns:
+        dict: the call record sinks get
+    """
+    def seconds(name):
+        return done.get(name, 0) / 1e9
+
+    def rate(count, duration):
+        return count / duration if duration else None
+
+    wall = finished - started
+    prompt_eval = seconds("prompt_eval_duration")
+    evaluation = seconds("eval_duration")
+    return {
+        "time": started,
+        "model": model,
+        "endpoint": url,
+        "wall_seconds": wall,
+        "ttft_seconds": None if first_token is None else first_token - started,
+        "total_seconds": seconds("total_duration"),
+        "load_seconds": seconds("load_duration"),
+        "prompt_eval_seconds": prompt_eval,
+        "eval_seconds": evaluation,
+        "queue_seconds": max(wall - seconds("total_duration"), 0.0),
+        "prompt_eval_count": done.get("prompt_eval_count", 0),
+        "eval_count": done.get("eval_count", 0),
+        "prompt_tokens_per_second": rate(done.get("prompt_eval_count", 0), prompt_eval),
+        "eval_tokens_per_second": rate(done.get("eval_count", 0), evaluation),
+        "cold_load": seconds("load_duration") > COLD_LOAD_SECONDS,
+    }
+
+
+class CallTimer:
+    """Times one streamed request, for the sinks of an LLM
+
+        timer = CallTimer(sinks, model, url)
+        for piece in llm.iter_tokens(response, selector, timer=timer):
+    """
+
+    def __init__(self, sinks, model, url, started=None):
+        self.sinks = sinks
+        self.model = model
+        self.url = url
+        self.started = time.time() if started is None else started
+        self.first_token = None
+
+    def first(self):
+        if self.first_token is None:
+            self.first_token = time.time()
+
+    def done(self, message):
+        record = call_record(self.model, self.url, message, self.started,
+                             self.first_token, time.time())
+        for sink in self.sinks:
+            sink.record(record)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # the last is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        if not self.count:
+            return None
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+
+
+class MetricsRegistry:
+    """Histograms and counters per (model, endpoint), in memory"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}    # (name, model, endpoint) -> Histogram
+        self.counters = {}      # (name, model, endpoint) -> number
+
+    def record(self, call):
+        labels = (call["model"], call["endpoint"])
+        with self._lock:
+            for name, (field, buckets) in HISTOGRAMS.items():
+                if call.get(field) is None:
+                    continue
+                key = (name,) + labels
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(call[field])
+            for name, field in COUNTERS.items():
+                key = (name,) + labels
+                self.counters[key] = self.counters.get(key, 0) + (
+                    1 if field is None else call[field])
+
+    def summary(self):
+        """
+        Returns:
+            dict: (model, endpoint) -> requests, cold loads, and the
+                median of each histogram
+        """
+        result = {}
+        with self._lock:
+            for (name, model, endpoint), n in self.counters.items():
+                result.setdefault((model, endpoint), {})[name] = n
+            for (name, model, endpoint), h in self.histograms.items():
+                result.setdefault((model, endpoint), {})[name + "_p50"] = h.quantile(0.5)
+        return result
+
+    def prometheus(self):
+        """
+        Returns:
+            str: everything in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name in COUNTERS:
+                lines.append("# TYPE {0} counter".format(name))
+                for (metric, model, endpoint), n in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append("{0}{{{1}}} {2}".format(
+                            name, _labels(model, endpoint), n))
+            for name in HISTOGRAMS:
+                lines.append("# TYPE {0} histogram".format(name))
+                for (metric, model, endpoint), h in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    labels = _labels(model, endpoint)
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + ("+Inf",), h.counts):
+                        cumulative += n
+                        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                            name, labels, bound, cumulative))
+                    lines.append("{0}_sum{{{1}}} {2}".format(name, labels, h.sum))
+                    lines.append("{0}_count{{{1}}} {2}".format(name, labels, h.count))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(model, endpoint):
+    return 'model="{0}",endpoint="{1}"'.format(
+        model.replace('"', '\\"'), endpoint.replace('"', '\\"'))
+
+
+class JsonLinesSink:
+    """Appends each call record to a file as one line of JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        line = json.dumps(call) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
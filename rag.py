@@ -0,0 +1,175 @@
+"""
+Answer questions about the ingested code: retrieve the chunks closest to
+the question, pack as many as fit in a token budget into the prompt, and
+ask the model.
+
+    python rag.py "how does submit_preflight build its command line"
+    python rag.py --local-store DIR --lexical FILE -k 20 --budget 3000 "..."
+
+The prompt puts what doesn't change first: the system prompt, then the
+code ordered by path and line, then the question. Questions that pull in
+the same chunks share a prefix, and Ollama doesn't prefill it again.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "data-ingestion"))
+
+from chunker import estimate_tokens     # noqa: E402
+from foo import LLM, logger             # noqa: E402
+
+# tokens of retrieved code allowed in one prompt, not counting the
+# system prompt and the question
+TOKEN_BUDGET = int(os.environ.get("RAG_TOKEN_BUDGET", 3000))
+TOP_K = int(os.environ.get("RAG_TOP_K", 20))
+# don't bother with a truncated chunk smaller than this
+MIN_TRUNCATED_TOKENS = 64
+
+SYSTEM_PROMPT = """You answer questions about a Python code base. The
+user's message starts with excerpts of that code, each headed by its path
+and line numbers, followed by the question. Use the excerpts to answer,
+and say so when they don't contain what's needed."""
+
+
+def chunk_header(properties):
+    return "# {path}:{start_line}-{end_line} ({qualname})".format(**properties)
+
+
+def retrieve(question, store, k=TOP_K, index=None):
+    """
+    Args:
+        store (VectorStore): what ingest.py stored
+        index (LexicalIndex): if given, fuse BM25 with vector search
+    Returns:
+        list: Hits, best first
+    """
+    from ingest import encode
+    if index is not None:
+        from lexical import hybrid_search
+        return hybrid_search(question, index, store, lambda text: encode([text])[0], k)
+    return store.search(encode([question])[0], k)
+
+
+def truncate(text, budget, count_tokens=estimate_tokens):
+    """Leading lines of text that fit in budget tokens"""
+    kept = []
+    used = 0
+    for line in text.splitlines(keepends=True):
+        used += count_tokens(line)
+        if used > budget:
+            break
+        kept.append(line)
+    return "".join(kept)
+
+
+def pack(hits, budget=TOKEN_BUDGET, count_tokens=estimate_tokens):
+    """Choose which chunks go into the prompt
+
+    Chunks are taken best score first. The same text twice, or lines
+    another chosen chunk already covers, are skipped. The first chunk that
+    doesn't fit is cut down to what's left of the budget, and packing
+    stops there.
+    Args:
+        hits (list): Hits from retrieve()
+        budget (int): tokens allowed, headers included
+    Returns:
+        list: (properties, text) pairs, ordered by path and first line
+    """
+    chosen = []
+    seen_text = set()
+    covered = {}        # path -> list of (start, end)
+    used = 0
+    for hit in sorted(hits, key=lambda h: -h.score):
+        props = hit.properties
+        text = props["code"]
+        ranges = covered.setdefault(props["path"], [])
+        if text in seen_text or any(start <= props["start_line"] and props["end_line"] <= end
+                                    for start, end in ranges):
+            continue
+        cost = count_tokens(chunk_header(props)) + count_tokens(text)
+        if used + cost > budget:
+            left = budget - used - count_tokens(chunk_header(props))
+            if left >= MIN_TRUNCATED_TOKENS:
+                text = truncate(text, left, count_tokens)
+                if text:
+                    end_line = props["start_line"] + len(text.splitlines()) - 1
+                    chosen.append((dict(props, end_line=end_line), text))
+            break
+        seen_text.add(text)
+        ranges.append((props["start_line"], props["end_line"]))
+        chosen.append((props, text))
+        used += cost
+    chosen.sort(key=lambda c: (c[0]["path"], c[0]["start_line"]))
+    return chosen
+
+
+def build_messages(question, chunks):
+    excerpts = "\n\n".join(chunk_header(props) + "\n" + text.rstrip("\n")
+                           for props, text in chunks)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": excerpts + "\n\n" + question},
+    ]
+
+
+def ask(llm, question, store, k=TOP_K, budget=TOKEN_BUDGET, index=None):
+    """Retrieve, pack and ask
+
+    Returns:
+        tuple: the answer, and a dict of seconds spent on retrieval,
+            prompt assembly and inference, with the prompt's size
+    """
+    t0 = time.time()
+    hits = retrieve(question, store, k, index)
+    t1 = time.time()
+    chunks = pack(hits, budget)
+    messages = build_messages(question, chunks)
+    t2 = time.time()
+    answer = llm.chat(messages=messages)
+    t3 = time.time()
+    timings = {
+        "retrieval_seconds": t1 - t0,
+        "assembly_seconds": t2 - t1,
+        "inference_seconds": t3 - t2,
+        "retrieved": len(hits),
+        "packed": len(chunks),
+        "prompt_tokens": sum(estimate_tokens(m["content"]) for m in messages),
+    }
+    logger.info("retrieval %.3fs, assembly %.3fs, inference %.2fs, "
+                "%d of %d chunks packed, about %d prompt tokens",
+                timings["retrieval_seconds"], timings["assembly_seconds"],
+                timings["inference_seconds"], timings["packed"],
+                timings["retrieved"], timings["prompt_tokens"])
+    return answer, timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("question")
+    parser.add_argument("-k", type=int, default=TOP_K, help="chunks to retrieve")
+    parser.add_argument("--budget", type=int, default=TOKEN_BUDGET,
+                        help="tokens of code allowed in the prompt")
+    parser.add_argument("--model", default="llama3")
+    parser.add_argument("--local-store", metavar="DIR")
+    parser.add_argument("--lexical", metavar="FILE")
+    args = parser.parse_args()
+
+    from vector_store import LocalStore, WeaviateStore
+    if args.local_store:
+        store = LocalStore(args.local_store)
+    else:
+        from ingest import connect
+        store = WeaviateStore(connect())
+    index = None
+    if args.lexical:
+        from lexical import LexicalIndex
+        index = LexicalIndex(args.lexical)
+    ask(LLM(args.model), args.question, store, args.k, args.budget, index)
+
+
+if __name__ == "__main__":
+    main()
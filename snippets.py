@@ -0,0 +1,148 @@
+"""
+Ranges of lines from source files, read in proportion to the range
+rather than the file.
+
+    index = SnippetIndex()
+    index.snippet("generated.py", 1200, 1260)
+    index.snippets([("a.py", 10, 40), ("b.py", 1, 12), ("a.py", 90, 95)])
+
+The first time a file is asked for, it is memory-mapped and the offset
+of every line start is recorded, in one pass. After that a range is one
+slice of the map. The index of a file is rebuilt when its mtime or size
+changes, and only the most recently used max_files files are kept open.
+"""
+
+import logging
+import mmap
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+MAX_FILES = 64
+
+_NEWLINE = re.compile(rb"\n")
+
+
+class _Lines:
+    """A memory-mapped file and where each of its lines starts"""
+
+    def __init__(self, path, st):
+        self.stamp = (st.st_mtime_ns, st.st_size)
+        self.size = st.st_size
+        self.map = None
+        # offsets[i] is where line i + 1 starts; the last is the file size
+        self.offsets = array("q", [0])
+        if not self.size:
+            return
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets.extend(m.end() for m in _NEWLINE.finditer(self.map))
+        if self.offsets[-1] != self.size:
+            self.offsets.append(self.size)     # last line has no newline
+
+    @property
+    def count(self):
+        return len(self.offsets) - 1
+
+    def slice(self, start, finish):
+        start = max(start, 1)
+        finish = min(finish, self.count)
+        if self.map is None or start > finish:
+            return b""
+        return self.map[self.offsets[start - 1]:self.offsets[finish]]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class SnippetIndex:
+    def __init__(self, max_files=MAX_FILES):
+        """
+        Args:
+            max_files (int): files kept mapped and indexed at once
+        """
+        self.max_files = max_files
+        self._files = OrderedDict()     # path -> _Lines, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lines(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        lines = self._files.get(path)
+        if lines is not None and lines.stamp == (st.st_mtime_ns, st.st_size):
+            self.hits += 1
+            self._files.move_to_end(path)
+            return lines
+        self.misses += 1
+        if lines is not None:
+            lines.close()
+        lines = self._files[path] = _Lines(path, st)
+        self._files.move_to_end(path)
+        while len(self._files) > self.max_files:
+            self._files.popitem(last=False)[1].close()
+        return lines
+
+    def snippet(self, path, start, finish):
+        """Lines start to finish of a file, both included, counting from 1
+
+        Returns:
+            str: the lines with their newlines, as in the file
+        """
+        with self._lock:
+            return self._lines(path).slice(start, finish).decode("utf-8")
+
+    def snippets(self, requests):
+        """Many snippets at once, looking at each file only once
+
+        Args:
+            requests (iterable): (path, start, finish) triples
+        Returns:
+            list: the snippets, in the same order
+        """
+        by_path = OrderedDict()
+        count = 0
+        for i, (path, start, finish) in enumerate(requests):
+            by_path.setdefault(path, []).append((i, start, finish))
+            count += 1
+        result = [None] * count
+        with self._lock:
+            # a file at a time, so evicting others can't unmap it midway
+            for path, wanted in by_path.items():
+                lines = self._lines(path)
+                for i, start, finish in wanted:
+                    result[i] = lines.slice(start, finish).decode("utf-8")
+        return result
+
+    def line_count(self, path):
+        with self._lock:
+            return self._lines(path).count
+
+    def close(self):
+        with self._lock:
+            for lines in self._files.values():
+                lines.close()
+            self._files.clear()
+
+    def stats(self):
+        return {"files": len(self._files), "hits": self.hits, "misses": self.misses}
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_index():
+    """The SnippetIndex shared by code_snippet() and batch jobs"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = SnippetIndex()
+        return _default
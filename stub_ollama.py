@@ -0,0 +1,118 @@
+"""
+A tiny stand-in for an Ollama server, good enough for benchmarks.
+It answers /api/generate and /api/chat with a short NDJSON stream
+over HTTP/1.1 keep-alive connections, and /api/tags and /api/ps for
+health checks. Like a real server it can be limited to a number of
+requests evaluated at once (OLLAMA_NUM_PARALLEL); the rest wait.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    tokens = ["Hello", ",", " world", "!"]
+    delay = 0.0
+    slots = None        # threading.Semaphore, None for no limit
+    loaded = None       # set of models this server has answered for
+
+    def log_message(self, format, *args):
+        pass
+
+    def hang_up(self):
+        """Drop the connection without answering if the server is "down"
+        (set server.down = True), the way a crashed server would"""
+        if getattr(self.server, "down", False):
+            self.close_connection = True
+            return True
+        return False
+
+    def do_GET(self):
+        if self.hang_up():
+            return
+        models = []
+        if self.path == "/api/ps":
+            models = [{"name": name, "model": name} for name in sorted(self.loaded)]
+        body = json.dumps({"models": models}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.hang_up():
+            return
+        if self.slots is not None:
+            with self.slots:
+                self.evaluate(request)
+        else:
+            self.evaluate(request)
+
+    def evaluate(self, request):
+        if self.delay:
+            time.sleep(self.delay)
+        self.loaded.add(request.get("model"))
+        chat = self.path == "/api/chat"
+        lines = []
+        for token in self.tokens:
+            if chat:
+                msg = {"message": {"role": "assistant", "content": token}}
+            else:
+                msg = {"response": token}
+            msg.update(model=request.get("model"), done=False)
+            lines.append(json.dumps(msg))
+        if chat:
+            prompt = " ".join(m["content"] for m in request.get("messages", []))
+        else:
+            prompt = request.get("prompt", "")
+        prompt_tokens = len(prompt.split())
+        done = {
+            "model": request.get("model"),
+            "done": True,
+            "total_duration": int((self.delay + 0.001) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": prompt_tokens * 1000000,
+            "eval_count": len(self.tokens),
+            "eval_duration": len(self.tokens) * 1000000,
+        }
+        if not chat:
+            done["context"] = (request.get("context", []) +
+                               list(range(prompt_tokens + len(self.tokens))))
+        lines.append(json.dumps(done))
+        body = ("\n".join(lines) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port=0, delay=0.0, parallel=None):
+    """Start a stub server in a daemon thread
+
+    Args:
+        port (int): port to listen on, 0 picks a free one
+        delay (float): seconds to sleep before answering each POST
+        parallel (int): POSTs evaluated at once, None for no limit
+    Returns:
+        ThreadingHTTPServer: the running server, its URL is
+            "http://127.0.0.1:%d" % server.server_address[1]
+    """
+    handler = type("Handler", (StubHandler,), {
+        "delay": delay,
+        "slots": threading.Semaphore(parallel) if parallel else None,
+        "loaded": set(),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server